@@ -8,6 +8,9 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -53,43 +56,25 @@ test_t = t[-Ntest:]
 
 # CGF for True System
 test_u = test_u.numpy()
-Nt = test_u.shape[0]
 dim_u2 = 1
-mu_trace = np.zeros((Nt, dim_u2, 1))
-R_trace = np.zeros((Nt, dim_u2, dim_u2))
-mu_trace[0] = np.zeros((dim_u2, 1))
-R_trace[0] = np.eye(dim_u2)*0.01
-mu0 = mu_trace[0]
-R0 = R_trace[0]
-for n in range(1, Nt):
-    y0 = test_u[n-1, 1]
-    z0 = test_u[n-1, 2]
-    y1 = test_u[n, 1]
-    z1 = test_u[n, 2]
-    f1 = np.array([[g-y0], [-z0]])
-    g1 = np.array([[y0-b*z0], [b*y0+z0]])
-    s1 = np.diag([sigma_y, sigma_z])
-    f2 = np.array([[a*f - (y0**2+z0**2)]])
-    g2 = np.array([[-a]])
-    s2 = np.array([[sigma_x]])
-    invs1os1 = np.linalg.inv(s1@s1.T)
-    s2os2 = s2@s2.T
-    du1 = np.array([[y1-y0], [z1-z0]])
-    mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-    R1 = R0 + ( g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-    mu_trace[n] = mu1
-    R_trace[n] = R1
-    mu0 = mu1
-    R0 = R1
+def coef_true(u1):
+    # Coefficients of the true model at all steps, stacked over time (t-1, ...)
+    y0 = u1[:-1, [0]]
+    z0 = u1[:-1, [1]]
+    f1 = torch.cat([g-y0, -z0], dim=1)
+    g1 = torch.cat([y0-b*z0, b*y0+z0], dim=1)
+    s1 = torch.diag(torch.tensor([sigma_y, sigma_z], dtype=torch.float64))
+    f2 = a*f - (y0**2+z0**2)
+    g2 = torch.tensor([[-a]], dtype=torch.float64)
+    s2 = torch.tensor([[sigma_x]], dtype=torch.float64)
+    return (f1, g1, s1, f2, g2, s2)
+mu_trace, R_trace = cgf.CGFilter(coef_true, u1=torch.tensor(test_u[:, 1:], dtype=torch.float64).unsqueeze(2), mu0=torch.zeros((dim_u2, 1), dtype=torch.float64), R0=0.01*torch.eye(dim_u2, dtype=torch.float64), cut_point=0, dt=dt)
+mu_trace = mu_trace.numpy()
+R_trace = R_trace.numpy()
 
 np.mean( (test_u[:,0] - mu_trace.flatten())**2 )
 
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 avg_neg_log_likehood(
     torch.tensor(test_u[:, [0]]).unsqueeze(2),
@@ -152,7 +137,6 @@ class MixModel(nn.Module):
 
 def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a0 = regmodel.reg0.bias[:]
@@ -164,36 +148,22 @@ def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     c1 = regmodel.reg2.weight[:, 0]
     c2 = regmodel.reg2.weight[:, 1]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        y0 = u1[n-1, 0].flatten()
-        z0 = u1[n, 1].flatten()
-        du1 = u1[n] - u1[n-1]
-
-        f1 = torch.cat([b0+b1*y0, c0+c1*z0]).reshape(-1, 1)
-        g1 = torch.cat([torch.zeros(1), c2*z0]).reshape(-1, 1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        y0 = u1[:-1, 0]
+        z0 = u1[1:, 1]
+
+        f1 = torch.cat([b0+b1*y0, c0+c1*z0], dim=1).unsqueeze(2)
+        g1 = torch.cat([torch.zeros_like(z0), c2*z0], dim=1).unsqueeze(2)
         s1 = torch.diag(torch.tensor([sigma_y, sigma_z]))
-        f2 = (a0+a2*z0**2).reshape(1,1)
-        g2 = (a1).reshape(1,1)
+        f2 = (a0+a2*z0**2).unsqueeze(2)
+        g2 = a1.reshape(1, 1)
         s2 = torch.tensor([[sigma_x]])
+        return (f1, g1, s1, f2, g2, s2)
 
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 def CGFilter_MixModel(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a0 = mixmodel.reg0.bias[:]
@@ -205,34 +175,21 @@ def CGFilter_MixModel(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     c1 = mixmodel.reg2.weight[:, 0]
     c2 = mixmodel.reg2.weight[:, 1]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        y0 = u1[n-1, 0].flatten()
-        z0 = u1[n, 1].flatten()
-        du1 = u1[n] - u1[n-1]
-        outnet = mixmodel.net(u1[n-1].T).T
-
-        f1 = torch.cat([b0+b1*y0+outnet[1], c0+c1*z0+outnet[2]]).reshape(-1, 1)
-        g1 = torch.cat([outnet[4], c2*z0+outnet[5]]).reshape(-1, 1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        y0 = u1[:-1, 0]
+        z0 = u1[1:, 1]
+        outnet = mixmodel.net(u1[:-1, :, 0])
+
+        f1 = torch.cat([b0+b1*y0+outnet[:, [1]], c0+c1*z0+outnet[:, [2]]], dim=1).unsqueeze(2)
+        g1 = torch.cat([outnet[:, [4]], c2*z0+outnet[:, [5]]], dim=1).unsqueeze(2)
         s1 = torch.diag(torch.tensor([sigma_y, sigma_z]))
-        f2 = (a0+a2*z0**2+outnet[0]).reshape(1,1)
-        g2 = (a1+outnet[3]).reshape(1,1)
+        f2 = (a0+a2*z0**2+outnet[:, [0]]).unsqueeze(2)
+        g2 = (a1+outnet[:, [3]]).unsqueeze(2)
         s2 = torch.tensor([[sigma_x]])
+        return (f1, g1, s1, f2, g2, s2)
 
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 
 
 model1 = RegModel()
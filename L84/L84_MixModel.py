@@ -8,6 +8,11 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.forecast import forecast_windows, skill_curves, cg_forecast
+from cgnsde.smoother import CGSampler
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -90,7 +95,7 @@ class MixModel(nn.Module):
         self.out = torch.cat([x_dyn, y_dyn, z_dyn], dim=1)
         return self.out
 
-def ODESolver(model, u0, steps, dt):
+def ODESolver(model, u0, steps, dt, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     u_pred = torch.zeros(steps, dim)
@@ -98,6 +103,8 @@ def ODESolver(model, u0, steps, dt):
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_pred[n].unsqueeze(0)).squeeze(0)
         u_pred[n+1] = u_pred[n]+u_dot_pred*dt
+        if guard is not None and not guard.check(n+1, u_pred[n+1]):
+            return u_pred[:n+2]
     return u_pred
 
 ###########################################################
@@ -144,9 +151,7 @@ with torch.no_grad():
     train_u_dot_pred = mixmodel(None, train_u[:-1])
 sigma_hat = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred)**2, dim=0 ) ).tolist()
 
-def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
-    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
+def cg_coef(mixmodel, sigma_lst):
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a0 = mixmodel.reg0.bias[:]
@@ -158,36 +163,28 @@ def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     c1 = mixmodel.reg2.weight[:, 0]
     c2 = mixmodel.reg2.weight[:, 1]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        y0 = u1[n-1, 0].flatten()
-        z0 = u1[n, 1].flatten()
-        du1 = u1[n] - u1[n-1]
-        outnet = mixmodel.net(u1[n-1].T).T
-
-        f1 = torch.cat([b0+b1*y0+outnet[1], c0+c1*z0+outnet[2]]).reshape(-1, 1)
-        g1 = torch.cat([outnet[4], c2*z0+outnet[5]]).reshape(-1, 1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        y0 = u1[:-1, 0]
+        z0 = u1[1:, 1]
+        outnet = mixmodel.net(u1[:-1, :, 0])
+
+        f1 = torch.cat([b0+b1*y0+outnet[:, [1]], c0+c1*z0+outnet[:, [2]]], dim=1).unsqueeze(2)
+        g1 = torch.cat([outnet[:, [4]], c2*z0+outnet[:, [5]]], dim=1).unsqueeze(2)
         s1 = torch.diag(torch.tensor([sigma_y, sigma_z]))
-        f2 = (a0+a2*z0**2+outnet[0]).reshape(1,1)
-        g2 = (a1+outnet[3]).reshape(1,1)
+        f2 = (a0+a2*z0**2+outnet[:, [0]]).unsqueeze(2)
+        g2 = (a1+outnet[:, [3]]).unsqueeze(2)
         s2 = torch.tensor([[sigma_x]])
+        return (f1, g1, s1, f2, g2, s2)
+
+    return coef
+
 
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
-
-def SDESolver(model, u0, steps, dt, sigma_lst):
+def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
+    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
+    return cgf.CGFilter(cg_coef(mixmodel, sigma_lst), u1, mu0, R0, cut_point, dt)
+
+def SDESolver(model, u0, steps, dt, sigma_lst, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     sigma = torch.tensor(sigma_lst)
@@ -196,6 +193,8 @@ def SDESolver(model, u0, steps, dt, sigma_lst):
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_simu[n].unsqueeze(0)).squeeze(0)
         u_simu[n+1] = u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(3)
+        if guard is not None and not guard.check(n+1, u_simu[n+1]):
+            return u_simu[:n+2]
     return u_simu
 
 ############################################################
@@ -203,15 +202,16 @@ def SDESolver(model, u0, steps, dt, sigma_lst):
 ############################################################
 # Stage 2: Train mixmodel with forcast loss + DA loss
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 long_steps = int(50/dt)
 cut_point = int(5/dt)
 
+# Warm-started DA windows: start from the cached posteriors of previous epochs with a short spin-up
+warm_start = True
+warm_long_steps = long_steps//2
+warm_cut_point = int(1/dt)
+state_cache = cgf.FilterStateCache(Ntrain, 1, max_age=20, device=device)
+
 epochs = 500
 train_loss_history = []
 train_loss_da_history = []
@@ -223,17 +223,25 @@ for ep in range(1, epochs+1):
     u_short = train_u[head_idx_short:head_idx_short + short_steps].to(device)
     t_short = train_t[head_idx_short:head_idx_short + short_steps].to(device)
 
-    head_idx_long = torch.from_numpy( np.random.choice(Ntrain-long_steps+1, size=1) )
-    u_long = train_u[head_idx_long:head_idx_long + long_steps].to(device)
-    t_long = train_t[head_idx_long:head_idx_long + long_steps].to(device)
+    head_idx_long = state_cache.sample_head(ep, Ntrain-warm_long_steps) if warm_start else None
+    if head_idx_long is None:
+        head_idx_long = np.random.choice(Ntrain-long_steps+1)
+        mu0, R0 = torch.zeros(1,1).to(device), 0.01*torch.eye(1).to(device)
+        da_cut_point, da_steps = cut_point, long_steps
+    else:
+        mu0, R0 = state_cache.lookup(head_idx_long, ep)
+        da_cut_point, da_steps = warm_cut_point, warm_long_steps
+    u_long = train_u[head_idx_long:head_idx_long + da_steps].to(device)
+    t_long = train_t[head_idx_long:head_idx_long + da_steps].to(device)
 
     optimizer.zero_grad()
 
     out = torchdiffeq.odeint(mixmodel, u_short[[0]], t_short)[:,0,:]
     loss = F.mse_loss(u_short, out)
 
-    out_da = CGFilter(mixmodel, u1=u_long[:, 1:].reshape(-1, 2, 1), mu0=torch.zeros(1,1).to(device), R0=0.01*torch.eye(1).to(device), cut_point=cut_point, sigma_lst=sigma_hat)[0]
-    loss_da = F.mse_loss(u_long[cut_point:, [0]], out_da.squeeze(2))
+    out_da, out_R = CGFilter(mixmodel, u1=u_long[:, 1:].reshape(-1, 2, 1), mu0=mu0, R0=R0, cut_point=da_cut_point, sigma_lst=sigma_hat)
+    state_cache.store(head_idx_long+da_cut_point, out_da, out_R, ep)
+    loss_da = F.mse_loss(u_long[da_cut_point:, [0]], out_da.squeeze(2))
     total_loss = loss + loss_da
     total_loss.backward()
     optimizer.step()
@@ -261,21 +269,10 @@ np.save(r"/home/cc/CodeProjects/CGNN/L84/L84_Model/L84_mixmodel2_fc_train_loss_d
 # Short-term Prediction
 def integrate_batch(t, u, model, batch_steps):
     # u is in vector form, e.g. (t, x)
-    device = u.device
-    Nt = u.shape[0]
-    num_batchs = int(Nt / batch_steps)
-    error_abs = 0
-    # error_rel = 0
-    u_pred = torch.tensor([]).to(device)
-    for i in range(num_batchs):
-        u_batch = u[i*batch_steps: (i+1)*batch_steps]
-        with torch.no_grad():
-            u_batch_pred = torchdiffeq.odeint(model, u_batch[[0]], t[:batch_steps])[:,0,:]
-        u_pred = torch.cat([u_pred, u_batch_pred])
-        error_abs += torch.mean( (u_batch - u_batch_pred)**2 ).item()
-        # error_rel += torch.mean( torch.norm(stt_batch - stt_pred_batch, 2, 1) / (torch.norm(stt_batch, 2, 1)) ).item()
-    error_abs /= num_batchs
-    # error_rel /= num_batch
+    # Consecutive windows of batch_steps, all integrated in one batched odeint call (see forecast_windows for overlapping windows)
+    u_batch_pred, u_batch = forecast_windows(t, u, model, batch_steps)
+    error_abs = torch.mean( (u_batch - u_batch_pred)**2 ).item()
+    u_pred = u_batch_pred.reshape(-1, u.shape[1])
     return [u_pred, error_abs]
 u_shortPreds, error_abs = integrate_batch(test_t, test_u, mixmodel, short_steps)
 
@@ -299,6 +296,26 @@ for ax in fig.get_axes():
 fig.tight_layout()
 plt.show()
 
+# Skill against lead time up to 1 time unit, every lead time read off one rollout from every 1000-th test step
+skill = skill_curves(test_t, test_u, mixmodel, lead_steps=int(1/dt), stride=1000)
+
+fig = plt.figure(figsize=(16, 5))
+axs = fig.subplots(1, 2)
+for i, name in enumerate(["x", "y", "z"]):
+    axs[0].plot(skill["lead"], skill["rmse"][:, i], linewidth=2, label=r"$"+name+"$")
+    axs[1].plot(skill["lead"], skill["corr"][:, i], linewidth=2, label=r"$"+name+"$")
+axs[0].set_ylabel(r"\textbf{RMSE}", fontsize=25)
+axs[1].set_ylabel(r"\textbf{Correlation}", fontsize=25)
+for ax in axs:
+    ax.set_xlabel(r"\textbf{Lead time}", fontsize=25)
+    ax.legend(fontsize=20)
+for ax in fig.get_axes():
+    ax.tick_params(labelsize=25, length=7, width=2)
+    for spine in ax.spines.values():
+        spine.set_linewidth(2)
+fig.tight_layout()
+plt.show()
+
 
 # Data Assimilation
 with torch.no_grad():
@@ -321,6 +338,55 @@ for ax in fig.get_axes():
 fig.tight_layout()
 plt.show()
 
+# Streaming DA of the same record with constant memory, skill accumulated on the fly (same posteriors as CGFilter)
+coef_hat = cg_coef(mixmodel, sigma_hat)
+with torch.no_grad():
+    stream_skill = cgf.RunningSkill()
+    stream = cgf.StreamingCGFilter(coef_hat, mu0=torch.zeros(1, 1), R0=0.01*torch.eye(1), dt=dt, reducers=[stream_skill])
+    stream.run(test_u[:, 1:].reshape(-1, 2, 1), test_u[:, [0]].unsqueeze(2), chunk_size=10000)
+stream_skill.result()
+
+
+# Forecast of x from the posteriors at every 10000-th test step, 1 time unit ahead (analytic moments over sampled u1 paths)
+fc_idx = torch.arange(0, Ntest-1000, 10000)
+fc = cg_forecast(coef_hat, test_u[fc_idx, 1:].reshape(-1, 2, 1), mu_preds[fc_idx], R_preds[fc_idx], steps=1001, dt=dt,
+                 samples=50, generator=torch.Generator().manual_seed(0))
+fc_true = torch.stack([test_u[fc_idx+n, 0] for n in range(1001)])
+fc_rmse = torch.sqrt(torch.mean((fc["mu"][:, :, 0, 0] - fc_true)**2, dim=1))
+fc_spread = torch.sqrt(torch.mean(fc["R"][:, :, 0, 0], dim=1))
+
+fig = plt.figure(figsize=(10, 4))
+ax = fig.subplots(1, 1)
+ax.plot(np.linspace(0, 1, 1001), fc_rmse, linewidth=3, label=r"\textbf{RMSE}")
+ax.plot(np.linspace(0, 1, 1001), fc_spread, linewidth=3, linestyle="dashed", label=r"\textbf{Spread}")
+ax.set_xlabel(r"Lead time", fontsize=30)
+ax.set_title(r"\textbf{Forecast of} $x$", fontsize=30)
+ax.legend(fontsize=25)
+for ax in fig.get_axes():
+    ax.tick_params(labelsize=25, length=7, width=2)
+    for spine in ax.spines.values():
+        spine.set_linewidth(2)
+fig.tight_layout()
+plt.show()
+
+
+# Posterior trajectories of x given all observations (forward-filter backward-sample)
+x_samples = CGSampler(coef_hat, test_u[:, 1:].reshape(-1, 2, 1), mu_preds, R_preds, dt, samples=20,
+                      generator=torch.Generator().manual_seed(0))
+
+fig = plt.figure(figsize=(10, 4))
+ax = fig.subplots(1, 1)
+ax.plot(test_t[:20000], x_samples[:20000, :, 0], linewidth=1, color="grey", alpha=0.5)
+ax.plot(test_t[:20000], test_u[:20000, 0], linewidth=3, label=r"\textbf{True System}")
+ax.set_ylabel(r"$x$", fontsize=30, rotation=0)
+ax.set_title(r"\textbf{Posterior Samples}", fontsize=30)
+for ax in fig.get_axes():
+    ax.tick_params(labelsize=25, length=7, width=2)
+    for spine in ax.spines.values():
+        spine.set_linewidth(2)
+fig.tight_layout()
+plt.show()
+
 
 
 
@@ -8,6 +8,10 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.forecast import forecast_windows
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -71,7 +75,7 @@ class RegModel(nn.Module):
         self.out = torch.cat([x_dyn, y_dyn, z_dyn], dim=1)
         return self.out
 
-def ODESolver(model, u0, steps, dt):
+def ODESolver(model, u0, steps, dt, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     u_pred = torch.zeros(steps, dim)
@@ -79,6 +83,8 @@ def ODESolver(model, u0, steps, dt):
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_pred[n].unsqueeze(0)).squeeze(0)
         u_pred[n+1] = u_pred[n]+u_dot_pred*dt
+        if guard is not None and not guard.check(n+1, u_pred[n+1]):
+            return u_pred[:n+2]
     return u_pred
 
 
@@ -124,9 +130,7 @@ with torch.no_grad():
     train_u_dot_pred = regmodel(None, train_u[:-1])
 sigma_hat = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred)**2, dim=0 ) ).tolist()
 
-def CGFilter(regmodel, u1, mu0, R0, cut_point, sigma_lst):
-    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
+def cg_coef(regmodel, sigma_lst):
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a0 = regmodel.reg0.bias[:]
@@ -138,35 +142,27 @@ def CGFilter(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     c1 = regmodel.reg2.weight[:, 0]
     c2 = regmodel.reg2.weight[:, 1]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        y0 = u1[n-1, 0].flatten()
-        z0 = u1[n, 1].flatten()
-        du1 = u1[n] - u1[n-1]
-
-        f1 = torch.cat([b0+b1*y0, c0+c1*z0]).reshape(-1, 1)
-        g1 = torch.cat([torch.zeros(1), c2*z0]).reshape(-1, 1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        y0 = u1[:-1, 0]
+        z0 = u1[1:, 1]
+
+        f1 = torch.cat([b0+b1*y0, c0+c1*z0], dim=1).unsqueeze(2)
+        g1 = torch.cat([torch.zeros_like(z0), c2*z0], dim=1).unsqueeze(2)
         s1 = torch.diag(torch.tensor([sigma_y, sigma_z]))
-        f2 = (a0+a2*z0**2).reshape(1,1)
-        g2 = (a1).reshape(1,1)
+        f2 = (a0+a2*z0**2).unsqueeze(2)
+        g2 = a1.reshape(1, 1)
         s2 = torch.tensor([[sigma_x]])
+        return (f1, g1, s1, f2, g2, s2)
+
+    return coef
+
+
+def CGFilter(regmodel, u1, mu0, R0, cut_point, sigma_lst):
+    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
+    return cgf.CGFilter(cg_coef(regmodel, sigma_lst), u1, mu0, R0, cut_point, dt)
 
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
-
-def SDESolver(model, u0, steps, dt, sigma_lst):
+def SDESolver(model, u0, steps, dt, sigma_lst, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     sigma = torch.tensor(sigma_lst)
@@ -175,13 +171,10 @@ def SDESolver(model, u0, steps, dt, sigma_lst):
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_simu[n].unsqueeze(0)).squeeze(0)
         u_simu[n+1] = u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(3)
+        if guard is not None and not guard.check(n+1, u_simu[n+1]):
+            return u_simu[:n+2]
     return u_simu
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 #################################################
 ################# Test RegModel #################
@@ -190,21 +183,10 @@ def avg_neg_log_likehood(x, mu, R):
 # Short-term Prediction
 def integrate_batch(t, u, model, batch_steps):
     # u is in vector form, e.g. (t, x)
-    device = u.device
-    Nt = u.shape[0]
-    num_batchs = int(Nt / batch_steps)
-    error_abs = 0
-    # error_rel = 0
-    u_pred = torch.tensor([]).to(device)
-    for i in range(num_batchs):
-        u_batch = u[i*batch_steps: (i+1)*batch_steps]
-        with torch.no_grad():
-            u_batch_pred = torchdiffeq.odeint(model, u_batch[[0]], t[:batch_steps])[:,0,:]
-        u_pred = torch.cat([u_pred, u_batch_pred])
-        error_abs += torch.mean( (u_batch - u_batch_pred)**2 ).item()
-        # error_rel += torch.mean( torch.norm(stt_batch - stt_pred_batch, 2, 1) / (torch.norm(stt_batch, 2, 1)) ).item()
-    error_abs /= num_batchs
-    # error_rel /= num_batch
+    # Consecutive windows of batch_steps, all integrated in one batched odeint call (see forecast_windows for overlapping windows)
+    u_batch_pred, u_batch = forecast_windows(t, u, model, batch_steps)
+    error_abs = torch.mean( (u_batch - u_batch_pred)**2 ).item()
+    u_pred = u_batch_pred.reshape(-1, u.shape[1])
     return [u_pred, error_abs]
 u_shortPreds, error_abs = integrate_batch(test_t, test_u, regmodel, short_steps)
 
@@ -8,6 +8,9 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -69,50 +72,35 @@ dim_u2 = len(indices_u2)
 ########## CG-Filter ###########
 ################################
 u = test_u.numpy()
-Nt = u.shape[0]
 indices_u1 = np.array([i for i in range(36) if i % 3 != 2])
 indices_u2 = np.array([i for i in range(36) if i % 3 == 2])
 
 dim_u1 = len(indices_u1)
 dim_u2 = len(indices_u2)
-mu_trace = np.zeros((Nt, dim_u2, 1))
-R_trace = np.zeros((Nt, dim_u2, dim_u2))
-mu_trace[0] = np.zeros((dim_u2, 1))
-R_trace[0] = np.eye(dim_u2)*0.01
-mu0 = mu_trace[0]
-R0 = R_trace[0]
-
-for n in range(1, Nt):
-    du1 = (u[n, indices_u1] - u[n-1, indices_u1]).reshape(-1, 1)
-
-    f1 = F-u[n-1, indices_u1].reshape(-1, 1)
-    g1 = np.zeros((dim_u1, dim_u2))
-    for j in range(dim_u2):
-        g1[np.arange(2*j+1, 2*j+4)%dim_u1, j] = [u[n-1, 3*j], u[n-1, (3*j+4)%I]-u[n-1, 3*j+1], -u[n-1, (3*j+3)%I]]
-    s1 = np.diag([sigma]*dim_u1)
-    f2 = np.zeros((dim_u2, 1))
-    for i in range(dim_u2):
-        f2[i] = F + (u[n-1, (3*i+3)%I] - u[n-1, 3*i]) * u[n-1, 3*i+1]
-    g2 = np.diag([-1]*dim_u2)
-    s2 = np.diag([sigma]*dim_u2)
-    invs1os1 = np.linalg.inv(s1@s1.T)
-    s2os2 = s2@s2.T
-
-    mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-    R1 = R0 + ( g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-    mu_trace[n] = mu1
-    R_trace[n] = R1
-    mu0 = mu1
-    R0 = R1
+
+def coef_true(u1):
+    # Coefficients of the true model at all steps, stacked over time (t-1, ...)
+    N = u1.shape[0] - 1
+    u_prev = torch.zeros(N, I, dtype=torch.float64)
+    u_prev[:, indices_u1] = u1[:-1, :, 0]
+    jj = torch.arange(dim_u2)
+
+    f1 = F - u1[:-1]
+    g1 = torch.zeros(N, dim_u1, dim_u2, dtype=torch.float64)
+    g1[:, (2*jj.unsqueeze(1)+torch.arange(1, 4))%dim_u1, jj.unsqueeze(1).repeat(1, 3)] = \
+        torch.stack([u_prev[:, 3*jj], u_prev[:, (3*jj+4)%I]-u_prev[:, 3*jj+1], -u_prev[:, (3*jj+3)%I]], dim=2)
+    s1 = torch.diag(torch.tensor([sigma]*dim_u1, dtype=torch.float64))
+    f2 = (F + (u_prev[:, (3*jj+3)%I] - u_prev[:, 3*jj]) * u_prev[:, 3*jj+1]).unsqueeze(2)
+    g2 = -torch.eye(dim_u2, dtype=torch.float64)
+    s2 = torch.diag(torch.tensor([sigma]*dim_u2, dtype=torch.float64))
+    return (f1, g1, s1, f2, g2, s2)
+mu_trace, R_trace = cgf.CGFilter(coef_true, u1=torch.tensor(u[:, indices_u1], dtype=torch.float64).unsqueeze(2), mu0=torch.zeros((dim_u2, 1), dtype=torch.float64), R0=0.01*torch.eye(dim_u2, dtype=torch.float64), cut_point=0, dt=dt)
+mu_trace = mu_trace.numpy()
+R_trace = R_trace.numpy()
 
 np.mean( (u[:, indices_u2] - mu_trace.squeeze(2) )**2 )
 
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 avg_neg_log_likehood(torch.tensor(u[:,indices_u2].reshape(20000, 12 ,1)),
                      torch.tensor(mu_trace),
                      torch.tensor(R_trace))
@@ -200,7 +188,6 @@ class MixModel(nn.Module):
 
 def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_tsr = torch.tensor(sigma_lst)
 
     indices_u1 = np.array([i for i in range(36) if i % 3 != 2])
@@ -208,79 +195,51 @@ def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
 
     dim_u1 = len(indices_u1)
     dim_u2 = len(indices_u2)
-    dim_u = dim_u1 + dim_u2
 
     FF = regmodel.reg[0]
     c = regmodel.reg[1]
 
-    Nt = u1.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        du1 = u1[n] - u1[n-1]
-
-        f1 = c * u1[n-1] + FF
+    def coef(u1):
+        # Only f1 depends on u1; the remaining coefficients are shared by all steps
+        f1 = c * u1[:-1] + FF
         g1 = torch.zeros(dim_u1, dim_u2)
         s1 = torch.diag(sigma_tsr[indices_u1])
         f2 = FF.repeat(dim_u2).reshape(-1, 1)
         g2 = torch.diag(c.repeat(dim_u2))
         s2 = torch.diag(sigma_tsr[indices_u2])
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2.T
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+        return (f1, g1, s1, f2, g2, s2)
+
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 
 def CGFilter_MixModel(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_tsr = torch.tensor(sigma_lst)
 
     indices_u1 = np.array([i for i in range(36) if i % 3 != 2])
     indices_u2 = np.array([i for i in range(36) if i % 3 == 2])
     dim_u1 = len(indices_u1)
     dim_u2 = len(indices_u2)
-    dim_u = dim_u1 + dim_u2
 
     FF = mixmodel.reg[0]
     c = mixmodel.reg[1]
 
-    Nt = u1.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        du1 = u1[n] - u1[n-1]
-        outnet = mixmodel.net(u1[n-1].T) # A tuple with outputs of 3 NNs
-        outnet1 = outnet[0].squeeze(0)
-        outnet2 = outnet[1].squeeze(0)
-        outnet3 = outnet[2].squeeze(0)
-
-        f1 = c*u1[n-1] + FF + torch.stack([outnet1[:,[0]], outnet2[:, [0]]]).permute(1, 0, 2).reshape(-1, 1)
-        g1 = torch.zeros(dim_u1, dim_u2)
-        g1[torch.arange(24).unsqueeze(dim=1), torch.stack([torch.arange(12)-1, torch.arange(12)]).T.repeat_interleave(2, dim=0)] = \
-            torch.stack([outnet1[:,1:], outnet2[:, 1:]]).permute(1, 0, 2).reshape(-1, 2)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        outnet = mixmodel.net(u1[:-1, :, 0]) # A tuple with outputs of 3 NNs
+        outnet1, outnet2, outnet3 = outnet
+
+        f1 = c*u1[:-1] + FF + torch.stack([outnet1[:, :, [0]], outnet2[:, :, [0]]], dim=2).reshape(N, -1, 1)
+        g1 = torch.zeros(N, dim_u1, dim_u2)
+        g1[:, torch.arange(24).unsqueeze(dim=1), torch.stack([torch.arange(12)-1, torch.arange(12)]).T.repeat_interleave(2, dim=0)] = \
+            torch.stack([outnet1[:, :, 1:], outnet2[:, :, 1:]], dim=2).reshape(N, -1, 2)
         s1 = torch.diag(sigma_tsr[indices_u1])
-        f2 = FF + outnet3[:, [0]]
-        g2 = torch.diag(c + outnet3[:, 1])
+        f2 = FF + outnet3[:, :, [0]]
+        g2 = torch.diag_embed(c + outnet3[:, :, 1])
         s2 = torch.diag(sigma_tsr[indices_u2])
+        return (f1, g1, s1, f2, g2, s2)
 
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2.T
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 
 
 model1 = RegModel()
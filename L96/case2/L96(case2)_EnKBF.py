@@ -8,6 +8,10 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.enkbf import L96Tendency, StreamingEnKBF, enkbf_repeats, model_tendency, split_tendency
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -70,20 +74,8 @@ dim_u = dim_u1 + dim_u2
 ################# EnKBF  #################
 ##########################################
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 u = test_u.numpy()
-def cross_cov(X, Y):
-    n = X.shape[0]
-    assert n == Y.shape[0]
-    X_centered = X - np.mean(X, axis=0)
-    Y_centered = Y - np.mean(Y, axis=0)
-    cross_cov_matrix = np.dot(X_centered.T, Y_centered) / (n - 1)
-    return cross_cov_matrix
 
 u1 = u[:, indices_u1]
 SIG1 = np.diag([sigma**2]*dim_u1)
@@ -93,40 +85,11 @@ sig2 = np.diag([sigma]*dim_u2)
 
 J = 100
 p = dim_u2
-u2_ens = np.zeros((J, Ntest, p))
-err_lst = []
-nll_lst = []
-for _ in range(100):
-    for n in range(1, Ntest):
-        u1_repeat = np.tile(u1[n-1], (J, 1))
-        u_ens = np.stack([u1_repeat, u2_ens[:, n-1]]).transpose(1,2,0).reshape(-1, 36)
-        u_dot_ens = np.zeros_like(u_ens)
-        for i in range(I):
-            u_dot_ens[:, i] = -u_ens[:, i] + u_ens[:,(i+1)%I]*u_ens[:,i-1] - u_ens[:,i-2]*u_ens[:,i-1] + F
-        g = u_dot_ens[:, ::2]
-        f = u_dot_ens[:, 1::2]
-
-        g_bar = np.mean(g, axis=0)
-        CCOV = cross_cov(u2_ens[:, n-1], g)
-        Sys_term = f*dt + np.random.randn(J,p) @ sig2 * np.sqrt(dt)
-        DA_term = -0.5*((g+g_bar)*dt-2*(u1[n]-u1[n-1])) @ (CCOV@np.linalg.inv(SIG1)).T
-
-        u2_ens[:, n, :] = u2_ens[:, n-1, :] + Sys_term + DA_term
-
-    mu_trace = np.mean(u2_ens, axis=0).reshape(u2_ens.shape[1], u2_ens.shape[2], 1)
-    R_trace = np.zeros((u2_ens.shape[1], u2_ens.shape[2], u2_ens.shape[2]))
-    for i in range(u2_ens.shape[1]):
-        R_trace[i] = np.cov(u2_ens[:, i, :].T)
-
-    nll = avg_neg_log_likehood(torch.tensor(u[:,indices_u2].reshape(20000, 18 ,1)[1:]),
-                               torch.tensor(mu_trace)[1:],
-                               torch.tensor(R_trace)[1:]).item()
-
-    err = np.mean( (u[:, indices_u2] - mu_trace.squeeze(2) )**2 )
-
-    err_lst.append(err)
-    nll_lst.append(nll)
-    print(_, err, nll)
+tendency = L96Tendency(F, indices_u1, indices_u2)
+# 100 independent repeats, one noise stream per repeat, in chunks advanced together on all CPU cores
+stats = enkbf_repeats(tendency, u1, u[:, indices_u2], J, 100, dt, sig1, sig2, seed=0, processes=None)
+err_lst = stats["mse"]
+nll_lst = stats["nll"]
 
 
 np.mean(err_lst)
@@ -139,33 +102,15 @@ np.mean(nll_lst)
 torch.manual_seed(0)
 np.random.seed(0)
 
-for n in range(1, Ntest):
-    u1_repeat = np.tile(u1[n-1], (J, 1))
-    u_ens = np.stack([u1_repeat, u2_ens[:, n-1]]).transpose(1,2,0).reshape(-1, 36)
-    u_dot_ens = np.zeros_like(u_ens)
-    for i in range(I):
-        u_dot_ens[:, i] = -u_ens[:, i] + u_ens[:,(i+1)%I]*u_ens[:,i-1] - u_ens[:,i-2]*u_ens[:,i-1] + F
-    g = u_dot_ens[:, ::2]
-    f = u_dot_ens[:, 1::2]
-
-    g_bar = np.mean(g, axis=0)
-    CCOV = cross_cov(u2_ens[:, n-1], g)
-    Sys_term = f*dt + np.random.randn(J,p) @ sig2 * np.sqrt(dt)
-    DA_term = -0.5*((g+g_bar)*dt-2*(u1[n]-u1[n-1])) @ (CCOV@np.linalg.inv(SIG1)).T
-
-    u2_ens[:, n, :] = u2_ens[:, n-1, :] + Sys_term + DA_term
-
-
+# Only the current ensemble is kept; NLL and the posterior mean/variance traces are accumulated on the fly
+nll_reducer = cgf.RunningNLL()
+trace_writer = cgf.TraceWriter(diagonal=True)
+enkbf = StreamingEnKBF(tendency, np.zeros((J, p)), dt, sig1, sig2, cut_point=1, reducers=[nll_reducer, trace_writer])
+enkbf.run(u1, u[:, indices_u2])
+_, mu_trace, R_trace = trace_writer.result()  # steps 1, ..., Ntest-1; R_trace holds the variances
 
-mu_trace = np.mean(u2_ens, axis=0).reshape(u2_ens.shape[1], u2_ens.shape[2], 1)
-R_trace = np.zeros((u2_ens.shape[1], u2_ens.shape[2], u2_ens.shape[2]))
-for i in range(u2_ens.shape[1]):
-    R_trace[i] = np.cov(u2_ens[:, i, :].T)
 
-
-avg_neg_log_likehood(torch.tensor(u[:,indices_u2].reshape(20000, 18 ,1)[1:]),
-                     torch.tensor(mu_trace)[1:],
-                     torch.tensor(R_trace)[1:])
+nll_reducer.result()
 
 
 
@@ -260,93 +205,70 @@ class MixModel(nn.Module):
 
 def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_tsr = torch.tensor(sigma_lst)
 
     indices_u1 = np.arange(0, 36, 2)
     indices_u2 = np.arange(1, 36, 2)
     dim_u1 = len(indices_u1)
     dim_u2 = len(indices_u2)
-    dim_u = dim_u1 + dim_u2
 
     a = regmodel.reg1
     b = regmodel.reg2
 
-    Nt = u1.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        du1 = u1[n] - u1[n-1]
-        f1 = a[0] + a[1]*u1[n-1]
-        g1 = torch.zeros(dim_u1, dim_u2)
-        g1[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
-            torch.cat([ a[3]*u1[n-1][torch.arange(-1, 17)]+a[4]*u1[n-1][torch.arange(1,19)%dim_u1],
-                        a[2]+a[5]*u1[n-1] ], dim=1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        v = u1[:-1]
+        f1 = a[0] + a[1]*v
+        g1 = torch.zeros(N, dim_u1, dim_u2)
+        g1[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
+            torch.cat([ a[3]*v[:, torch.arange(-1, 17)]+a[4]*v[:, torch.arange(1,19)%dim_u1],
+                        a[2]+a[5]*v ], dim=2)
         s1 = torch.diag(sigma_tsr[indices_u1])
-        f2 = b[0] + b[3]*u1[n-1]*u1[n-1][torch.arange(1, 19)%dim_u1]
-        g2 = torch.zeros(dim_u2, dim_u2)
-        g2[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18)]).T] = \
-            torch.cat([ b[2]*u1[n-1],
-                        b[1].repeat(dim_u2).reshape(-1,1) ], dim=1)
+        f2 = b[0] + b[3]*v*v[:, torch.arange(1, 19)%dim_u1]
+        g2 = torch.zeros(N, dim_u2, dim_u2)
+        g2[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18)]).T] = \
+            torch.cat([ b[2]*v,
+                        b[1].expand(N, dim_u2, 1) ], dim=2)
         s2 = torch.diag(sigma_tsr[indices_u2])
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2.T
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+        return (f1, g1, s1, f2, g2, s2)
+
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 def CGFilter_MixModel(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_tsr = torch.tensor(sigma_lst)
 
     indices_u1 = np.arange(0, 36, 2)
     indices_u2 = np.arange(1, 36, 2)
     dim_u1 = len(indices_u1)
     dim_u2 = len(indices_u2)
-    dim_u = dim_u1 + dim_u2
 
     a = mixmodel.reg1
     b = mixmodel.reg2
 
-    Nt = u1.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        du1 = u1[n] - u1[n-1]
-        outnet = mixmodel.net(u1[n-1].T) # A tuple with outputs of 2 NNs
-        outnet1 = outnet[0].squeeze(0)  # (18, 3)
-        outnet2 = outnet[1].squeeze(0)  # (18, 4)
-
-        f1 = a[0] + a[1]*u1[n-1] + outnet1[:,[0]]
-        g1 = torch.zeros(dim_u1, dim_u2)
-        g1[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
-            torch.cat([ a[3]*u1[n-1][torch.arange(-1, 17)]+a[4]*u1[n-1][torch.arange(1,19)%dim_u1]+outnet1[:,[1]],
-                        a[2]+a[5]*u1[n-1]+outnet1[:,[2]] ], dim=1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        v = u1[:-1]
+        outnet = mixmodel.net(v[:, :, 0]) # A tuple with outputs of 2 NNs
+        outnet1, outnet2 = outnet  # (t-1, 18, 3), (t-1, 18, 4)
+
+        f1 = a[0] + a[1]*v + outnet1[:, :, [0]]
+        g1 = torch.zeros(N, dim_u1, dim_u2)
+        g1[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
+            torch.cat([ a[3]*v[:, torch.arange(-1, 17)]+a[4]*v[:, torch.arange(1,19)%dim_u1]+outnet1[:, :, [1]],
+                          a[2]+a[5]*v+outnet1[:, :, [2]] ], dim=2)
         s1 = torch.diag(sigma_tsr[indices_u1])
-        f2 = b[0] + outnet2[:, [0]] + b[3]*u1[n-1]*u1[n-1][torch.arange(1, 19)%dim_u1]
-        g2 = torch.zeros(dim_u2, dim_u2)
-        g2[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18), torch.arange(1, 19)%18]).T] = \
-            torch.cat([ b[2]*u1[n-1]+outnet2[:,[1]],
-                        b[1]+outnet2[:, [2]],
-                        outnet2[:, [3]] ], dim=1)
+        f2 = b[0] + outnet2[:, :, [0]] + b[3]*v*v[:, torch.arange(1, 19)%dim_u1]
+        g2 = torch.zeros(N, dim_u2, dim_u2)
+        g2[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18), torch.arange(1, 19)%18]).T] = \
+            torch.cat([ b[2]*v+outnet2[:, :, [1]],
+                        b[1]+outnet2[:, :, [2]],
+                        outnet2[:, :, [3]] ], dim=2)
         s2 = torch.diag(sigma_tsr[indices_u2])
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2.T
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+        return (f1, g1, s1, f2, g2, s2)
+
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 
 
 model1 = RegModel()
@@ -364,10 +286,12 @@ with torch.no_grad():
 sigma_hat1 = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred1)**2, dim=0 ) ).tolist()
 sigma_hat2 = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred2)**2, dim=0 ) ).tolist()
 
+start = time.time()
 with torch.no_grad():
     mu_preds1, R_preds1 = CGFilter_RegModel(model1, u1=test_u[:, indices_u1].unsqueeze(2), mu0=torch.zeros(dim_u2, 1).to(device), R0=0.01*torch.eye(dim_u2).to(device), cut_point=0, sigma_lst=sigma_hat1)
     mu_preds2, R_preds2 = CGFilter_MixModel(model2, u1=test_u[:, indices_u1].unsqueeze(2), mu0=torch.zeros(dim_u2, 1).to(device), R0=0.01*torch.eye(dim_u2).to(device), cut_point=0, sigma_lst=sigma_hat2)
     mu_preds3, R_preds3 = CGFilter_MixModel(model3, u1=test_u[:, indices_u1].unsqueeze(2), mu0=torch.zeros(dim_u2, 1).to(device), R0=0.01*torch.eye(dim_u2).to(device), cut_point=0, sigma_lst=sigma_hat2)
+print("CGFilter time per model:", (time.time()-start)/3)
 
 nnF.mse_loss(test_u[:,indices_u2], mu_preds1.squeeze(2))
 nnF.mse_loss(test_u[:,indices_u2], mu_preds2.squeeze(2))
@@ -377,6 +301,15 @@ avg_neg_log_likehood(test_u[:,indices_u2].unsqueeze(2), mu_preds2, R_preds2)
 avg_neg_log_likehood(test_u[:,indices_u2].unsqueeze(2), mu_preds3, R_preds3)
 
 
+# EnKBF for models: same learned drift and noise as the CGFilter above, all members in one forward call per step
+for model, sigma_hat in [(model1, sigma_hat1), (model2, sigma_hat2), (model3, sigma_hat2)]:
+    sigma_hat = np.array(sigma_hat)
+    model_tend = split_tendency(model_tendency(model), indices_u1, indices_u2)
+    start = time.time()
+    stats = enkbf_repeats(model_tend, u1, u[:, indices_u2], J, 10, dt, np.diag(sigma_hat[indices_u1]), np.diag(sigma_hat[indices_u2]), seed=0)
+    print(np.mean(stats["mse"]), np.mean(stats["nll"]), "time per run:", (time.time()-start)/10)
+
+
 # Visualizaton
 plt.rcParams["text.latex.preamble"] = r"\usepackage{amsmath}"
 
@@ -393,11 +326,11 @@ axs[1,0].set_ylabel(r"$x_2$", fontsize=35, rotation=0)
 axs[1,0].set_xlabel(r"$t$", fontsize=35)
 axs[1,1].set_xlabel(r"$t$", fontsize=35)
 axs[0,0].plot(test_t, test_u[:, 1], linewidth=3.5, color="blue", label="True signal")
-axs[0,0].plot(test_t, mu_trace[:,0,0],  linewidth=2.5, color="red", label="Posterior mean")
+axs[0,0].plot(test_t[1:], mu_trace[:,0,0],  linewidth=2.5, color="red", label="Posterior mean")
 axs[0,1].plot(test_t, mu_preds1[:,0,0], linewidth=2.5, color="red")
 axs[1,0].plot(test_t, mu_preds2[:,0,0], linewidth=2.5, color="red")
 axs[1,1].plot(test_t, mu_preds3[:,0,0], linewidth=2.5, color="red")
-axs[0,0].fill_between(test_t, mu_trace[:, 0, 0]-2*np.sqrt(R_trace[:, 0, 0]), mu_trace[:, 0, 0]+2*np.sqrt(R_trace[:, 0, 0]), color='grey', alpha=0.8, label=r"Uncertainty")
+axs[0,0].fill_between(test_t[1:], mu_trace[:, 0, 0]-2*np.sqrt(R_trace[:, 0]), mu_trace[:, 0, 0]+2*np.sqrt(R_trace[:, 0]), color='grey', alpha=0.8, label=r"Uncertainty")
 axs[0,1].fill_between(test_t, mu_preds1[:, 0, 0]-2*torch.sqrt(R_preds1[:, 0, 0]), mu_preds1[:, 0, 0]+2*torch.sqrt(R_preds1[:, 0, 0]), color='grey', alpha=0.8)
 axs[1,0].fill_between(test_t, mu_preds2[:, 0, 0]-2*torch.sqrt(R_preds2[:, 0, 0]), mu_preds2[:, 0, 0]+2*torch.sqrt(R_preds2[:, 0, 0]), color='grey', alpha=0.8)
 axs[1,1].fill_between(test_t, mu_preds3[:, 0, 0]-2*torch.sqrt(R_preds3[:, 0, 0]), mu_preds3[:, 0, 0]+2*torch.sqrt(R_preds3[:, 0, 0]), color='grey', alpha=0.8)
@@ -0,0 +1,127 @@
+import numpy as np
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import seaborn as sns
+import torch
+import torch.nn as nn
+import torch.nn.functional as nnF
+import torchdiffeq
+import time
+
+from cgnsde.enkbf import L96Tendency, enkbf_repeats, ring_localization
+
+device = "cpu"
+torch.manual_seed(0)
+np.random.seed(0)
+
+mpl.use("Qt5Agg")
+plt.rcParams["agg.path.chunksize"] = 10000
+plt.rc("text", usetex=True)
+plt.rcParams["font.family"] = "Times New Roman"
+plt.rcParams["text.latex.preamble"] = r"\usepackage{amsmath} \boldmath"
+
+######################################
+########## Data Generation ###########
+######################################
+F = 8
+sigma = 0.5
+
+I = 36
+Lt = 300
+dt = 0.001
+Nt = int(Lt/dt) + 1
+t = np.linspace(0, Lt, Nt)
+u = np.zeros((Nt, I))
+
+for n in range(Nt-1):
+    for i in range(I):
+        u_dot = -u[n, i] + u[n,(i+1)%I]*u[n,i-1] - u[n,i-2]*u[n,i-1] + F
+        u[n+1, i] = u[n, i] + u_dot*dt + sigma*np.sqrt(dt)*np.random.randn()
+
+
+# Sub-sampling
+u = u[::10]
+dt = 0.01
+Nt = int(Lt/dt) + 1
+t = np.linspace(0, Lt, Nt)
+u_dot = np.diff(u, axis=0)/dt
+
+# Split data in to train and test
+u_dot = torch.tensor(u_dot, dtype=torch.float32)
+u = torch.tensor(u[:-1], dtype=torch.float32)
+t = torch.tensor(t[:-1], dtype=torch.float32)
+
+Ntrain = 10000
+Ntest = 20000
+train_u = u[:Ntrain]
+train_u_dot = u_dot[:Ntrain]
+train_t = t[:Ntrain]
+test_u = u[-Ntest:]
+test_u_dot = u_dot[-Ntest:]
+test_t = t[-Ntest:]
+
+# Indices of u1 and u2
+indices_u1 = np.arange(0, 36, 2)
+indices_u2 = np.arange(1, 36, 2)
+dim_u1 = len(indices_u1)
+dim_u2 = len(indices_u2)
+dim_u = dim_u1 + dim_u2
+
+
+##############################################################
+################# Localized EnKBF vs. Ensemble Size  #########
+##############################################################
+# Skill and cost of the EnKBF for the true system as functions of the ensemble size J, without and with Gaspari-Cohn
+# localization of the cross-covariance on the ring (half-width of 4 sites) and multiplicative inflation.
+# The NLL needs J > dim_u2 (full-rank sample covariance); it is only reported and plotted for these ensembles (NaN
+# otherwise), next to the MSE, which is meaningful for all J.
+
+u = test_u.numpy()
+u1 = u[:, indices_u1]
+u2 = u[:, indices_u2]
+sig1 = np.diag([sigma]*dim_u1)
+sig2 = np.diag([sigma]*dim_u2)
+
+tendency = L96Tendency(F, indices_u1, indices_u2)
+configs = {"Baseline": {},
+           "Localization + inflation": {"localization": ring_localization(indices_u2, indices_u1, I, radius=4),
+                                        "inflation": 5.}}
+
+J_lst = [10, 20, 30, 50, 100]
+repeats = 10
+mse_dict = {name: [] for name in configs}
+nll_dict = {name: [] for name in configs}
+time_dict = {name: [] for name in configs}
+for J in J_lst:
+    for name, kwargs in configs.items():
+        start = time.time()
+        stats = enkbf_repeats(tendency, u1, u2, J, repeats, dt, sig1, sig2, seed=0, processes=None, **kwargs)
+        time_dict[name].append((time.time()-start)/repeats)
+        mse_dict[name].append(np.mean(stats["mse"]))
+        # Rank-deficient sample covariances for J <= dim_u2: the NLL is NaN or meaningless and is not reported
+        nll_dict[name].append(np.mean(stats["nll"]) if J > dim_u2 else np.nan)
+        print(name, J, mse_dict[name][-1], nll_dict[name][-1], time_dict[name][-1])
+
+
+# Visualizaton
+full_rank = [k for k, J in enumerate(J_lst) if J > dim_u2]
+fig = plt.figure(figsize=(30, 7))
+axs = fig.subplots(1, 3)
+for name, color in zip(configs, ["blue", "red"]):
+    axs[0].plot(J_lst, mse_dict[name], linewidth=3.5, marker="o", markersize=12, color=color, label=name)
+    axs[1].plot([J_lst[k] for k in full_rank], [nll_dict[name][k] for k in full_rank], linewidth=3.5, marker="o",
+                markersize=12, color=color)
+    axs[2].plot(J_lst, time_dict[name], linewidth=3.5, marker="o", markersize=12, color=color)
+axs[0].set_ylabel(r"MSE", fontsize=35)
+axs[1].set_ylabel(r"NLL ($J > %d$)" % dim_u2, fontsize=35)
+axs[2].set_ylabel(r"Wall time per run (s)", fontsize=35)
+for ax in axs:
+    ax.set_xlabel(r"$J$", fontsize=35)
+    ax.tick_params(labelsize=30, length=8, width=1, direction="in")
+    for spine in ax.spines.values():
+        spine.set_linewidth(1)
+lege = fig.legend(fontsize=30, loc="upper center", ncol=2, fancybox=False, edgecolor="black", bbox_to_anchor=(0.5, 1))
+lege.get_frame().set_linewidth(1)
+fig.tight_layout()
+fig.subplots_adjust(top=0.82)
+plt.show()
@@ -8,6 +8,10 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.forecast import forecast_windows
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -88,7 +92,7 @@ class RegModel(nn.Module):
         out[:, indices_u2] = torch.einsum("nij,j->ni", x2, self.reg2[1:]) + self.reg2[0]
         return out
 
-def ODESolver(model, u0, steps, dt):
+def ODESolver(model, u0, steps, dt, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     u_pred = torch.zeros(steps, dim)
@@ -96,6 +100,8 @@ def ODESolver(model, u0, steps, dt):
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_pred[n].unsqueeze(0)).squeeze(0)
         u_pred[n+1] = u_pred[n]+u_dot_pred*dt
+        if guard is not None and not guard.check(n+1, u_pred[n+1]):
+            return u_pred[:n+2]
     return u_pred
 
 
@@ -173,51 +179,44 @@ sigma_hat = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred)**2, dim=
 # R0 = 0.01*torch.eye(dim_u2)
 # cut_point = 0
 # sigma_lst = sigma_hat
-def CGFilter(regmodel, u1, mu0, R0, cut_point, sigma_lst):
-    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
+def cg_coef(regmodel, sigma_lst):
     sigma_tsr = torch.tensor(sigma_lst)
 
     indices_u1 = np.arange(0, 36, 2)
     indices_u2 = np.arange(1, 36, 2)
     dim_u1 = len(indices_u1)
     dim_u2 = len(indices_u2)
-    dim_u = dim_u1 + dim_u2
 
     a = regmodel.reg1
     b = regmodel.reg2
 
-    Nt = u1.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        du1 = u1[n] - u1[n-1]
-        f1 = a[0] + a[1]*u1[n-1]
-        g1 = torch.zeros(dim_u1, dim_u2)
-        g1[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
-            torch.cat([ a[3]*u1[n-1][torch.arange(-1, 17)]+a[4]*u1[n-1][torch.arange(1,19)%dim_u1],
-                        a[2]+a[5]*u1[n-1] ], dim=1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        v = u1[:-1]
+        f1 = a[0] + a[1]*v
+        g1 = torch.zeros(N, dim_u1, dim_u2)
+        g1[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
+            torch.cat([ a[3]*v[:, torch.arange(-1, 17)]+a[4]*v[:, torch.arange(1,19)%dim_u1],
+                        a[2]+a[5]*v ], dim=2)
         s1 = torch.diag(sigma_tsr[indices_u1])
-        f2 = b[0] + b[3]*u1[n-1]*u1[n-1][torch.arange(1, 19)%dim_u1]
-        g2 = torch.zeros(dim_u2, dim_u2)
-        g2[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18)]).T] = \
-            torch.cat([ b[2]*u1[n-1],
-                        b[1].repeat(dim_u2).reshape(-1,1) ], dim=1)
+        f2 = b[0] + b[3]*v*v[:, torch.arange(1, 19)%dim_u1]
+        g2 = torch.zeros(N, dim_u2, dim_u2)
+        g2[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18)]).T] = \
+            torch.cat([ b[2]*v,
+                        b[1].expand(N, dim_u2, 1) ], dim=2)
         s2 = torch.diag(sigma_tsr[indices_u2])
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2.T
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
-
-
-def SDESolver(model, u0, steps, dt, sigma_lst):
+        return (f1, g1, s1, f2, g2, s2)
+
+    return coef
+
+
+def CGFilter(regmodel, u1, mu0, R0, cut_point, sigma_lst):
+    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
+    return cgf.CGFilter(cg_coef(regmodel, sigma_lst), u1, mu0, R0, cut_point, dt)
+
+
+def SDESolver(model, u0, steps, dt, sigma_lst, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     sigma = torch.tensor(sigma_lst)
@@ -225,36 +224,25 @@ def SDESolver(model, u0, steps, dt, sigma_lst):
     u_simu[0] = u0
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_simu[n].unsqueeze(0)).squeeze(0)
-        u_simu[n+1] = torch.clamp(u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(dim), min=torch.min(train_u), max=torch.max(train_u))
+        u_simu[n+1] = u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(dim)
+        if guard is None:
+            # Without a guard the state is kept in the range of the training data; with one, leaving it is a blow-up
+            u_simu[n+1] = torch.clamp(u_simu[n+1], min=torch.min(train_u), max=torch.max(train_u))
+        elif not guard.check(n+1, u_simu[n+1]):
+            return u_simu[:n+2]
     return u_simu
 
 #################################################
 ################# Test RegModel #################
 #################################################
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 # Short-term Prediction
 def integrate_batch(t, u, model, batch_steps):
     # u is in vector form, e.g. (t, x)
-    device = u.device
-    Nt = u.shape[0]
-    num_batchs = int(Nt / batch_steps)
-    error_abs = 0
-    # error_rel = 0
-    u_pred = torch.tensor([]).to(device)
-    for i in range(num_batchs):
-        u_batch = u[i*batch_steps: (i+1)*batch_steps]
-        with torch.no_grad():
-            u_batch_pred = torchdiffeq.odeint(model, u_batch[[0]], t[:batch_steps])[:,0,:]
-        u_pred = torch.cat([u_pred, u_batch_pred])
-        error_abs += torch.mean( (u_batch - u_batch_pred)**2 ).item()
-        # error_rel += torch.mean( torch.norm(stt_batch - stt_pred_batch, 2, 1) / (torch.norm(stt_batch, 2, 1)) ).item()
-    error_abs /= num_batchs
-    # error_rel /= num_batch
+    # Consecutive windows of batch_steps, all integrated in one batched odeint call (see forecast_windows for overlapping windows)
+    u_batch_pred, u_batch = forecast_windows(t, u, model, batch_steps)
+    error_abs = torch.mean( (u_batch - u_batch_pred)**2 ).item()
+    u_pred = u_batch_pred.reshape(-1, u.shape[1])
     return [u_pred, error_abs]
 u_shortPreds, error_abs = integrate_batch(test_t, test_u, regmodel, batch_steps=20)
 
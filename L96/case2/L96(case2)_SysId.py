@@ -8,6 +8,8 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde.sysid import PolyLibrary, cem_from_cov, library_cov
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -71,53 +73,20 @@ dim_u2 = len(indices_u2)
 u = train_u.numpy()
 u_dot = train_u_dot.numpy()
 
-def cem(A, B):
-    """
-    :param A: numpy.array(Nt, Na); Basis Functions
-    :param B: numpy.array(Nt, Nb); Dynamics
-    :return: numpy.array(Nb, Na); Causation Entropy Matrix C(X->Y|Z)
-    """
-    Na = A.shape[1]
-    Nb = B.shape[1]
-    CEM = np.zeros((Nb, Na))
-    for i in range(Nb):
-        XYZ = np.concatenate([A, B[:, [i]]], axis=1)
-        RXYZ = np.cov(XYZ.T)
-        RXYZ_det = np.linalg.det(RXYZ)
-        RXZ = RXYZ[:-1, :-1]
-        RXZ_det = np.linalg.det(RXZ)
-        for j in range(Na):
-            RYZ = np.delete(np.delete(RXYZ, j, axis=0), j, axis=1)
-            RYZ_det = np.linalg.det(RYZ)
-            RZ = RYZ[:-1, :-1]
-            RZ_det = np.linalg.det(RZ)
-            CEM[i, j] = 1/2 * np.log(RYZ_det) - 1/2*np.log(RZ_det) - 1/2*np.log(RXYZ_det) + 1/2*np.log(RXZ_det)
-    return CEM
-
-def basisCG1(x):
-    # x: shape(N, x)
-    out = np.stack([x[:, 0], x[:, 1], x[:, 2], x[:, 3], x[:, 4],
-                    x[:, 0]**2, x[:, 2]**2, x[:, 4]**2,
-                    x[:,0]*x[:,1], x[:,0]*x[:,2], x[:,0]*x[:,3], x[:,0]*x[:,4],
-                    x[:,1]*x[:,2], x[:,1]*x[:,4],
-                    x[:,2]*x[:,3], x[:,2]*x[:,4],
-                    x[:,3]*x[:,4]]).T
-    return out
-def basisCG2(x):
-    out = np.stack([x[:, 0], x[:, 1], x[:, 2], x[:, 3], x[:, 4],
-                    x[:, 1]**2, x[:, 3]**2,
-                    x[:,0]*x[:,1], x[:,0]*x[:,3],
-                    x[:,1]*x[:,2], x[:,1]*x[:,3], x[:,1]*x[:,4],
-                    x[:,2]*x[:,3],
-                    x[:,3]*x[:,4]]).T
-    return out
-
-LibCG1 = np.concatenate([basisCG1( u[:, [i-2, i-1, i, i+1, (i+2)%I]] ) for i in indices_u1], axis=0)
-u_dot1_stacked = u_dot[:, indices_u1].T.reshape(-1, 1)
-np.where( ( cem(LibCG1, u_dot1_stacked)*1e7 > 1e5).flatten() )
-
-
-LibCG2 = np.concatenate([basisCG2( u[:, [i-2, i-1, i, (i+1)%I, (i+2)%I]] ) for i in indices_u2], axis=0)
-u_dot2_stacked = u_dot[:, indices_u2].T.reshape(-1, 1)
-np.where( (cem(LibCG2, u_dot2_stacked)*1e7 > 1e5).flatten() )
+# CG libraries: monomials up to degree 2 of the 5-point stencil, at most linear in the hidden neighbours (u2).
+# The terms of the u1 sites are [u_{i-2}, ..., u_{i+2}, u_{i-2}^2, u_{i}^2, u_{i+2}^2, u_{i-2}*u_{i-1}, ...], see .names
+libCG1 = PolyLibrary([-2, -1, 0, 1, 2], hidden=[-1, 1], degree=2, size=I)
+libCG2 = PolyLibrary([-2, -1, 0, 1, 2], hidden=[-2, 0, 2], degree=2, size=I)
+
+# Joint covariance of the library and the target accumulated over time chunks of all sites (no stacked library)
+R1 = library_cov(libCG1, u, u_dot, indices_u1, processes=None)
+CEM1 = cem_from_cov(R1, R1.shape[0]-1)
+np.where( ( CEM1*1e7 > 1e5).flatten() )
+np.array(libCG1.names)[CEM1[0]*1e7 > 1e5]
+
+
+R2 = library_cov(libCG2, u, u_dot, indices_u2, processes=None)
+CEM2 = cem_from_cov(R2, R2.shape[0]-1)
+np.where( (CEM2*1e7 > 1e5).flatten() )
+np.array(libCG2.names)[CEM2[0]*1e7 > 1e5]
 
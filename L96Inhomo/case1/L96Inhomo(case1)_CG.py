@@ -8,6 +8,9 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -70,50 +73,35 @@ dim_u2 = len(indices_u2)
 ########## CG-Filter ###########
 ################################
 u = test_u.numpy()
-Nt = u.shape[0]
 indices_u1 = np.array([i for i in range(36) if i % 3 != 2])
 indices_u2 = np.array([i for i in range(36) if i % 3 == 2])
 
 dim_u1 = len(indices_u1)
 dim_u2 = len(indices_u2)
-mu_trace = np.zeros((Nt, dim_u2, 1))
-R_trace = np.zeros((Nt, dim_u2, dim_u2))
-mu_trace[0] = np.zeros((dim_u2, 1))
-R_trace[0] = np.eye(dim_u2)*0.01
-mu0 = mu_trace[0]
-R0 = R_trace[0]
-
-for n in range(1, Nt):
-    du1 = (u[n, indices_u1] - u[n-1, indices_u1]).reshape(-1, 1)
-
-    f1 = F - (c_lst[indices_u1]*u[n-1, indices_u1]).reshape(-1, 1)
-    g1 = np.zeros((dim_u1, dim_u2))
-    for j in range(dim_u2):
-        g1[np.arange(2*j+1, 2*j+4)%dim_u1, j] = [u[n-1, 3*j], u[n-1, (3*j+4)%I]-u[n-1, 3*j+1], -u[n-1, (3*j+3)%I]]
-    s1 = np.diag([sigma]*dim_u1)
-    f2 = np.zeros((dim_u2, 1))
-    for i in range(dim_u2):
-        f2[i] = F + (u[n-1, (3*i+3)%I] - u[n-1, 3*i]) * u[n-1, 3*i+1]
-    g2 = np.diag(-c_lst[indices_u2])
-    s2 = np.diag([sigma]*dim_u2)
-    invs1os1 = np.linalg.inv(s1@s1.T)
-    s2os2 = s2@s2.T
-
-    mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-    R1 = R0 + ( g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-    mu_trace[n] = mu1
-    R_trace[n] = R1
-    mu0 = mu1
-    R0 = R1
+
+def coef_true(u1):
+    # Coefficients of the true model at all steps, stacked over time (t-1, ...)
+    N = u1.shape[0] - 1
+    u_prev = torch.zeros(N, I, dtype=torch.float64)
+    u_prev[:, indices_u1] = u1[:-1, :, 0]
+    jj = torch.arange(dim_u2)
+
+    f1 = F - torch.tensor(c_lst[indices_u1], dtype=torch.float64).reshape(-1, 1)*u1[:-1]
+    g1 = torch.zeros(N, dim_u1, dim_u2, dtype=torch.float64)
+    g1[:, (2*jj.unsqueeze(1)+torch.arange(1, 4))%dim_u1, jj.unsqueeze(1).repeat(1, 3)] = \
+        torch.stack([u_prev[:, 3*jj], u_prev[:, (3*jj+4)%I]-u_prev[:, 3*jj+1], -u_prev[:, (3*jj+3)%I]], dim=2)
+    s1 = torch.diag(torch.tensor([sigma]*dim_u1, dtype=torch.float64))
+    f2 = (F + (u_prev[:, (3*jj+3)%I] - u_prev[:, 3*jj]) * u_prev[:, 3*jj+1]).unsqueeze(2)
+    g2 = torch.diag(torch.tensor(-c_lst[indices_u2], dtype=torch.float64))
+    s2 = torch.diag(torch.tensor([sigma]*dim_u2, dtype=torch.float64))
+    return (f1, g1, s1, f2, g2, s2)
+mu_trace, R_trace = cgf.CGFilter(coef_true, u1=torch.tensor(u[:, indices_u1], dtype=torch.float64).unsqueeze(2), mu0=torch.zeros((dim_u2, 1), dtype=torch.float64), R0=0.01*torch.eye(dim_u2, dtype=torch.float64), cut_point=0, dt=dt)
+mu_trace = mu_trace.numpy()
+R_trace = R_trace.numpy()
 
 np.mean( (u[:, indices_u2] - mu_trace.squeeze(2) )**2 )
 
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 avg_neg_log_likehood(torch.tensor(u[:,indices_u2].reshape(20000, 12 ,1)),
                      torch.tensor(mu_trace),
                      torch.tensor(R_trace))
@@ -8,6 +8,8 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde.enkbf import L96Tendency, enkbf_repeats
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -71,20 +73,8 @@ dim_u2 = len(indices_u2)
 ################# EnKBF  #################
 ##########################################
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 u = test_u.numpy()
-def cross_cov(X, Y):
-    n = X.shape[0]
-    assert n == Y.shape[0]
-    X_centered = X - np.mean(X, axis=0)
-    Y_centered = Y - np.mean(Y, axis=0)
-    cross_cov_matrix = np.dot(X_centered.T, Y_centered) / (n - 1)
-    return cross_cov_matrix
 
 u1 = u[:, indices_u1]
 SIG1 = np.diag([sigma**2]*dim_u1)
@@ -94,40 +84,11 @@ sig2 = np.diag([sigma]*dim_u2)
 
 J = 100
 p = dim_u2
-u2_ens = np.zeros((J, Ntest, p))
-err_lst = []
-nll_lst = []
-for _ in range(100):
-    for n in range(1, Ntest):
-        u1_repeat = np.tile(u1[n-1], (J, 1))
-        u_ens = np.stack([u1_repeat, u2_ens[:, n-1]]).transpose(1,2,0).reshape(-1, 36)
-        u_dot_ens = np.zeros_like(u_ens)
-        for i in range(I):
-            u_dot_ens[:, i] = -c_lst[i]*u_ens[:, i] + u_ens[:,(i+1)%I]*u_ens[:,i-1] - u_ens[:,i-2]*u_ens[:,i-1] + F
-        g = u_dot_ens[:, ::2]
-        f = u_dot_ens[:, 1::2]
-
-        g_bar = np.mean(g, axis=0)
-        CCOV = cross_cov(u2_ens[:, n-1], g)
-        Sys_term = f*dt + np.random.randn(J,p) @ sig2 * np.sqrt(dt)
-        DA_term = -0.5*((g+g_bar)*dt-2*(u1[n]-u1[n-1])) @ (CCOV@np.linalg.inv(SIG1)).T
-
-        u2_ens[:, n, :] = u2_ens[:, n-1, :] + Sys_term + DA_term
-
-    mu_trace = np.mean(u2_ens, axis=0).reshape(u2_ens.shape[1], u2_ens.shape[2], 1)
-    R_trace = np.zeros((u2_ens.shape[1], u2_ens.shape[2], u2_ens.shape[2]))
-    for i in range(u2_ens.shape[1]):
-        R_trace[i] = np.cov(u2_ens[:, i, :].T)
-
-    nll = avg_neg_log_likehood(torch.tensor(u[:,indices_u2].reshape(20000, 18 ,1)[1:]),
-                             torch.tensor(mu_trace)[1:],
-                             torch.tensor(R_trace)[1:]).item()
-
-    err = np.mean( (u[:, indices_u2] - mu_trace.squeeze(2) )**2 )
-
-    err_lst.append(err)
-    nll_lst.append(nll)
-    print(_, err, nll)
+tendency = L96Tendency(F, indices_u1, indices_u2, c_lst)
+# 100 independent repeats, one noise stream per repeat, in chunks advanced together on all CPU cores
+stats = enkbf_repeats(tendency, u1, u[:, indices_u2], J, 100, dt, sig1, sig2, seed=0, processes=None)
+err_lst = stats["mse"]
+nll_lst = stats["nll"]
 
 
 np.mean(err_lst)
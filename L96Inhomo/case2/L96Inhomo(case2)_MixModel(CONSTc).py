@@ -8,6 +8,10 @@ import torch.nn.functional as nnF
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.forecast import forecast_windows
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -140,7 +144,7 @@ class MixModel(nn.Module):
         self.out = outnet_dynamics + self.outreg
         return self.out
 
-def ODESolver(model, u0, steps, dt):
+def ODESolver(model, u0, steps, dt, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     u_pred = torch.zeros(steps, dim)
@@ -148,6 +152,8 @@ def ODESolver(model, u0, steps, dt):
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_pred[n].unsqueeze(0)).squeeze(0)
         u_pred[n+1] = u_pred[n]+u_dot_pred*dt
+        if guard is not None and not guard.check(n+1, u_pred[n+1]):
+            return u_pred[:n+2]
     return u_pred
 
 
@@ -232,56 +238,48 @@ sigma_hat = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred)**2, dim=
 # R0 = 0.01*torch.eye(dim_u2)
 # cut_point = 0
 # sigma_lst = sigma_hat
-def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
-    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
+def cg_coef(mixmodel, sigma_lst):
     sigma_tsr = torch.tensor(sigma_lst)
 
     indices_u1 = np.arange(0, 36, 2)
     indices_u2 = np.arange(1, 36, 2)
     dim_u1 = len(indices_u1)
     dim_u2 = len(indices_u2)
-    dim_u = dim_u1 + dim_u2
 
     a = mixmodel.reg1
     b = mixmodel.reg2
 
-    Nt = u1.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        du1 = u1[n] - u1[n-1]
-        outnet = mixmodel.net(u1[n-1].T) # A tuple with outputs of 2 NNs
-        outnet1 = outnet[0].squeeze(0)  # (18, 3)
-        outnet2 = outnet[1].squeeze(0)  # (18, 4)
-
-        f1 = a[0] + a[1]*u1[n-1] + outnet1[:,[0]]
-        g1 = torch.zeros(dim_u1, dim_u2)
-        g1[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
-            torch.cat([ a[2]*u1[n-1][torch.arange(-1, 17)]+a[4]*u1[n-1]+a[5]*u1[n-1][torch.arange(1,19)%dim_u1]+outnet1[:,[1]],
-                        a[3]*u1[n-1][torch.arange(-1, 17)]+a[6]*u1[n-1]+outnet1[:,[2]] ], dim=1)
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        v = u1[:-1]
+        outnet = mixmodel.net(v[:, :, 0]) # A tuple with outputs of 2 NNs
+        outnet1, outnet2 = outnet  # (t-1, 18, 3), (t-1, 18, 4)
+
+        f1 = a[0] + a[1]*v + outnet1[:, :, [0]]
+        g1 = torch.zeros(N, dim_u1, dim_u2)
+        g1[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(18)-1, torch.arange(18)]).T] = \
+            torch.cat([ a[2]*v[:, torch.arange(-1, 17)]+a[4]*v+a[5]*v[:, torch.arange(1,19)%dim_u1]+outnet1[:, :, [1]],
+                        a[3]*v[:, torch.arange(-1, 17)]+a[6]*v+outnet1[:, :, [2]] ], dim=2)
         s1 = torch.diag(sigma_tsr[indices_u1])
 
-        f2 = b[0] + b[2]*u1[n-1][torch.arange(1,19)%dim_u1]**2+b[4]*u1[n-1]*u1[n-1][torch.arange(1, 19)%dim_u1]+outnet2[:, [0]]
-        g2 = torch.zeros(dim_u2, dim_u2)
-        g2[torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18), torch.arange(1, 19)%18]).T] = \
-            torch.cat([ b[3]*u1[n-1]+outnet2[:,[1]],
-                        b[1]+outnet2[:, [2]],
-                        outnet2[:, [3]] ], dim=1)
+        f2 = b[0] + b[2]*v[:, torch.arange(1,19)%dim_u1]**2+b[4]*v*v[:, torch.arange(1, 19)%dim_u1]+outnet2[:, :, [0]]
+        g2 = torch.zeros(N, dim_u2, dim_u2)
+        g2[:, torch.arange(18).unsqueeze(dim=1), torch.stack([torch.arange(-1, 17), torch.arange(0, 18), torch.arange(1, 19)%18]).T] = \
+            torch.cat([ b[3]*v+outnet2[:, :, [1]],
+                        b[1]+outnet2[:, :, [2]],
+                        outnet2[:, :, [3]] ], dim=2)
         s2 = torch.diag(sigma_tsr[indices_u2])
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2.T
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
-
-def SDESolver(model, u0, steps, dt, sigma_lst):
+        return (f1, g1, s1, f2, g2, s2)
+
+    return coef
+
+
+def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
+    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
+    return cgf.CGFilter(cg_coef(mixmodel, sigma_lst), u1, mu0, R0, cut_point, dt)
+
+def SDESolver(model, u0, steps, dt, sigma_lst, guard=None):
     # u0 is in vector form, e.g. (x)
     dim = u0.shape[0]
     sigma = torch.tensor(sigma_lst)
@@ -289,7 +287,12 @@ def SDESolver(model, u0, steps, dt, sigma_lst):
     u_simu[0] = u0
     for n in range(0, steps-1):
         u_dot_pred = model(None, u_simu[n].unsqueeze(0)).squeeze(0)
-        u_simu[n+1] = torch.clamp(u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(dim), min=torch.min(train_u), max=torch.max(train_u))
+        u_simu[n+1] = u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(dim)
+        if guard is None:
+            # Without a guard the state is kept in the range of the training data; with one, leaving it is a blow-up
+            u_simu[n+1] = torch.clamp(u_simu[n+1], min=torch.min(train_u), max=torch.max(train_u))
+        elif not guard.check(n+1, u_simu[n+1]):
+            return u_simu[:n+2]
     return u_simu
 
 
@@ -298,15 +301,16 @@ def SDESolver(model, u0, steps, dt, sigma_lst):
 ############################################################
 # Stage 2: Train mixmodel with forcast loss + DA loss
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 long_steps = int(100/dt)
 cut_point = int(5/dt)
 
+# Warm-started DA windows: start from the cached posteriors of previous epochs with a short spin-up
+warm_start = True
+warm_long_steps = long_steps//2
+warm_cut_point = int(1/dt)
+state_cache = cgf.FilterStateCache(Ntrain, dim_u2, max_age=20, device=device)
+
 epochs = 1000
 train_loss_history = []
 train_loss_da_history = []
@@ -318,17 +322,25 @@ for ep in range(1, epochs+1):
     u_short = u[head_idx_short:head_idx_short + short_steps].to(device)
     t_short = t[head_idx_short:head_idx_short + short_steps].to(device)
 
-    head_idx_long = torch.from_numpy( np.random.choice(Ntrain-long_steps+1, size=1) )
-    u_long = u[head_idx_long:head_idx_long + long_steps].to(device)
-    t_long = t[head_idx_long:head_idx_long + long_steps].to(device)
+    head_idx_long = state_cache.sample_head(ep, Ntrain-warm_long_steps) if warm_start else None
+    if head_idx_long is None:
+        head_idx_long = np.random.choice(Ntrain-long_steps+1)
+        mu0, R0 = torch.zeros(dim_u2,1).to(device), 0.01*torch.eye(dim_u2).to(device)
+        da_cut_point, da_steps = cut_point, long_steps
+    else:
+        mu0, R0 = state_cache.lookup(head_idx_long, ep)
+        da_cut_point, da_steps = warm_cut_point, warm_long_steps
+    u_long = u[head_idx_long:head_idx_long + da_steps].to(device)
+    t_long = t[head_idx_long:head_idx_long + da_steps].to(device)
 
     optimizer.zero_grad()
 
     out = torchdiffeq.odeint(mixmodel, u_short[[0]], t_short)[:,0,:]
     loss = nnF.mse_loss(u_short, out)
 
-    out_da = CGFilter(mixmodel, u1=u_long[:, indices_u1].unsqueeze(2), mu0=torch.zeros(dim_u2,1).to(device), R0=0.01*torch.eye(dim_u2).to(device), cut_point=cut_point, sigma_lst=sigma_hat)[0]
-    loss_da = nnF.mse_loss(u_long[cut_point:, indices_u2], out_da.squeeze(2))
+    out_da, out_R = CGFilter(mixmodel, u1=u_long[:, indices_u1].unsqueeze(2), mu0=mu0, R0=R0, cut_point=da_cut_point, sigma_lst=sigma_hat)
+    state_cache.store(head_idx_long+da_cut_point, out_da, out_R, ep)
+    loss_da = nnF.mse_loss(u_long[da_cut_point:, indices_u2], out_da.squeeze(2))
 
     total_loss = loss + loss_da
     total_loss.backward()
@@ -359,21 +371,10 @@ for ep in range(1, epochs+1):
 # Short-term Prediction
 def integrate_batch(t, u, model, batch_steps):
     # u is in vector form, e.g. (t, x)
-    device = u.device
-    Nt = u.shape[0]
-    num_batchs = int(Nt / batch_steps)
-    error_abs = 0
-    # error_rel = 0
-    u_pred = torch.tensor([]).to(device)
-    for i in range(num_batchs):
-        u_batch = u[i*batch_steps: (i+1)*batch_steps]
-        with torch.no_grad():
-            u_batch_pred = torchdiffeq.odeint(model, u_batch[[0]], t[:batch_steps])[:,0,:]
-        u_pred = torch.cat([u_pred, u_batch_pred])
-        error_abs += torch.mean( (u_batch - u_batch_pred)**2 ).item()
-        # error_rel += torch.mean( torch.norm(stt_batch - stt_pred_batch, 2, 1) / (torch.norm(stt_batch, 2, 1)) ).item()
-    error_abs /= num_batchs
-    # error_rel /= num_batch
+    # Consecutive windows of batch_steps, all integrated in one batched odeint call (see forecast_windows for overlapping windows)
+    u_batch_pred, u_batch = forecast_windows(t, u, model, batch_steps)
+    error_abs = torch.mean( (u_batch - u_batch_pred)**2 ).item()
+    u_pred = u_batch_pred.reshape(-1, u.shape[1])
     return [u_pred, error_abs]
 u_shortPreds, error_abs = integrate_batch(test_t, test_u, mixmodel, batch_steps=20)
 
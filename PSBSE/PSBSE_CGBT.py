@@ -7,6 +7,8 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -47,32 +49,21 @@ t = np.linspace(0, Lt, Nt)
 
 ########## DA ###########
 dim_u2 = 2
-mu_trace = np.zeros((Nt, dim_u2, 1))
-R_trace = np.zeros((Nt, dim_u2, dim_u2))
-mu_trace[0] = np.zeros((dim_u2, 1))
-R_trace[0] = np.eye(dim_u2)*0.01
-mu0 = mu_trace[0]
-R0 = R_trace[0]
-for n in range(1, Nt):
-    x0 = u[n-1, 0]
-    x1 = u[n, 0]
-    y1 = u[n, 1]
-    f1 = np.array([[beta_x*x0]])
-    g1 = np.array([[alpha*x0, 0]])
-    # g1 = np.array([[alpha*x0, alpha*y1]])
-    S1 = np.array([[sigma_x]])
-    f2 = np.array([[-alpha*x0**2], [0]])
-    g2 = np.array([beta_y, 2*alpha*x0, -3*alpha*x0, beta_z]).reshape(2,2)
-    S2 = np.diag([sigma_y**2, sigma_z**2])
-    invS1oS1 = np.linalg.inv(S1@S1.T)
-    S2oS2 = S2*S2
-    du1 = np.array([[x1 - x0]])
-    mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invS1oS1 @ (du1 -(f1+g1@mu0)*dt)
-    R1 = R0 + ( g2@R0 + R0@g2.T + S2oS2 - R0@g1.T@ invS1oS1 @ g1@R0 )*dt
-    mu_trace[n] = mu1
-    R_trace[n] = R1
-    mu0 = mu1
-    R0 = R1
+def coef_true(u1):
+    # Coefficients of the true model at all steps, stacked over time (t-1, ...)
+    N = u1.shape[0] - 1
+    x0 = u1[:-1, :, 0]
+    f1 = (beta_x*x0).unsqueeze(2)
+    g1 = torch.cat([alpha*x0, torch.zeros_like(x0)], dim=1).reshape(N, 1, 2)
+    # g1 = torch.cat([alpha*x0, alpha*torch.tensor(u[1:, [1]])], dim=1).reshape(N, 1, 2)
+    S1 = torch.tensor([[sigma_x]], dtype=torch.float64)
+    f2 = torch.cat([-alpha*x0**2, torch.zeros_like(x0)], dim=1).reshape(N, 2, 1)
+    g2 = torch.cat([beta_y+torch.zeros_like(x0), 2*alpha*x0, -3*alpha*x0, beta_z+torch.zeros_like(x0)], dim=1).reshape(N, 2, 2)
+    S2 = torch.diag(torch.tensor([sigma_y**2, sigma_z**2], dtype=torch.float64))
+    return (f1, g1, S1, f2, g2, S2)
+mu_trace, R_trace = cgf.CGFilter(coef_true, u1=torch.tensor(u[:, [0]]).unsqueeze(2), mu0=torch.zeros((dim_u2, 1), dtype=torch.float64), R0=0.01*torch.eye(dim_u2, dtype=torch.float64), cut_point=0, dt=dt)
+mu_trace = mu_trace.numpy()
+R_trace = R_trace.numpy()
 mu_trace = mu_trace.reshape(mu_trace.shape[0], mu_trace.shape[1])
 
 np.mean( ( u[:, 1:] - mu_trace)**2 )
@@ -8,6 +8,11 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.enkbf import model_tendency, split_tendency
+from cgnsde.particle import BootstrapPF
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -61,11 +66,6 @@ test_t = t[-Ntest:]
 ################# Ensemble Kalman-Bucy Filter #################
 ###############################################################
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)).flatten())
-    return torch.mean(neg_log_likehood)
 
 def cross_cov(X, Y):
     n = X.shape[0]
@@ -161,6 +161,28 @@ avg_neg_log_likehood(torch.tensor(test_u[:,1:]).unsqueeze(2)[1:],
 
 
 
+
+##############################################################
+################# Bootstrap Particle Filter  #################
+##############################################################
+# Nonlinear reference for the non-CG system: the true drift with the noise levels of the data generation
+
+def psbse_tendency(u1, u2):
+    # (g (N, 1), f (N, 2)) of the true system for the particles u2 (N, 2)
+    x, y, z = u1[0], u2[:, 0], u2[:, 1]
+    g = (beta_x*x + alpha*x*y + alpha*y*z)[:, None]
+    f = np.stack([beta_y*y - alpha*x**2 + 2*alpha*x*z, beta_z*z - 3*alpha*x*y], axis=1)
+    return (g, f)
+
+pf = BootstrapPF(psbse_tendency, u1, np.zeros((10000, p)), dt, np.array([[0.3]]), np.diag([1., 1.]), ess_threshold=0.5, seed=0)
+print("particles x steps per second:", pf["throughput"], "resampling steps:", pf["resampled"])
+np.mean( (test_u[:, 1:] - pf["mu_trace"].squeeze(2) )**2 )
+avg_neg_log_likehood(torch.tensor(test_u[:,1:]).unsqueeze(2)[1:],
+                     torch.tensor(pf["mu_trace"])[1:],
+                     torch.tensor(pf["R_trace"])[1:])
+
+
+
 # CGF for Models
 train_u = torch.tensor(train_u, dtype=torch.float32)
 test_u = torch.tensor(test_u, dtype=torch.float32)
@@ -220,7 +242,6 @@ class MixModel(nn.Module):
 
 def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a1 = regmodel.reg0.weight[:, 0]
@@ -229,38 +250,24 @@ def CGFilter_RegModel(regmodel, u1, mu0, R0, cut_point, sigma_lst):
     b2 = regmodel.reg1.weight[:, 1]
     c1 = regmodel.reg2.weight[:, 0]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        x0 = u1[n-1].flatten()
-        x1 = u1[n].flatten()
-        du1 = (x1 - x0).reshape(-1, 1)
-
-        f1 = torch.zeros(1,1)
-        g1 = torch.cat([a2*x0, a1]).reshape(1, 2)
-        s1 = torch.tensor([[sigma_x]]).to(device)
-        f2 = torch.cat([b1*x0**2, torch.zeros(1)]).reshape(2, 1)
-        g2 = torch.cat([torch.zeros(1), b2*x0, c1*x0, torch.zeros(1)]).reshape(2, 2)
-        s2 = torch.diag(torch.tensor([sigma_y, sigma_z])).to(device)
-
-
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        x0 = u1[:-1, :, 0]
+        zeros = torch.zeros_like(x0)
+
+        f1 = torch.zeros(1, 1)
+        g1 = torch.cat([a2*x0, a1+zeros], dim=1).reshape(N, 1, 2)
+        s1 = torch.tensor([[sigma_x]])
+        f2 = torch.cat([b1*x0**2, zeros], dim=1).reshape(N, 2, 1)
+        g2 = torch.cat([zeros, b2*x0, c1*x0, zeros], dim=1).reshape(N, 2, 2)
+        s2 = torch.diag(torch.tensor([sigma_y, sigma_z]))
+        return (f1, g1, s1, f2, g2, s2)
+
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 
 def CGFilter_MixModel(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a1 = mixmodel.reg0.weight[:, 0]
@@ -269,34 +276,21 @@ def CGFilter_MixModel(mixmodel, u1, mu0, R0, cut_point, sigma_lst):
     b2 = mixmodel.reg1.weight[:, 1]
     c1 = mixmodel.reg2.weight[:, 0]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        x0 = u1[n-1].flatten()
-        x1 = u1[n].flatten()  # for dynamics of x0
-        du1 = (x1 - x0).reshape(-1, 1)
-        outnet = mixmodel.net(x0.unsqueeze(0)).T
-
-        f1 = (outnet[0]).reshape(-1, 1)
-        g1 = torch.cat([a2*x0+outnet[3], a1+outnet[4]]).reshape(1, 2)
-        s1 = torch.tensor([[sigma_x]]).to(device)
-        f2 = torch.cat([b1*x0**2+outnet[1], outnet[2]]).reshape(2, 1)
-        g2 = torch.cat([outnet[5], b2*x0+outnet[6], c1*x0+outnet[7], outnet[8]]).reshape(2, 2)
-        s2 = torch.diag(torch.tensor([sigma_y, sigma_z])).to(device)
-
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        x0 = u1[:-1, :, 0]
+        outnet = mixmodel.net(x0)
+
+        f1 = outnet[:, [0]].unsqueeze(2)
+        g1 = torch.cat([a2*x0+outnet[:, [3]], a1+outnet[:, [4]]], dim=1).reshape(N, 1, 2)
+        s1 = torch.tensor([[sigma_x]])
+        f2 = torch.cat([b1*x0**2+outnet[:, [1]], outnet[:, [2]]], dim=1).reshape(N, 2, 1)
+        g2 = torch.cat([outnet[:, [5]], b2*x0+outnet[:, [6]], c1*x0+outnet[:, [7]], outnet[:, [8]]], dim=1).reshape(N, 2, 2)
+        s2 = torch.diag(torch.tensor([sigma_y, sigma_z]))
+        return (f1, g1, s1, f2, g2, s2)
+
+    return cgf.CGFilter(coef, u1, mu0, R0, cut_point, dt)
 
 
 model1 = RegModel()
@@ -325,6 +319,12 @@ avg_neg_log_likehood(test_u[:,1:].unsqueeze(2), mu_preds1, R_preds1)
 avg_neg_log_likehood(test_u[:,1:].unsqueeze(2), mu_preds2, R_preds2)
 avg_neg_log_likehood(test_u[:,1:].unsqueeze(2), mu_preds3, R_preds3)
 
+# Particle filter with the learned drift (CGNSDE with DA loss), i.e. the exact nonlinear filter of the same model
+sigma_hat = np.array(sigma_hat2)
+pf3 = BootstrapPF(split_tendency(model_tendency(model3), [0], [1, 2]), u1, np.zeros((10000, p)), dt, np.diag(sigma_hat[[0]]), np.diag(sigma_hat[[1, 2]]), seed=0)
+F.mse_loss(test_u[:,1:], torch.tensor(pf3["mu_trace"]).reshape(-1, 2).float())
+avg_neg_log_likehood(test_u[:,1:].unsqueeze(2).double()[1:], torch.tensor(pf3["mu_trace"])[1:], torch.tensor(pf3["R_trace"])[1:])
+
 
 
 # Visualizaton
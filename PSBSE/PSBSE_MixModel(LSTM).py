@@ -7,6 +7,10 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.simulate import LSTMStepper
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -81,8 +85,14 @@ class MixModel(nn.Module):
         # u_history shape (N, t, x)
         u1_history = u_history[:, :, [0]]
         self.outnet = self.net(u1_history)
+        return self.dynamics(u_history[:, -1, :])
+
+    def step(self, stepper, u):
+        # Same as forward, with the LSTM output taken from an LSTMStepper over the u1 history; u shape (N, x)
+        self.outnet = self.net.fc(stepper.output())
+        return self.dynamics(u)
 
-        u = u_history[:, -1, :]
+    def dynamics(self, u):
         basis_x = torch.stack([u[:,2], u[:,0]*u[:,1]]).T
         basis_y = torch.stack([u[:,0]**2, u[:,0]*u[:,2]]).T
         basis_z = torch.stack([u[:,0]*u[:,1]]).T
@@ -93,15 +103,21 @@ class MixModel(nn.Module):
         self.out = torch.cat([x_dyn, y_dyn, z_dyn], dim=1)
         return self.out
 
-def ODESolver(mixmodel, u_history, steps, dt):
+def ODESolver(mixmodel, u_history, steps, dt, guard=None, memory="fixed"):
     # u_history is in vector form, e.g. (t, x)
+    # memory: update of the LSTM window, see LSTMStepper ("fixed": u_history[:-1] is kept and the newest state replaced)
     dim = u_history.shape[1]
     u_pred = torch.zeros(steps, dim)
     u_pred[0] = u_history[-1]
+    u_last = u_history[[-1]]
+    stepper = LSTMStepper(mixmodel.net.lstm, u_history[:, [0]].unsqueeze(0), memory)
     for n in range(0, steps-1):
-        u_dot_pred = mixmodel(u_history.unsqueeze(0)).squeeze(0)
-        u_pred[n+1] = u_pred[n] + u_dot_pred * dt
-        u_history = torch.cat([u_history[:-1], u_pred[n+1].unsqueeze(0)])
+        u_dot_pred = mixmodel.step(stepper, u_last)
+        u_last = u_last + u_dot_pred * dt
+        u_pred[n+1] = u_last.squeeze(0)
+        if guard is not None and not guard.check(n+1, u_pred[n+1]):
+            return u_pred[:n+2]
+        stepper.push(u_last[:, [0]])
     return u_pred
 
 ############################################################
@@ -163,9 +179,9 @@ with torch.no_grad():
 
 sigma_hat = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred)**2, dim=0 ) ).tolist()
 
-def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst, memory_steps):
-    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
+def cg_coef(mixmodel, sigma_lst, u1, memory_steps):
+    # Conditional Gaussian coefficients of the model for the series u1[memory_steps-1:] (see CGFilter): coef reads its
+    # LSTM windows from the whole u1 including the history, so it is only valid for that series, not for sub-blocks
     sigma_x, sigma_y, sigma_z = sigma_lst
 
     a1 = mixmodel.reg0.weight[:, 0]
@@ -174,48 +190,46 @@ def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst, memory_steps):
     b2 = mixmodel.reg1.weight[:, 1]
     c1 = mixmodel.reg2.weight[:, 0]
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt-memory_steps+1, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt-memory_steps+1, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt-memory_steps+1):
-        start_idx = n-1
-        end_idx = n-1+memory_steps
-        u1_history = u1[start_idx:end_idx]
-        x0 = u1[end_idx-1].flatten()
-        x1 = u1[end_idx].flatten()
-        du1 = (x1 - x0).reshape(-1, 1)
-        outnet = mixmodel.net(u1_history.reshape(1, memory_steps, 1)).T
-
-        f1 = (outnet[0]).reshape(-1, 1)
-        g1 = torch.cat([a2*x0+outnet[3], a1+outnet[4]]).reshape(1, 2)
-        s1 = torch.tensor([[sigma_x]]).to(device)
-        f2 = torch.cat([b1*x0**2+outnet[1], outnet[2]]).reshape(2, 1)
-        g2 = torch.cat([outnet[5], b2*x0+outnet[6], c1*x0+outnet[7], outnet[8]]).reshape(2, 2)
-        s2 = torch.diag(torch.tensor([sigma_y, sigma_z])).to(device)
-
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
-
-def SDESolver(mixmodel, u_history, steps, dt, sigma_lst):
+    def coef(u1_filter):
+        # Coefficients of all steps at once, stacked over time (t-1, ...); the LSTM runs once on the batch of all
+        # windows u1[n-1:n-1+memory_steps], which are unfold views of the observations (no copies)
+        N = u1_filter.shape[0] - 1
+        x0 = u1_filter[:-1, :, 0]
+        u1_windows = u1[:-1, 0, 0].unfold(0, memory_steps, 1).unsqueeze(2)
+        outnet = mixmodel.net(u1_windows)
+
+        f1 = outnet[:, [0]].unsqueeze(2)
+        g1 = torch.cat([a2*x0+outnet[:, [3]], a1+outnet[:, [4]]], dim=1).reshape(N, 1, 2)
+        s1 = torch.tensor([[sigma_x]])
+        f2 = torch.cat([b1*x0**2+outnet[:, [1]], outnet[:, [2]]], dim=1).reshape(N, 2, 1)
+        g2 = torch.cat([outnet[:, [5]], b2*x0+outnet[:, [6]], c1*x0+outnet[:, [7]], outnet[:, [8]]], dim=1).reshape(N, 2, 2)
+        s2 = torch.diag(torch.tensor([sigma_y, sigma_z]))
+        return (f1, g1, s1, f2, g2, s2)
+
+    return coef
+
+
+def CGFilter(mixmodel, u1, mu0, R0, cut_point, sigma_lst, memory_steps):
+    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
+    # The filter starts at u1[memory_steps-1], the first step with a full LSTM window
+    return cgf.CGFilter(cg_coef(mixmodel, sigma_lst, u1, memory_steps), u1[memory_steps-1:], mu0, R0, cut_point, dt)
+
+def SDESolver(mixmodel, u_history, steps, dt, sigma_lst, guard=None, memory="fixed"):
     # u_history is in vector form, e.g. (t, x)
+    # memory: update of the LSTM window, see LSTMStepper ("fixed": u_history[:-1] is kept and the newest state replaced)
     dim = u_history.shape[1]
     sigma = torch.tensor(sigma_lst)
     u_simu = torch.zeros(steps, dim)
     u_simu[0] = u_history[-1]
+    u_last = u_history[[-1]]
+    stepper = LSTMStepper(mixmodel.net.lstm, u_history[:, [0]].unsqueeze(0), memory)
     for n in range(0, steps-1):
-        u_dot_pred = mixmodel(u_history.unsqueeze(0)).squeeze(0)
-        u_simu[n+1] = u_simu[n]+u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(3)
-        u_history = torch.cat([u_history[:-1], u_simu[n+1].unsqueeze(0)])
+        u_dot_pred = mixmodel.step(stepper, u_last)
+        u_last = u_last + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(3)
+        u_simu[n+1] = u_last.squeeze(0)
+        if guard is not None and not guard.check(n+1, u_simu[n+1]):
+            return u_simu[:n+2]
+        stepper.push(u_last[:, [0]])
     return u_simu
 
 ############################################################
@@ -223,11 +237,6 @@ def SDESolver(mixmodel, u_history, steps, dt, sigma_lst):
 ############################################################
 # Stage 2: Train mixmodel with forcast loss + DA loss
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)))
-    return torch.mean(neg_log_likehood)
 
 long_steps = int(100/dt)
 cut_point = int(10/dt)
@@ -294,13 +303,13 @@ def integrate_batch(u, model, batch_steps, memory_steps):
     num_batchs = int((Nt-memory_steps+1) / batch_steps)
     error_abs = 0
     # error_rel = 0
-    u_pred = torch.tensor([]).to(device)
+    u_pred = torch.zeros(num_batchs*batch_steps, u.shape[1]).to(device)
     for i in range(num_batchs):
         u_batch = u[i*batch_steps+memory_steps-1: (i+1)*batch_steps+memory_steps-1]
         u_history = u[i*batch_steps: i*batch_steps+memory_steps]
         with torch.no_grad():
             u_batch_pred = ODESolver(model, u_history, batch_steps, dt)
-        u_pred = torch.cat([u_pred, u_batch_pred])
+        u_pred[i*batch_steps: (i+1)*batch_steps] = u_batch_pred
         error_abs += torch.mean( (u_batch - u_batch_pred)**2 ).item()
         # error_rel += torch.mean( torch.norm(stt_batch - stt_pred_batch, 2, 1) / (torch.norm(stt_batch, 2, 1)) ).item()
     error_abs /= num_batchs
@@ -333,7 +342,7 @@ plt.show()
 start = 0
 end = Ntrain
 with torch.no_grad():
-    mu_pred = CGFilter(mixmodel, u1=train_u[:, [0]].reshape(-1, 1, 1), mu0=torch.zeros(2, 1).to(device), R0=0.01 * torch.eye(2).to(device), cut_point=0, sigma_lst=sigma_hat)[0]
+    mu_pred = CGFilter(mixmodel, u1=train_u[:, [0]].reshape(-1, 1, 1), mu0=torch.zeros(2, 1).to(device), R0=0.01 * torch.eye(2).to(device), cut_point=0, sigma_lst=sigma_hat, memory_steps=memory_steps)[0]
 F.mse_loss(train_u[:,1:], mu_pred.reshape(-1, 2))
 
 fig = plt.figure(figsize=(16, 10))
@@ -437,7 +446,7 @@ plt.show()
 start = 0
 end = Ntest
 with torch.no_grad():
-    mu_preds = CGFilter(mixmodel, u1=test_u[:, [0]].reshape(-1, 1, 1), mu0=torch.zeros(2, 1).to(device), R0=0.01 * torch.eye(2).to(device), cut_point=0, sigma_lst=sigma_hat)[0]
+    mu_preds = CGFilter(mixmodel, u1=test_u[:, [0]].reshape(-1, 1, 1), mu0=torch.zeros(2, 1).to(device), R0=0.01 * torch.eye(2).to(device), cut_point=0, sigma_lst=sigma_hat, memory_steps=memory_steps)[0]
 F.mse_loss(test_u[:,1:], mu_preds.reshape(-1, 2))
 
 fig = plt.figure(figsize=(16, 10))
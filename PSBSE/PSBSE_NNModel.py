@@ -7,6 +7,10 @@ import torch.nn.functional as F
 import torchdiffeq
 import time
 
+from cgnsde import filter as cgf
+from cgnsde.metrics import avg_neg_log_likehood
+from cgnsde.forecast import forecast_windows
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -137,54 +141,44 @@ with torch.no_grad():
     train_u_dot_pred = model(None, train_u[:-1])
 sigma_hat = torch.sqrt( dt*torch.mean( (train_u_dot - train_u_dot_pred)**2, dim=0 ) ).tolist()
 
-def CGFilter(model, u1, mu0, R0, cut_point, sigma_lst):
-    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
-    device = u1.device
+def cg_coef(model, sigma_lst):
     sigma_x, sigma_y, sigma_z = sigma_lst
 
-    Nt = u1.shape[0]
-    dim_u2 = mu0.shape[0]
-    mu_trace = torch.zeros((Nt, dim_u2, 1)).to(device)
-    R_trace = torch.zeros((Nt, dim_u2, dim_u2)).to(device)
-    mu_trace[0] = mu0
-    R_trace[0] = R0
-    for n in range(1, Nt):
-        x0 = u1[n-1].flatten()
-        x1 = u1[n].flatten()  # for dynamics of x0
-        du1 = (x1 - x0).reshape(-1, 1)
-        outnet = model.net(x0.unsqueeze(0)).T
-
-        f1 = (outnet[0]).reshape(-1, 1)
-        g1 = torch.cat([outnet[3], outnet[4]]).reshape(1, 2)
-        s1 = torch.tensor([[sigma_x]]).to(device)
-        f2 = torch.cat([outnet[1], outnet[2]]).reshape(2, 1)
-        g2 = torch.cat([outnet[5], outnet[6], outnet[7], outnet[8]]).reshape(2, 2)
-        s2 = torch.diag(torch.tensor([sigma_y, sigma_z])).to(device)
-
-        invs1os1 = torch.linalg.inv(s1@s1.T)
-        s2os2 = s2@s2
-        mu1 = mu0 + (f2+g2@mu0)*dt + (R0@g1.T) @ invs1os1 @ (du1 -(f1+g1@mu0)*dt)
-        R1 = R0 + (g2@R0 + R0@g2.T + s2os2 - R0@g1.T@ invs1os1 @ g1@R0 )*dt
-        mu_trace[n] = mu1
-        R_trace[n] = R1
-        mu0 = mu1
-        R0 = R1
-    return (mu_trace[cut_point:], R_trace[cut_point:])
+    def coef(u1):
+        # Coefficients of all steps at once, stacked over time (t-1, ...)
+        N = u1.shape[0] - 1
+        outnet = model.net(u1[:-1, :, 0])
+
+        f1 = outnet[:, [0]].unsqueeze(2)
+        g1 = outnet[:, [3, 4]].reshape(N, 1, 2)
+        s1 = torch.tensor([[sigma_x]])
+        f2 = outnet[:, [1, 2]].reshape(N, 2, 1)
+        g2 = outnet[:, [5, 6, 7, 8]].reshape(N, 2, 2)
+        s2 = torch.diag(torch.tensor([sigma_y, sigma_z]))
+        return (f1, g1, s1, f2, g2, s2)
+
+    return coef
+
+
+def CGFilter(model, u1, mu0, R0, cut_point, sigma_lst):
+    # u1, mu0 are in col-matrix form, e.g. (t, x, 1)
+    return cgf.CGFilter(cg_coef(model, sigma_lst), u1, mu0, R0, cut_point, dt)
 
 ############################################################
 ################# Train MixModel (Stage2)  #################
 ############################################################
 # Stage 2: Train model with forcast loss + DA loss
 
-def avg_neg_log_likehood(x, mu, R):
-    # x, mu are in matrix form, e.g. (t, x, 1)
-    d = x.shape[1]
-    neg_log_likehood = 1/2*(d*np.log(2*np.pi) + torch.log(torch.linalg.det(R)) + ((x-mu).permute(0,2,1)@torch.linalg.inv(R)@(x-mu)))
-    return torch.mean(neg_log_likehood)
 
 long_steps = int(100/dt)
 cut_point = int(10/dt)
 
+# Warm-started DA windows: start from the cached posteriors of previous epochs with a short spin-up
+warm_start = True
+warm_long_steps = long_steps//2
+warm_cut_point = int(1/dt)
+state_cache = cgf.FilterStateCache(Ntrain, 2, max_age=20, device=device)
+
 epochs = 500
 train_loss_history = []
 train_loss_da_history = []
@@ -196,17 +190,25 @@ for ep in range(1, epochs+1):
     u_short = u[head_idx_short:head_idx_short + short_steps].to(device)
     t_short = t[head_idx_short:head_idx_short + short_steps].to(device)
 
-    head_idx_long = torch.from_numpy( np.random.choice(Ntrain-long_steps+1, size=1) )
-    u_long = u[head_idx_long:head_idx_long + long_steps].to(device)
-    t_long = t[head_idx_long:head_idx_long + long_steps].to(device)
+    head_idx_long = state_cache.sample_head(ep, Ntrain-warm_long_steps) if warm_start else None
+    if head_idx_long is None:
+        head_idx_long = np.random.choice(Ntrain-long_steps+1)
+        mu0, R0 = torch.zeros(2,1).to(device), 0.01*torch.eye(2).to(device)
+        da_cut_point, da_steps = cut_point, long_steps
+    else:
+        mu0, R0 = state_cache.lookup(head_idx_long, ep)
+        da_cut_point, da_steps = warm_cut_point, warm_long_steps
+    u_long = u[head_idx_long:head_idx_long + da_steps].to(device)
+    t_long = t[head_idx_long:head_idx_long + da_steps].to(device)
 
     optimizer.zero_grad()
 
     out = torchdiffeq.odeint(model, u_short[[0]], t_short)[:,0,:]
     loss = F.mse_loss(u_short, out)
 
-    out_da = CGFilter(model, u1=u_long[:, [0]].reshape(-1, 1, 1), mu0=torch.zeros(2,1).to(device), R0=0.01*torch.eye(2).to(device), cut_point=cut_point, sigma_lst=sigma_hat)[0]
-    loss_da = F.mse_loss(u_long[cut_point:, 1:], out_da.squeeze(2))
+    out_da, out_R = CGFilter(model, u1=u_long[:, [0]].reshape(-1, 1, 1), mu0=mu0, R0=R0, cut_point=da_cut_point, sigma_lst=sigma_hat)
+    state_cache.store(head_idx_long+da_cut_point, out_da, out_R, ep)
+    loss_da = F.mse_loss(u_long[da_cut_point:, 1:], out_da.squeeze(2))
 
     # out_da, out_R = CGFilter(model, u1=u_long[:, [0]].reshape(-1, 1, 1), mu0=torch.zeros(2,1).to(device), R0=0.01*torch.eye(2).to(device), cut_point=cut_point, sigma_lst=sigma_hat)
     # loss_da = avg_neg_log_likehood(u_long[cut_point:, 1:].unsqueeze(2), out_da, out_R)
@@ -241,21 +243,11 @@ np.save(r"/home/cc/CodeProjects/CGNN/NonCG/NonCG_Model/NonCG_nnmodel2_fc_train_l
 
 # Short-term Prediction
 def integrate_batch(t, u, model, batch_time):
-    device = u.device
-    data_size = u.shape[0]
-    num_batchs = int(data_size / batch_time)
-    error_abs = 0
-    # error_rel = 0
-    u_pred = torch.tensor([]).to(device)
-    for i in range(num_batchs):
-        u_batch = u[i*batch_time: (i+1)*batch_time]
-        with torch.no_grad():
-            u_batch_pred = torchdiffeq.odeint(model, u_batch[[0]], t[:batch_time])[:,0,:]
-        u_pred = torch.cat([u_pred, u_batch_pred])
-        error_abs += torch.mean( (u_batch - u_batch_pred)**2 ).item()
-        # error_rel += torch.mean( torch.norm(stt_batch - stt_pred_batch, 2, 1) / (torch.norm(stt_batch, 2, 1)) ).item()
-    error_abs /= num_batchs
-    # error_rel /= num_batch
+    # u is in vector form, e.g. (t, x)
+    # Consecutive windows of batch_time, all integrated in one batched odeint call (see forecast_windows for overlapping windows)
+    u_batch_pred, u_batch = forecast_windows(t, u, model, batch_time)
+    error_abs = torch.mean( (u_batch - u_batch_pred)**2 ).item()
+    u_pred = u_batch_pred.reshape(-1, u.shape[1])
     return [u_pred, error_abs]
 u_shortPreds, error_abs = integrate_batch(train_t, train_u, model, short_steps)
 
@@ -3,6 +3,8 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import torch
 
+from cgnsde.sysid import PolyLibrary, cem
+
 device = "cpu"
 torch.manual_seed(0)
 np.random.seed(0)
@@ -49,33 +51,11 @@ test_t = t[-Ntest:]
 ################# System Identification ################
 ########################################################
 
-# The CG Library [x, y, z, x^2, xy, xz]
-def cem(A, B):
-    """
-    :param A: numpy.array(Nt, Na); Basis Functions
-    :param B: numpy.array(Nt, Nb); Dynamics
-    :return: numpy.array(Nb, Na); Causation Entropy Matrix C(X->Y|Z)
-    """
-    Na = A.shape[1]
-    Nb = B.shape[1]
-    CEM = np.zeros((Nb, Na))
-    for i in range(Nb):
-        XYZ = np.concatenate([A, B[:, [i]]], axis=1)
-        RXYZ = np.cov(XYZ.T)
-        RXYZ_det = np.linalg.det(RXYZ)
-        RXZ = RXYZ[:-1, :-1]
-        RXZ_det = np.linalg.det(RXZ)
-        for j in range(Na):
-            RYZ = np.delete(np.delete(RXYZ, j, axis=0), j, axis=1)
-            RYZ_det = np.linalg.det(RYZ)
-            RZ = RYZ[:-1, :-1]
-            RZ_det = np.linalg.det(RZ)
-            CEM[i, j] = 1/2 * np.log(RYZ_det) - 1/2*np.log(RZ_det) - 1/2*np.log(RXYZ_det) + 1/2*np.log(RXZ_det)
-    return CEM
+# The CG Library [x, y, z, x^2, xy, xz]: monomials up to degree 2, at most linear in the hidden y, z
+libCG = PolyLibrary([0, 1, 2], hidden=[1, 2], degree=2, names=["x", "y", "z"])
 train_u_dot = torch.diff(train_u, dim=0)/dt
-train_LibCG = torch.stack([train_u[:, 0], train_u[:, 1], train_u[:, 2],
-                           train_u[:, 0]**2, train_u[:, 0]*train_u[:, 1], train_u[:, 0]*train_u[:, 2]]).T[:-1]
-CEM = cem(train_LibCG.numpy(), train_u_dot.numpy())
+train_LibCG = libCG(train_u.numpy())[:-1]
+CEM = cem(train_LibCG, train_u_dot.numpy())
 
 CEM.round(3)
 
@@ -0,0 +1,2 @@
+# Shared tools for the CGNSDE experiment scripts (L84, L96, L96Inhomo, PSBSE).
+# The scripts import from this package, so run them with the repository root on the python path.
@@ -0,0 +1,510 @@
+import os
+import numpy as np
+import torch
+
+from cgnsde.metrics import neg_log_likehood
+from cgnsde.parallel import map_jobs
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+#####################################################################
+################# Ensemble Kalman-Bucy Filter (EnKBF)  ##############
+#####################################################################
+# Reference filter for the hidden variables u2 given the observed u1, with the ensemble u2_ens (J, p), or (R, J, p) for R
+# independent repeats advanced together, by
+#     du2 = f dt + sig2 dW2 - 1/2 ((g + g_bar) dt - 2 du1) (CCOV inv(sig1 sig1.T)).T,   CCOV = cov(u2, g),
+# where f, g are the tendencies of u2 and u1 of every member. The tendency of the whole ensemble is one vectorized call
+# per step, the constant inverse is computed once, and the moments of all steps come from one batched einsum.
+# The noise of a block of steps is drawn at once; the legacy generators (np.random, RandomState) produce the same stream
+# as one rng.randn(J, p) per step, so the same seed gives the same ensemble as the step-by-step loop.
+# With small ensembles, the sampled CCOV carries spurious far-field correlations and the spread collapses. Localization
+# multiplies CCOV entrywise by a taper of the distance between hidden and observed sites (e.g. Gaspari-Cohn on the L96
+# ring, ring_localization); multiplicative inflation scales the anomalies by (1 + inflation dt) at every step, and
+# additive inflation adds noise of covariance additive * I dt to the hidden dynamics.
+# For the Lorenz-96 systems (L96Tendency), the steps of a noise block run in one compiled loop (numba) that fuses the
+# tendency, the moments, CCOV and the DA term of every member, so the per-step cost is a few small matrix products
+# instead of a dozen numpy calls; without numba, or for any other tendency, each step is one vectorized _enkbf_step.
+# The compiled steps then cost less than the legacy draws of their noise (a np.random.Generator draws faster).
+
+def l96_tendency(u, F, c=1.):
+    """
+    Lorenz-96 tendency -c u_i + (u_{i+1} - u_{i-2}) u_{i-1} + F on the ring, for all members at once via shifted arrays.
+    :param u: np.ndarray(..., J, I); States of the members
+    :param F: float; Forcing
+    :param c: float or np.ndarray(I); Damping (per site for the inhomogeneous system)
+    :return: np.ndarray(..., J, I)
+    """
+    # u_pad[..., k] = u[..., k-2] with the periodic wrap, so u_{i+k} = u_pad[..., i+2+k]
+    u_pad = np.concatenate([u[..., -2:], u, u[..., :1]], axis=-1)
+    u_m1 = u_pad[..., 1:-2]
+    return -c*u + u_pad[..., 3:]*u_m1 - u_pad[..., :-3]*u_m1 + F
+
+
+def model_tendency(model, dtype=torch.float32, device="cpu"):
+    """
+    Full-state tendency of a learned torch drift model (e.g. RegModel, MixModel, NNModel of the scripts), to be used with
+    split_tendency: all members (and repeats) are evaluated in one forward call model(None, u) under inference mode.
+    :param model: callable; model(t, u) returns du/dt for a batch u (N, dim)
+    :param dtype: torch.dtype; Dtype of the model parameters
+    :return: callable; full_tendency(u) for the states u (..., J, dim), in float64
+    """
+    def full_tendency(u):
+        with torch.inference_mode():
+            u_dot = model(None, torch.as_tensor(u.reshape(-1, u.shape[-1]), dtype=dtype, device=device))
+        return u_dot.cpu().numpy().astype(np.float64).reshape(u.shape)
+
+    return full_tendency
+
+
+def _as_index(indices):
+    # Evenly spaced indices as a slice (basic indexing avoids the copies of fancy indexing)
+    indices = np.asarray(indices)
+    if len(indices) > 1:
+        step = indices[1] - indices[0]
+        if step > 0 and np.all(np.diff(indices) == step):
+            return slice(int(indices[0]), int(indices[-1])+1, int(step))
+    return indices
+
+
+def split_tendency(full_tendency, indices_u1, indices_u2):
+    """
+    Tendency in the form needed by EnKBF from a tendency of the full state.
+    :param full_tendency: callable; full_tendency(u) returns du/dt of the states u (..., J, dim)
+    :return: callable; tendency(u1, u2) returning (g (..., J, d1), f (..., J, p)) for u1 (d1) and the ensemble u2 (..., J, p)
+    """
+    dim = len(indices_u1) + len(indices_u2)
+    idx1, idx2 = _as_index(indices_u1), _as_index(indices_u2)
+
+    def tendency(u1, u2):
+        u = np.empty(u2.shape[:-1] + (dim,))
+        u[..., idx1] = u1
+        u[..., idx2] = u2
+        u_dot = full_tendency(u)
+        return (u_dot[..., idx1], u_dot[..., idx2])
+
+    return tendency
+
+
+class L96Tendency:
+    """
+    Lorenz-96 tendency split into the observed (u1) and hidden (u2) sites, in the form needed by EnKBF; same results as
+    split_tendency(lambda u: l96_tendency(u, F, c), indices_u1, indices_u2), and recognized by the EnKBF tools, which
+    then advance the ensemble with the compiled L96 step loop.
+    :param F: float; Forcing
+    :param indices_u1: list; Sites of u1
+    :param indices_u2: list; Sites of u2
+    :param c: float or np.ndarray(I); Damping (per site for the inhomogeneous system)
+    """
+    def __init__(self, F, indices_u1, indices_u2, c=1.):
+        self.F = float(F)
+        self.indices_u1 = np.asarray(indices_u1, dtype=np.int64)
+        self.indices_u2 = np.asarray(indices_u2, dtype=np.int64)
+        I = len(self.indices_u1) + len(self.indices_u2)
+        self.c = np.broadcast_to(np.asarray(c, dtype=np.float64), (I,)).copy()
+        self._split = split_tendency(lambda u: l96_tendency(u, self.F, self.c), self.indices_u1, self.indices_u2)
+
+    def __call__(self, u1, u2):
+        return self._split(u1, u2)
+
+
+def gaspari_cohn(z):
+    """
+    Gaspari-Cohn fifth-order taper, compactly supported on z < 2.
+    :param z: np.ndarray; Distances in units of the localization half-width
+    :return: np.ndarray; Taper in [0, 1], 1 at z = 0
+    """
+    z = np.abs(np.asarray(z, dtype=np.float64))
+    near = z <= 1
+    far = (z > 1) & (z < 2)
+    rho = np.zeros_like(z)
+    zn = z[near]
+    rho[near] = -zn**5/4 + zn**4/2 + 5*zn**3/8 - 5*zn**2/3 + 1
+    zf = z[far]
+    rho[far] = zf**5/12 - zf**4/2 + 5*zf**3/8 + 5*zf**2/3 - 5*zf + 4 - 2/(3*zf)
+    return rho
+
+
+def ring_localization(indices_u2, indices_u1, I, radius):
+    """
+    Localization of CCOV for variables on a ring of I sites (L96): Gaspari-Cohn taper of the periodic site distances.
+    :param radius: float; Half-width of the taper in sites (correlations beyond 2*radius are removed)
+    :return: np.ndarray(p, d1)
+    """
+    d = np.abs(np.asarray(indices_u2)[:, None] - np.asarray(indices_u1)[None, :])
+    d = np.minimum(d, I-d)
+    return gaspari_cohn(d / radius)
+
+
+def _noise_amplitude(sig2, additive):
+    # Amplitude whose noise z @ amplitude has the covariance sig2.T sig2 + additive * I
+    if not additive:
+        return sig2
+    return np.linalg.cholesky(sig2.T @ sig2 + additive*np.eye(sig2.shape[0])).T
+
+
+def _normal_block(rng, steps, shape):
+    # Standard normal draws of the next steps (steps, ..., J, p); a list of sources gives one stream per repeat
+    if isinstance(rng, (list, tuple)):
+        return np.stack([r.standard_normal((steps,) + shape[1:]) for r in rng], axis=1)
+    return rng.standard_normal((steps,) + shape)
+
+
+def _is_diagonal(sig2):
+    return np.count_nonzero(sig2 - np.diag(np.diagonal(sig2))) == 0
+
+
+def _scale_noise(z, sig2, dt):
+    # Noise z @ sig2 * sqrt(dt); for a diagonal amplitude, the scaling gives the same values as the product
+    if _is_diagonal(sig2):
+        return z * np.diagonal(sig2) * np.sqrt(dt)
+    return z @ sig2 * np.sqrt(dt)
+
+
+def _enkbf_step(tendency, u1, du1, u2, noise, dt, inv_SIG1, localization=None, inflation=0.):
+    # One EnKBF step of the ensemble u2 (..., J, p) given u1 at the step and the increment du1 to the next one
+    J = u2.shape[-2]
+    g, f = tendency(u1, u2)
+    g_bar = g.sum(axis=-2, keepdims=True) / J
+    CCOV = np.swapaxes(u2 - u2.sum(axis=-2, keepdims=True) / J, -1, -2) @ (g - g_bar) / (J-1)
+    if localization is not None:
+        CCOV = CCOV * localization
+    Sys_term = f*dt + noise
+    DA_term = -0.5*((g+g_bar)*dt-2*du1) @ np.swapaxes(CCOV@inv_SIG1, -1, -2)
+    u2 = u2 + Sys_term + DA_term
+    if inflation:
+        u2_bar = u2.sum(axis=-2, keepdims=True) / J
+        u2 = u2_bar + (1 + inflation*dt)*(u2 - u2_bar)
+    return u2
+
+
+def _l96_steps_loop(u1, du1, u2, z, out, dt, sig2, diagonal, inv_SIG1, localization, inflation, F, c, idx1, idx2):
+    # Steps of the L96 ensembles u2 (R, J, p) for the standard normal draws z (steps, R, J, p), written to out
+    # (steps, R, J, p); same operations as _scale_noise and _enkbf_step with L96Tendency, the tendency evaluated on the
+    # padded ring u_pad[:, i+2] = u[:, i] and the products in preallocated buffers
+    R, J, p = u2.shape
+    d1 = idx1.shape[0]
+    I = c.shape[0]
+    sqrt_dt = np.sqrt(dt)
+    u_pad = np.empty((J, I+3))
+    u_dot = np.empty((J, I))
+    g = np.empty((J, d1))
+    innov = np.empty((J, d1))
+    anomalies = np.empty((p, J))
+    CCOV = np.empty((p, d1))
+    gain = np.empty((p, d1))
+    gain_T = np.empty((d1, p))
+    noise = np.empty((J, p))
+    DA_term = np.empty((J, p))
+    g_bar = np.empty(d1)
+    u2_bar = np.empty(p)
+    for s in range(z.shape[0]):
+        for r in range(R):
+            ens = u2[r] if s == 0 else out[s-1, r]
+            new = out[s, r]
+            for j in range(J):
+                for k in range(d1):
+                    u_pad[j, idx1[k]+2] = u1[s, k]
+                for k in range(p):
+                    u_pad[j, idx2[k]+2] = ens[j, k]
+                u_pad[j, 0] = u_pad[j, I]
+                u_pad[j, 1] = u_pad[j, I+1]
+                u_pad[j, I+2] = u_pad[j, 2]
+                for i in range(I):
+                    u_dot[j, i] = -c[i]*u_pad[j, i+2] + u_pad[j, i+3]*u_pad[j, i+1] - u_pad[j, i]*u_pad[j, i+1] + F
+            g_bar[:] = 0.
+            u2_bar[:] = 0.
+            for j in range(J):
+                for k in range(d1):
+                    g[j, k] = u_dot[j, idx1[k]]
+                    g_bar[k] += g[j, k]
+                for k in range(p):
+                    u2_bar[k] += ens[j, k]
+            g_bar /= J
+            u2_bar /= J
+            for j in range(J):
+                for k in range(d1):
+                    innov[j, k] = (g[j, k] + g_bar[k])*dt - 2*du1[s, k]
+                    g[j, k] -= g_bar[k]
+                for k in range(p):
+                    anomalies[k, j] = ens[j, k] - u2_bar[k]
+            # CCOV inv(SIG1) and the DA term -1/2 innov (CCOV inv(SIG1)).T
+            np.dot(anomalies, g, CCOV)
+            for k in range(p):
+                for l in range(d1):
+                    CCOV[k, l] = CCOV[k, l] / (J-1) * localization[k, l]
+            np.dot(CCOV, inv_SIG1, gain)
+            for k in range(p):
+                for l in range(d1):
+                    gain_T[l, k] = gain[k, l]
+            np.dot(innov, gain_T, DA_term)
+            if diagonal:
+                for j in range(J):
+                    for k in range(p):
+                        noise[j, k] = z[s, r, j, k] * sig2[k, k] * sqrt_dt
+            else:
+                np.dot(z[s, r], sig2, noise)
+                noise *= sqrt_dt
+            for j in range(J):
+                for k in range(p):
+                    new[j, k] = ens[j, k] + (u_dot[j, idx2[k]]*dt + noise[j, k]) - 0.5*DA_term[j, k]
+            if inflation != 0.:
+                for k in range(p):
+                    mean = 0.
+                    for j in range(J):
+                        mean += new[j, k]
+                    mean /= J
+                    for j in range(J):
+                        new[j, k] = mean + (1 + inflation*dt)*(new[j, k] - mean)
+
+
+if numba is not None:
+    _l96_steps_numba = numba.njit(cache=True)(_l96_steps_loop)
+
+
+def _enkbf_steps(tendency, u1, du1, u2, z, out, dt, sig2, inv_SIG1, localization=None, inflation=0.):
+    # Steps of the ensemble u2 (..., J, p) for the standard normal draws z (steps, ..., J, p) given u1 and du1 at the
+    # steps, written to out (steps, ..., J, p); one compiled loop for L96Tendency, one _enkbf_step per step otherwise
+    steps = z.shape[0]
+    if numba is not None and isinstance(tendency, L96Tendency):
+        shape = (steps, -1) + u2.shape[-2:]
+        p, d1 = u2.shape[-1], u1.shape[-1]
+        loc = np.ones((p, d1)) if localization is None else np.asarray(localization, dtype=np.float64)
+        _l96_steps_numba(np.ascontiguousarray(u1[:steps], dtype=np.float64),
+                         np.ascontiguousarray(du1[:steps], dtype=np.float64),
+                         np.ascontiguousarray(u2, dtype=np.float64).reshape(shape[1:]),
+                         np.ascontiguousarray(z).reshape(shape), out.reshape(shape), float(dt),
+                         np.ascontiguousarray(sig2, dtype=np.float64), _is_diagonal(sig2), inv_SIG1, loc,
+                         float(inflation), tendency.F, tendency.c, tendency.indices_u1, tendency.indices_u2)
+        return out
+    noise = _scale_noise(z, sig2, dt)
+    for s in range(steps):
+        u2 = out[s] = _enkbf_step(tendency, u1[s], du1[s], u2, noise[s], dt, inv_SIG1, localization, inflation)
+    return out
+
+
+def EnKBF(tendency, u1, u2_0, dt, sig1, sig2, rng=np.random, block_size=1000, localization=None, inflation=0., additive=0.):
+    """
+    :param tendency: callable; tendency(u1, u2) returns (g (J, d1), f (J, p)), see split_tendency
+    :param u1: np.ndarray(Nt, d1); Observed variables
+    :param u2_0: np.ndarray(J, p) or np.ndarray(R, J, p); Initial ensemble (of every repeat)
+    :param dt: float; Time step
+    :param sig1: np.ndarray(d1, d1); Noise amplitude of u1
+    :param sig2: np.ndarray(p, p); Noise amplitude of u2
+    :param rng: np.random, np.random.RandomState or np.random.Generator; Source of the noise (rng.standard_normal),
+                or a list of R sources (one stream per repeat)
+    :param block_size: int; Number of steps whose noise is drawn at once
+    :param localization: np.ndarray(p, d1); Entrywise taper of CCOV, e.g. ring_localization (None: no localization)
+    :param inflation: float; Rate of the multiplicative inflation of the anomalies
+    :param additive: float; Variance rate of the additive inflation noise
+    :return: np.ndarray(J, Nt, p) or np.ndarray(R, J, Nt, p); Ensemble at all steps (a view of time-major storage)
+    """
+    Nt = u1.shape[0]
+    inv_SIG1 = np.linalg.inv(sig1 @ sig1.T)
+    sig2 = _noise_amplitude(sig2, additive)
+    # Stored time-major so that the ensemble of a step is contiguous
+    u2_ens = np.empty((Nt,) + u2_0.shape)
+    u2_ens[0] = u2_0
+    du1 = np.diff(u1, axis=0)
+    for n in range(1, Nt, block_size):
+        z = _normal_block(rng, min(block_size, Nt-n), u2_0.shape)
+        _enkbf_steps(tendency, u1[n-1:], du1[n-1:], u2_ens[n-1], z, u2_ens[n:n+z.shape[0]], dt, sig2, inv_SIG1,
+                     localization, inflation)
+    return np.moveaxis(u2_ens, 0, -2)
+
+
+def ensemble_moments(u2_ens):
+    """
+    :param u2_ens: np.ndarray(..., J, Nt, p); Ensemble at all steps (of every repeat)
+    :return: tuple; (mu_trace (..., Nt, p, 1), R_trace (..., Nt, p, p)) ensemble means and sample covariances
+    """
+    J = u2_ens.shape[-3]
+    mu = np.mean(u2_ens, axis=-3)
+    anomalies = u2_ens - mu[..., None, :, :]
+    R_trace = np.einsum("...jnp,...jnq->...npq", anomalies, anomalies, optimize=True) / (J-1)
+    return (mu[..., None], R_trace)
+
+
+#####################################################
+################# Streaming EnKBF  ##################
+#####################################################
+# EnKBF stores the whole ensemble history (J, Nt, p), which is only needed for the moments afterwards. StreamingEnKBF
+# keeps only the current ensemble; the ensemble moments of each chunk of observations are handed to the same reducers as
+# the StreamingCGFilter (cgnsde.filter.RunningMSE, RunningNLL, RunningSkill, TraceWriter for full, variance-only or
+# decimated traces), and full ensembles are kept only at the steps requested by EnsembleSnapshots.
+
+class EnsembleSnapshots:
+    # Keeps the full ensemble (J, p) at the steps n % every == 0, in memory or as path/ens_{n}.npy files
+    def __init__(self, every, path=None):
+        self.every = every
+        self.path = path
+        self.n_lst = []
+        self.ens_lst = []
+
+    def update(self, n, ens):
+        for i in np.flatnonzero(n % self.every == 0):
+            self.n_lst.append(int(n[i]))
+            if self.path is None:
+                self.ens_lst.append(ens[i].copy())
+            else:
+                np.save(os.path.join(self.path, "ens_{}.npy".format(n[i])), ens[i])
+
+    def result(self):
+        # (n (K,), ensembles (K, J, p)); with path, the ensembles are in the files instead
+        return (np.array(self.n_lst), np.array(self.ens_lst) if self.path is None else None)
+
+
+class StreamingEnKBF:
+    """
+    EnKBF that is fed with the observations u1 one at a time (update) or in chunks (extend, run), keeping only the
+    current ensemble, so memory is O(J p) (times the chunk length) regardless of the record length. Feeding the series
+    u1 of EnKBF in any chunking draws the same noise stream and gives the same ensembles.
+    """
+    def __init__(self, tendency, u2_0, dt, sig1, sig2, rng=np.random, cut_point=0, reducers=(), snapshots=None,
+                 localization=None, inflation=0., additive=0.):
+        """
+        :param tendency: callable; tendency(u1, u2) returns (g (J, d1), f (J, p)), see split_tendency
+        :param u2_0: np.ndarray(J, p); Ensemble at the first observation
+        :param dt: float; Time step
+        :param sig1: np.ndarray(d1, d1); Noise amplitude of u1
+        :param sig2: np.ndarray(p, p); Noise amplitude of u2
+        :param rng: np.random, np.random.RandomState or np.random.Generator; Source of the noise
+        :param cut_point: int; Number of leading (spin-up) steps not passed to the reducers
+        :param reducers: list; Objects with update(n, mu, R, u2), see cgnsde.filter.RunningMSE, RunningNLL, TraceWriter
+        :param snapshots: EnsembleSnapshots; Keeps the full ensemble at some steps
+        :param localization, inflation, additive: Same as for EnKBF
+        """
+        self.tendency = tendency
+        self.ens = np.array(u2_0, dtype=np.float64)
+        self.dt = dt
+        self.sig2 = _noise_amplitude(sig2, additive)
+        self.localization = localization
+        self.inflation = inflation
+        self.inv_SIG1 = np.linalg.inv(sig1 @ sig1.T)
+        self.rng = rng
+        self.cut_point = cut_point
+        self.reducers = list(reducers)
+        self.snapshots = snapshots
+        self.u1_last = None
+        self.n = -1  # Step index of the current ensemble
+
+    def extend(self, u1, u2=None):
+        """
+        Assimilate the next k observations.
+        :param u1: np.ndarray(k, d1); New observations
+        :param u2: np.ndarray(k, p); True hidden states at the same steps (only needed by RunningMSE, RunningNLL, RunningSkill)
+        :return: np.ndarray(J, p); Current ensemble
+        """
+        window = u1 if self.u1_last is None else np.concatenate([self.u1_last[None], u1])
+        steps = window.shape[0] - 1
+        ens_block = np.empty((u1.shape[0],) + self.ens.shape)
+        first = u1.shape[0] - steps
+        if first:
+            ens_block[0] = self.ens
+        if steps > 0:
+            z = _normal_block(self.rng, steps, self.ens.shape)
+            _enkbf_steps(self.tendency, window, np.diff(window, axis=0), self.ens, z, ens_block[first:], self.dt,
+                         self.sig2, self.inv_SIG1, self.localization, self.inflation)
+            self.ens = ens_block[-1].copy()
+        n = np.arange(self.n+1, self.n+1+u1.shape[0])
+
+        keep = n >= self.cut_point
+        if keep.any() and self.reducers:
+            start = int(np.argmax(keep))
+            mu, R = ensemble_moments(np.moveaxis(ens_block[start:], 0, -2))
+            u2_tsr = None if u2 is None else torch.as_tensor(np.asarray(u2, dtype=np.float64)[start:, :, None])
+            for reducer in self.reducers:
+                reducer.update(n[start:], torch.from_numpy(mu), torch.from_numpy(R), u2_tsr)
+        if self.snapshots is not None:
+            self.snapshots.update(n, ens_block)
+
+        self.u1_last = np.asarray(u1[-1])
+        self.n = int(n[-1])
+        return self.ens
+
+    def update(self, u1_new, u2_new=None):
+        # Single observation u1_new (d1), e.g. from live data
+        return self.extend(u1_new[None], None if u2_new is None else u2_new[None])
+
+    def run(self, u1, u2=None, chunk_size=100):
+        # Stream a stored series (Nt, d1) through the filter chunk by chunk
+        for i in range(0, u1.shape[0], chunk_size):
+            self.extend(u1[i:i+chunk_size], None if u2 is None else u2[i:i+chunk_size])
+        return self.ens
+
+
+#####################################################
+################# Repeated Runs  ####################
+#####################################################
+# The skill of the EnKBF is averaged over many independent runs. All repeats (or a chunk of them) advance together as one
+# (R, J, p) ensemble, and only the running squared error and NLL of every repeat are kept, so the memory does not grow
+# with the record length. Repeat r draws its noise from its own stream (child r of np.random.SeedSequence(seed)), so the
+# result does not depend on how the repeats are split into chunks and worker processes.
+
+def _repeat_chunk(job, i):
+    streams = job["streams"][i*job["chunk_size"]:(i+1)*job["chunk_size"]]
+    rng = [np.random.default_rng(s) for s in streams]
+    u1, u2, dt = job["u1"], job["u2"], job["dt"]
+    Nt, p = u2.shape
+    block_size = job["block_size"]
+    inv_SIG1 = np.linalg.inv(job["sig1"] @ job["sig1"].T)
+    sig2 = _noise_amplitude(job["sig2"], job["additive"])
+    du1 = np.diff(u1, axis=0)
+    ens = np.broadcast_to(job["u2_0"], (len(rng), job["J"], p)).copy()
+    sq_err = np.sum((u2[0] - np.mean(ens, axis=1))**2, axis=1)
+    nll = np.zeros(len(rng))
+    ens_block = np.empty((block_size,) + ens.shape)
+    for n in range(1, Nt, block_size):
+        z = _normal_block(rng, min(block_size, Nt-n), ens.shape)
+        steps = z.shape[0]
+        block = _enkbf_steps(job["tendency"], u1[n-1:], du1[n-1:], ens, z, ens_block[:steps], dt, sig2, inv_SIG1,
+                             job["localization"], job["inflation"])
+        ens = block[-1].copy()
+        # Moments and NLL of all steps and repeats of the block at once, on the time-major block (steps, R, J, p)
+        mu = np.mean(block, axis=2)
+        anomalies = block - mu[:, :, None]
+        R = np.swapaxes(anomalies, -1, -2) @ anomalies / (job["J"]-1)
+        sq_err += np.sum((u2[n:n+steps, None] - mu)**2, axis=(0, 2))
+        x = np.broadcast_to(u2[n:n+steps, None, :, None], mu.shape + (1,)).reshape(-1, p, 1)
+        nll += neg_log_likehood(torch.from_numpy(x.copy()), torch.from_numpy(mu.reshape(-1, p, 1)),
+                                torch.from_numpy(R.reshape(-1, p, p))).numpy().reshape(steps, len(rng)).sum(axis=0)
+    # As in the scripts: MSE over all steps, NLL over the steps after the initial (degenerate) ensemble
+    return (sq_err / (Nt*p), nll / (Nt-1))
+
+
+def enkbf_repeats(tendency, u1, u2, J, repeats, dt, sig1, sig2, u2_0=None, seed=0, chunk_size=None, processes=1,
+                  block_size=50, localization=None, inflation=0., additive=0.):
+    """
+    Skill of R independent EnKBF runs against the true hidden variables, e.g. for the 100-repeat statistics of the scripts.
+    :param tendency: callable; tendency(u1, u2) returns (g (..., J, d1), f (..., J, p)), see split_tendency
+    :param u1: np.ndarray(Nt, d1); Observed variables
+    :param u2: np.ndarray(Nt, p); True hidden variables
+    :param J: int; Ensemble size
+    :param repeats: int; Number R of independent runs
+    :param dt: float; Time step
+    :param sig1: np.ndarray(d1, d1); Noise amplitude of u1
+    :param sig2: np.ndarray(p, p); Noise amplitude of u2
+    :param u2_0: np.ndarray(p) or np.ndarray(J, p); Initial ensemble (default: zeros)
+    :param seed: int; Seed of the repeat streams
+    :param chunk_size: int; Number of repeats advanced together (default: all, split evenly over the worker processes);
+                       lower it when memory is tight
+    :param processes: int; Number of forked worker processes over the chunks (None: all CPU cores), see cgnsde.parallel
+    :param block_size: int; Number of steps whose noise is drawn at once
+    :param localization, inflation, additive: Same as for EnKBF
+    :return: dict; {"mse" (R), "nll" (R)} MSE and average NLL of the posterior mean/covariance of every run
+    """
+    if chunk_size is None:
+        workers = os.cpu_count() if processes is None else processes
+        chunk_size = -(-repeats // max(workers, 1))
+    n_chunks = -(-repeats // chunk_size)
+    u2 = np.asarray(u2, dtype=np.float64)
+    job = dict(tendency=tendency, u1=np.asarray(u1), u2=u2, J=J, dt=dt, sig1=sig1, sig2=sig2,
+               u2_0=np.zeros(u2.shape[1]) if u2_0 is None else u2_0, streams=np.random.SeedSequence(seed).spawn(repeats),
+               chunk_size=chunk_size, block_size=block_size, localization=localization, inflation=inflation,
+               additive=additive)
+    results = list(map_jobs(_repeat_chunk, job, range(n_chunks), processes))
+    mse, nll = zip(*results)
+    return {"mse": np.concatenate(mse), "nll": np.concatenate(nll)}
@@ -0,0 +1,359 @@
+import numpy as np
+import torch
+
+from cgnsde import metrics
+
+
+class FilterStateCache:
+    """
+    Detached CGFilter posteriors (mu, R) along the training trajectory, kept across Stage-2 epochs.
+    A DA window whose head index has a fresh cached state starts from it and only needs a short spin-up,
+    instead of filtering from mu0 = 0, R0 = 0.01 I and discarding the first cut_point steps.
+    Cached states are written by the model of the epoch that filtered them, so entries older than
+    max_age epochs are dropped. Head indices are drawn uniformly and the window is filtered cold whenever the
+    drawn head has no fresh state, and in any case every refresh_every epochs (periodic refresh), so warm windows
+    cannot keep chaining off each other and the whole record stays in the DA loss.
+    """
+    def __init__(self, Nt, dim_u2, max_age=20, refresh_every=10, device="cpu"):
+        """
+        :param Nt: int; Length of the training trajectory
+        :param dim_u2: int; Dimension of the unobserved variables
+        :param max_age: int; Number of epochs a cached state stays valid
+        :param refresh_every: int; Every refresh_every-th epoch runs a cold window
+        """
+        self.max_age = max_age
+        self.refresh_every = refresh_every
+        self.mu_trace = torch.zeros((Nt, dim_u2, 1), device=device)
+        self.R_trace = torch.zeros((Nt, dim_u2, dim_u2), device=device)
+        self.stamp = np.full(Nt, -np.inf)
+
+    def valid(self, ep):
+        return ep - self.stamp < self.max_age
+
+    def sample_head(self, ep, max_idx):
+        # Uniform random head index in [0, max_idx]; None (cold window) if it has no fresh cached state or a
+        # refresh is due
+        if ep % self.refresh_every == 0:
+            return None
+        idx = np.random.randint(max_idx+1)
+        if not self.valid(ep)[idx]:
+            return None
+        return idx
+
+    def lookup(self, idx, ep):
+        if not self.valid(ep)[idx]:
+            return None
+        return (self.mu_trace[idx].clone(), self.R_trace[idx].clone())
+
+    def store(self, start_idx, mu_trace, R_trace, ep):
+        # mu_trace, R_trace are CGFilter outputs (after spin-up) starting at trajectory index start_idx
+        Nt = mu_trace.shape[0]
+        self.mu_trace[start_idx:start_idx+Nt] = mu_trace.detach()
+        self.R_trace[start_idx:start_idx+Nt] = R_trace.detach()
+        self.stamp[start_idx:start_idx+Nt] = ep
+
+
+####################################################
+################# CGFilter Engine  #################
+####################################################
+# All CGNSDE models share the conditional Gaussian structure
+#     du1 = (f1 + g1 u2) dt + s1 dW1,    du2 = (f2 + g2 u2) dt + s2 dW2,
+# where f1, g1, s1, f2, g2, s2 only depend on the observed u1. The coefficients of a whole record are therefore
+# evaluated in one batched call of the model, and only the small mean/covariance recursion below runs step by step.
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _cg_recursion_numpy(innov0, g1, f2, g2, G, H, s2os2, mu0, R0, dt):
+    # innov0 = du1 - f1*dt, G = g1.T @ inv(s1 s1.T), H = G @ g1; all stacked over the Nt-1 steps
+    Nt = innov0.shape[0] + 1
+    mu_trace = np.zeros((Nt,) + mu0.shape, dtype=mu0.dtype)
+    R_trace = np.zeros((Nt,) + R0.shape, dtype=R0.dtype)
+    mu_trace[0] = mu0
+    R_trace[0] = R0
+    for n in range(Nt-1):
+        mu0 = mu_trace[n]
+        R0 = R_trace[n]
+        mu_trace[n+1] = mu0 + (f2[n]+g2[n]@mu0)*dt + R0 @ (G[n] @ (innov0[n] - g1[n]@mu0*dt))
+        R_trace[n+1] = R0 + (g2[n]@R0 + R0@np.ascontiguousarray(g2[n].T) + s2os2[n] - R0@H[n]@R0)*dt
+    return (mu_trace, R_trace)
+
+
+def _cg_adjoint_numpy(innov0, g1, f2, g2, G, H, mu_trace, R_trace, grad_mu, grad_R, dt):
+    # Reverse sweep of _cg_recursion_numpy: gradients w.r.t. all step inputs and (mu0, R0)
+    N = innov0.shape[0]
+    d_innov0 = np.zeros_like(innov0)
+    d_g1 = np.zeros_like(g1)
+    d_f2 = np.zeros_like(f2)
+    d_g2 = np.zeros_like(g2)
+    d_G = np.zeros_like(G)
+    d_H = np.zeros_like(H)
+    d_s2os2 = np.zeros_like(H)
+    a = grad_mu[N].copy()
+    A = grad_R[N].copy()
+    for n in range(N-1, -1, -1):
+        mu = mu_trace[n]
+        R = R_trace[n]
+        RT = np.ascontiguousarray(R.T)
+        v = innov0[n] - g1[n]@mu*dt
+        w = G[n]@v
+        RTa = RT@a
+        GTRTa = np.ascontiguousarray(G[n].T)@RTa
+        d_f2[n] = a*dt
+        d_g2[n] = (a@np.ascontiguousarray(mu.T) + A@RT + np.ascontiguousarray(A.T)@R)*dt
+        d_G[n] = RTa@np.ascontiguousarray(v.T)
+        d_innov0[n] = GTRTa
+        d_g1[n] = -dt*GTRTa@np.ascontiguousarray(mu.T)
+        d_H[n] = -dt*RT@A@RT
+        d_s2os2[n] = A*dt
+        g2T = np.ascontiguousarray(g2[n].T)
+        HT = np.ascontiguousarray(H[n].T)
+        a_prev = a + dt*(g2T@a) - dt*(np.ascontiguousarray(g1[n].T)@GTRTa) + grad_mu[n]
+        A_prev = A + dt*(g2T@A + A@g2[n] - A@RT@HT - HT@RT@A) + a@np.ascontiguousarray(w.T) + grad_R[n]
+        a = a_prev
+        A = A_prev
+    return (d_innov0, d_g1, d_f2, d_g2, d_G, d_H, d_s2os2, a, A)
+
+
+if numba is not None:
+    _cg_recursion_numba = numba.njit(cache=True)(_cg_recursion_numpy)
+    _cg_adjoint_numba = numba.njit(cache=True)(_cg_adjoint_numpy)
+
+
+def _cg_recursion_torch(innov0, g1, f2, g2, G, H, s2os2, mu0, R0, dt):
+    mu_lst = [mu0]
+    R_lst = [R0]
+    for n in range(innov0.shape[0]):
+        mu1 = mu0 + (f2[n]+g2[n]@mu0)*dt + R0 @ (G[n] @ (innov0[n] - g1[n]@mu0*dt))
+        R1 = R0 + (g2[n]@R0 + R0@g2[n].T + s2os2[n] - R0@H[n]@R0)*dt
+        mu_lst.append(mu1)
+        R_lst.append(R1)
+        mu0 = mu1
+        R0 = R1
+    return (torch.stack(mu_lst), torch.stack(R_lst))
+
+
+def _to_numpy(*tensors):
+    return [np.ascontiguousarray(x.detach().cpu().numpy()) for x in tensors]
+
+
+class _CGRecursion(torch.autograd.Function):
+    # Compiled forward recursion with a compiled adjoint sweep as its backward, so the DA loss does not
+    # build an autograd graph of ~20 tiny ops per time step
+    @staticmethod
+    def forward(ctx, innov0, g1, f2, g2, G, H, s2os2, mu0, R0, dt):
+        arrays = _to_numpy(innov0, g1, f2, g2, G, H, s2os2, mu0, R0)
+        dt = arrays[0].dtype.type(dt)
+        mu_trace, R_trace = _cg_recursion_numba(*arrays, dt)
+        mu_trace = torch.from_numpy(mu_trace)
+        R_trace = torch.from_numpy(R_trace)
+        ctx.save_for_backward(innov0, g1, f2, g2, G, H, mu_trace, R_trace)
+        ctx.dt = dt
+        return (mu_trace, R_trace)
+
+    @staticmethod
+    def backward(ctx, grad_mu, grad_R):
+        innov0, g1, f2, g2, G, H, mu_trace, R_trace = ctx.saved_tensors
+        grad_mu = torch.zeros_like(mu_trace) if grad_mu is None else grad_mu
+        grad_R = torch.zeros_like(R_trace) if grad_R is None else grad_R
+        arrays = _to_numpy(innov0, g1, f2, g2, G, H, mu_trace, R_trace, grad_mu, grad_R)
+        grads = _cg_adjoint_numba(*arrays, ctx.dt)
+        return tuple(torch.from_numpy(x) for x in grads) + (None,)
+
+
+def _cg_recursion(coefs, mu0, R0, dt):
+    # Posteriors of steps 0..Nt-1 (including mu0, R0) from the precomputed coefficients of cg_coefficients()
+    mu0 = mu0.to(coefs[0].dtype)
+    R0 = R0.to(coefs[0].dtype)
+    if numba is not None and coefs[0].device.type == "cpu":
+        return _CGRecursion.apply(*coefs, mu0, R0, float(dt))
+    return _cg_recursion_torch(*coefs, mu0, R0, dt)
+
+
+def cg_coefficients(coef, u1, dt):
+    """
+    Evaluate the model coefficients of all steps and precompute everything in the update that does not depend on (mu, R).
+    :param coef: callable; coef(u1) returns (f1, g1, s1, f2, g2, s2) of the Nt-1 transitions u1[n-1] -> u1[n]
+    :param u1: torch.Tensor(Nt, d1, 1)
+    :param dt: float; Time step
+    :return: tuple; (innov0, g1, f2, g2, G, H, s2os2), each stacked over the Nt-1 steps
+    """
+    du1 = u1[1:] - u1[:-1]
+    N = du1.shape[0]
+    f1, g1, s1, f2, g2, s2 = coef(u1)
+    d1, d2 = g1.shape[-2:]
+    # s1, s2 may be constant (d, d) or stacked over time (N, d, d)
+    invs1os1 = torch.linalg.inv(s1@s1.mT)
+    s2os2 = (s2@s2.mT).expand(N, d2, d2)
+    g1 = g1.expand(N, d1, d2)
+    G = g1.mT @ invs1os1
+    H = G @ g1
+    return (du1 - f1*dt, g1, f2.expand(N, d2, 1), g2.expand(N, d2, d2), G, H, s2os2)
+
+
+def CGFilter(coef, u1, mu0, R0, cut_point, dt):
+    """
+    Conditional Gaussian filter shared by all systems.
+    On CPU with Numba installed, the recursion and (for the DA loss) its adjoint run as compiled loops;
+    otherwise it falls back to a plain torch loop.
+    :param coef: callable; coef(u1) returns (f1, g1, s1, f2, g2, s2) of the Nt-1 transitions u1[n-1] -> u1[n],
+                 with shapes f1 (Nt-1, d1, 1), g1 (Nt-1, d1, d2), f2 (Nt-1, d2, 1), g2 (Nt-1, d2, d2);
+                 g1, f2, g2 may also be shared by all steps (no time axis), and s1 (d1, d1), s2 (d2, d2) may be constant
+                 or stacked over time. The same coef serves cg_forecast, CGSampler, CGSmoother and
+                 StreamingCGFilter (which call it on sub-series of u1); the scripts build it from the trained model
+                 with cg_coef(model, sigma_lst)
+    :param u1: torch.Tensor(Nt, d1, 1); Observed variables
+    :param mu0: torch.Tensor(d2, 1); Initial posterior mean
+    :param R0: torch.Tensor(d2, d2); Initial posterior covariance
+    :param cut_point: int; Number of leading (spin-up) steps removed from the output
+    :param dt: float; Time step
+    :return: tuple; (mu_trace (Nt-cut_point, d2, 1), R_trace (Nt-cut_point, d2, d2))
+    """
+    mu_trace, R_trace = _cg_recursion(cg_coefficients(coef, u1, dt), mu0, R0, dt)
+    return (mu_trace[cut_point:], R_trace[cut_point:])
+
+
+####################################################
+################# Streaming CGFilter  ##############
+####################################################
+# CGFilter returns the whole (Nt, d2, d2) covariance trace. For long assimilation runs or live data, the
+# StreamingCGFilter below only keeps the current posterior; everything that is needed from the trace is
+# accumulated on the fly by reducers, each of which receives the posteriors block by block through
+#     reducer.update(n, mu, R, u2)
+# with n the step indices (k,), mu (k, d2, 1), R (k, d2, d2) and u2 (k, d2, 1) the true hidden states or None.
+
+class StreamingCGFilter:
+    """
+    Conditional Gaussian filter that is fed with the observations u1 one at a time (update) or in chunks (extend, run).
+    Feeding the series u1 of CGFilter in any chunking gives the same posteriors as CGFilter(coef, u1, mu0, R0, cut_point, dt),
+    with the coefficients only evaluated on the current chunk, so memory does not grow with the length of the run.
+    """
+    def __init__(self, coef, mu0, R0, dt, cut_point=0, reducers=()):
+        """
+        :param coef: callable; Same as for CGFilter; it is called on windows of consecutive observations
+        :param mu0: torch.Tensor(d2, 1); Posterior mean at the first observation
+        :param R0: torch.Tensor(d2, d2); Posterior covariance at the first observation
+        :param dt: float; Time step
+        :param cut_point: int; Number of leading (spin-up) steps not passed to the reducers
+        :param reducers: list; Objects with update(n, mu, R, u2), see RunningMSE, RunningNLL, RunningSkill, TraceWriter
+        """
+        self.coef = coef
+        self.mu = mu0
+        self.R = R0
+        self.dt = dt
+        self.cut_point = cut_point
+        self.reducers = list(reducers)
+        self.u1_last = None
+        self.n = -1  # Step index of the current posterior
+
+    def extend(self, u1, u2=None):
+        """
+        Assimilate the next k observations.
+        :param u1: torch.Tensor(k, d1, 1); New observations
+        :param u2: torch.Tensor(k, d2, 1); True hidden states at the same steps (only needed by RunningMSE, RunningNLL, RunningSkill)
+        :return: tuple; Current posterior (mu (d2, 1), R (d2, d2))
+        """
+        if self.u1_last is None:
+            window = u1
+        else:
+            window = torch.cat([self.u1_last.unsqueeze(0), u1])
+        if window.shape[0] > 1:
+            mu_trace, R_trace = _cg_recursion(cg_coefficients(self.coef, window, self.dt), self.mu, self.R, self.dt)
+        else:
+            mu_trace, R_trace = self.mu.unsqueeze(0), self.R.unsqueeze(0)
+        if self.u1_last is not None:
+            mu_trace, R_trace = mu_trace[1:], R_trace[1:]
+        n = np.arange(self.n+1, self.n+1+u1.shape[0])
+
+        keep = n >= self.cut_point
+        if keep.any():
+            start = int(np.argmax(keep))
+            for reducer in self.reducers:
+                reducer.update(n[start:], mu_trace[start:], R_trace[start:], None if u2 is None else u2[start:])
+
+        # The carried state is detached, so no autograd graph builds up over a long run
+        self.u1_last = u1[-1]
+        self.mu = mu_trace[-1].detach()
+        self.R = R_trace[-1].detach()
+        self.n = int(n[-1])
+        return (self.mu, self.R)
+
+    def update(self, u1_new, u2_new=None):
+        # Single observation u1_new (d1, 1), e.g. from live data
+        return self.extend(u1_new.unsqueeze(0), None if u2_new is None else u2_new.unsqueeze(0))
+
+    def run(self, u1, u2=None, chunk_size=1000):
+        # Stream a stored series (Nt, d1, 1) through the filter chunk by chunk
+        for i in range(0, u1.shape[0], chunk_size):
+            self.extend(u1[i:i+chunk_size], None if u2 is None else u2[i:i+chunk_size])
+        return (self.mu, self.R)
+
+
+class RunningMSE:
+    # Mean squared error of the posterior mean over all hidden variables and steps
+    def __init__(self):
+        self.sse = 0.
+        self.count = 0
+
+    def update(self, n, mu, R, u2):
+        if u2 is None:
+            raise ValueError("RunningMSE needs the true hidden states u2")
+        self.sse += torch.sum((u2-mu)**2).item()
+        self.count += u2.numel()
+
+    def result(self):
+        return self.sse / self.count
+
+
+class RunningNLL:
+    # Average Gaussian negative log-likelihood of the true hidden states under the posteriors (as avg_neg_log_likehood)
+    def __init__(self):
+        self.total = 0.
+        self.count = 0
+
+    def update(self, n, mu, R, u2):
+        if u2 is None:
+            raise ValueError("RunningNLL needs the true hidden states u2")
+        self.total += torch.sum(metrics.neg_log_likehood(u2, mu, R)).item()
+        self.count += u2.shape[0]
+
+    def result(self):
+        return self.total / self.count
+
+
+class RunningSkill:
+    # MSE, NLL, CRPS and +-2 sigma coverage at once, see metrics.SkillAccumulator
+    def __init__(self, diagonal=False):
+        self.acc = metrics.SkillAccumulator(diagonal=diagonal)
+
+    def update(self, n, mu, R, u2):
+        if u2 is None:
+            raise ValueError("RunningSkill needs the true hidden states u2")
+        self.acc.update(u2, mu, R)
+
+    def result(self):
+        return self.acc.result()
+
+
+class TraceWriter:
+    # Keeps every `every`-th posterior (steps n % every == 0), optionally only the variances instead of full covariances
+    def __init__(self, every=1, diagonal=False):
+        self.every = every
+        self.diagonal = diagonal
+        self.n_lst = []
+        self.mu_lst = []
+        self.R_lst = []
+
+    def update(self, n, mu, R, u2):
+        keep = n % self.every == 0
+        R = torch.diagonal(R, dim1=1, dim2=2) if self.diagonal else R
+        self.n_lst.append(n[keep])
+        self.mu_lst.append(mu[keep].detach())
+        self.R_lst.append(R[keep].detach())
+
+    def result(self):
+        # (n (K,), mu_trace (K, d2, 1), R_trace (K, d2, d2) or variances (K, d2))
+        return (np.concatenate(self.n_lst), torch.cat(self.mu_lst), torch.cat(self.R_lst))
@@ -0,0 +1,258 @@
+import numpy as np
+import torch
+import torchdiffeq
+
+from cgnsde.parallel import map_jobs
+from cgnsde.simulate import EnsembleSDESolver
+
+
+#############################################################
+################# Short-term Forecast Skill  ################
+#############################################################
+# Short-term skill is measured on forecasts of lead_steps steps started from the true states u[s] at the start points s.
+# All start points are stacked into one batch of initial conditions and integrated by one odeint call (optionally in
+# chunks of start points), the forecasts are written into a preallocated (S, lead_steps, dim) tensor and the matching
+# true windows are unfold views of u. With stride < lead_steps the windows overlap, so the skill is averaged over more
+# initial conditions at the cost of a larger batch instead of more solver calls.
+
+def forecast_windows(t, u, model, lead_steps, stride=None, chunk_size=None, **odeint_kwargs):
+    """
+    Deterministic forecasts of lead_steps steps from the start points 0, stride, 2*stride, ... of u.
+    :param t: torch.Tensor(t); Time points of u (t[:lead_steps] is used for every window, as the models are autonomous)
+    :param u: torch.Tensor(t, x); True states
+    :param model: callable; model(t, u) returns du/dt for a batch u (N, x)
+    :param lead_steps: int; Number of time steps of each forecast (including the initial state)
+    :param stride: int; Distance of the start points (default lead_steps: consecutive, non-overlapping windows)
+    :param chunk_size: int; Maximal number of start points per odeint call (default: all at once)
+    :param odeint_kwargs: Further arguments of torchdiffeq.odeint (method, rtol, atol, options)
+    :return: tuple; (u_pred (S, lead_steps, x) forecasts, u_true (S, lead_steps, x) view of the true windows)
+    """
+    stride = lead_steps if stride is None else stride
+    dim = u.shape[1]
+    u_true = u.unfold(0, lead_steps, stride).transpose(1, 2)
+    S = u_true.shape[0]
+    chunk_size = S if chunk_size is None else chunk_size
+    u_pred = torch.empty((S, lead_steps, dim), dtype=u.dtype, device=u.device)
+    with torch.no_grad():
+        for i in range(0, S, chunk_size):
+            u0 = u_true[i:i+chunk_size, 0]
+            u_pred[i:i+u0.shape[0]] = torchdiffeq.odeint(model, u0, t[:lead_steps], **odeint_kwargs).transpose(0, 1)
+    return (u_pred, u_true)
+
+
+def skill_curves(t, u, model, lead_steps, stride=1, chunk_size=1000, sigma_lst=None, members=20, generator=None, **odeint_kwargs):
+    """
+    Forecast skill as a function of lead time, from one rollout of lead_steps steps per start point (every lead time is
+    read off the same rollout). The start points are processed in chunks and only running sums are kept.
+    :param t: torch.Tensor(t); Time points of u
+    :param u: torch.Tensor(t, x); Test series
+    :param model: callable; model(t, u) returns du/dt for a batch u (N, x)
+    :param lead_steps: int; Number of time steps of the rollouts (lead times t[:lead_steps] - t[0])
+    :param stride: int; Distance of the start points
+    :param chunk_size: int; Number of start points per rollout batch
+    :param sigma_lst: list; Noise amplitudes: if given, every start point runs an Euler-Maruyama ensemble of `members`
+                      members (EnsembleSDESolver) and the ensemble mean is verified; otherwise a deterministic odeint forecast
+    :param members: int; Ensemble size per start point (with sigma_lst)
+    :param generator: torch.Generator; Random number generator of the ensembles
+    :return: dict; {"lead" (lead_steps), "rmse" (lead_steps, x), "corr" (lead_steps, x) correlation of forecast and truth
+             over the start points, "pattern_corr" (lead_steps) mean correlation over the components of each forecast
+             (only forecasts whose forecast and true fields are not constant count; NaN if there is none, e.g. for x = 1),
+             "spread" (lead_steps, x) root mean ensemble variance, zeros for deterministic forecasts}
+    """
+    dim = u.shape[1]
+    u_true = u.unfold(0, lead_steps, stride).transpose(1, 2)
+    S = u_true.shape[0]
+    dt = (t[1]-t[0]).item()
+    sums = {}
+
+    def accumulate(name, value):
+        sums[name] = sums.get(name, 0.) + value.to(torch.float64)
+
+    with torch.no_grad():
+        for i in range(0, S, chunk_size):
+            obs = u_true[i:i+chunk_size].transpose(0, 1)
+            C = obs.shape[1]
+            if sigma_lst is None:
+                pred = torchdiffeq.odeint(model, obs[0], t[:lead_steps], **odeint_kwargs)
+            else:
+                ens = EnsembleSDESolver(model, obs[0].repeat_interleave(members, dim=0), lead_steps, dt, sigma_lst,
+                                        generator=generator).reshape(lead_steps, C, members, dim)
+                pred = torch.mean(ens, dim=2)
+                accumulate("var", torch.sum(torch.var(ens, dim=2), dim=1))
+            # (lead, C, x) sums over the start points
+            accumulate("se", torch.sum((pred-obs)**2, dim=1))
+            accumulate("f", torch.sum(pred, dim=1))
+            accumulate("o", torch.sum(obs, dim=1))
+            accumulate("ff", torch.sum(pred**2, dim=1))
+            accumulate("oo", torch.sum(obs**2, dim=1))
+            accumulate("fo", torch.sum(pred*obs, dim=1))
+            # Correlation over the components of every single forecast
+            pa = pred - torch.mean(pred, dim=2, keepdim=True)
+            oa = obs - torch.mean(obs, dim=2, keepdim=True)
+            norm = torch.sqrt(torch.sum(pa**2, dim=2)*torch.sum(oa**2, dim=2))
+            valid = norm > 0
+            pc = torch.sum(pa*oa, dim=2) / torch.where(valid, norm, 1.)
+            accumulate("pc", torch.sum(torch.where(valid, pc, 0.), dim=1))
+            accumulate("pc_n", torch.sum(valid, dim=1))
+
+    cov = sums["fo"]/S - sums["f"]*sums["o"]/S**2
+    var_f = sums["ff"]/S - (sums["f"]/S)**2
+    var_o = sums["oo"]/S - (sums["o"]/S)**2
+    rmse = torch.sqrt(sums["se"]/S)
+    return {"lead": t[:lead_steps] - t[0],
+            "rmse": rmse,
+            "corr": cov / torch.sqrt(var_f*var_o),
+            "pattern_corr": sums["pc"]/sums["pc_n"],
+            "spread": torch.sqrt(sums["var"]/S) if sigma_lst is not None else torch.zeros_like(rmse)}
+
+
+#############################################################
+################# CG Posterior Forecasts  ###################
+#############################################################
+# Forecasts of the hidden variables u2 started from the CGFilter posterior N(mu, R) at an initial time. Given a path of
+# u1, u2 stays conditionally Gaussian and its mean/covariance follow the filter equations along that path. So u1 is
+# sampled jointly with u2 (Euler-Maruyama of the CG model, u2 drawn from N(mu, R)), while the forecast of u2 is the
+# mixture of the K conditional Gaussians obtained by filtering each sampled u1 path from (mu, R). The mixture is exact
+# for any K and its moments converge much faster than the sample moments of a brute-force ensemble of the same size.
+
+def _pointwise_coefficients(coef, u1):
+    # Coefficients at each of the states u1 (N, d1, 1) in one coef call: the series x0, x0, x1, x1, ... has the
+    # transitions x_i -> x_i at the even indices, whatever end of the transition coef reads
+    coefs = coef(u1.repeat_interleave(2, dim=0))
+    return [c[::2] if c.dim() == 3 else c for c in coefs]
+
+
+def _sqrt_psd(R):
+    # Symmetric square root of the (batched) covariances, robust to round-off negative eigenvalues
+    evals, evecs = torch.linalg.eigh((R+R.mT)/2)
+    return evecs @ torch.diag_embed(torch.sqrt(torch.clamp(evals, min=0))) @ evecs.mT
+
+
+def cg_forecast(coef, u1, mu, R, steps, dt, samples=20, generator=None, return_components=False):
+    """
+    Forecast of the hidden variables from the CGFilter posteriors at B initial times, all propagated at once.
+    :param coef: callable; Same as for CGFilter, coef(u1) returns (f1, g1, s1, f2, g2, s2) of the transitions of a series u1
+    :param u1: torch.Tensor(B, d1, 1); Observed variables at the initial times (e.g. u1[idx])
+    :param mu: torch.Tensor(B, d2, 1); Posterior means at the initial times (e.g. mu_trace[idx])
+    :param R: torch.Tensor(B, d2, d2); Posterior covariances at the initial times (e.g. R_trace[idx])
+    :param steps: int; Number of time steps of the forecast (including the initial time)
+    :param dt: float; Time step
+    :param samples: int; Number K of sampled u1 paths per initial time
+    :param generator: torch.Generator; Random number generator (default: global RNG)
+    :param return_components: bool; Also return the sampled u1 paths and the conditional Gaussians of every path
+    :return: dict; {"mu" (steps, B, d2, 1), "R" (steps, B, d2, d2): mean and covariance of the forecast of u2,
+             and with return_components "u1" (steps, B, K, d1, 1), "mu_k" (steps, B, K, d2, 1), "R_k" (steps, B, K, d2, d2)}
+    """
+    B, d1 = u1.shape[:2]
+    d2 = mu.shape[1]
+    K = samples
+    out = {"mu": torch.empty((steps, B, d2, 1), dtype=mu.dtype, device=mu.device),
+           "R": torch.empty((steps, B, d2, d2), dtype=mu.dtype, device=mu.device)}
+    if return_components:
+        out["u1"] = torch.empty((steps, B, K, d1, 1), dtype=mu.dtype, device=mu.device)
+        out["mu_k"] = torch.empty((steps, B, K, d2, 1), dtype=mu.dtype, device=mu.device)
+        out["R_k"] = torch.empty((steps, B, K, d2, d2), dtype=mu.dtype, device=mu.device)
+
+    def randn(d):
+        return torch.randn((B*K, d, 1), generator=generator, dtype=mu.dtype, device=mu.device)
+
+    with torch.no_grad():
+        # Every initial time is repeated for its K paths: (B*K, ...)
+        x1 = u1.to(mu.dtype).repeat_interleave(K, dim=0)
+        m = mu.repeat_interleave(K, dim=0)
+        P = R.repeat_interleave(K, dim=0)
+        x2 = m + _sqrt_psd(P) @ randn(d2)
+        for n in range(steps):
+            m_k = m.reshape(B, K, d2, 1)
+            P_k = P.reshape(B, K, d2, d2)
+            out["mu"][n] = torch.mean(m_k, dim=1)
+            out["R"][n] = torch.mean(P_k + m_k @ m_k.mT, dim=1) - out["mu"][n] @ out["mu"][n].mT
+            if return_components:
+                out["u1"][n] = x1.reshape(B, K, d1, 1)
+                out["mu_k"][n] = m_k
+                out["R_k"][n] = P_k
+            if n == steps-1:
+                break
+            f1, g1, s1, f2, g2, s2 = _pointwise_coefficients(coef, x1)
+            # Joint Euler-Maruyama step of (u1, u2)
+            dx1 = (f1 + g1@x2)*dt + s1 @ randn(d1) * np.sqrt(dt)
+            x2 = x2 + (f2 + g2@x2)*dt + s2 @ randn(d2) * np.sqrt(dt)
+            x1 = x1 + dx1
+            # Filter step of (m, P) along the sampled increment dx1
+            G = g1.mT @ torch.linalg.inv(s1@s1.mT)
+            m, P = (m + (f2 + g2@m)*dt + P @ (G @ (dx1 - (f1 + g1@m)*dt)),
+                    P + (g2@P + P@g2.mT + s2@s2.mT - P@G@g1@P)*dt)
+    return out
+
+
+#############################################################
+################# Posterior Ensemble Forecasts  #############
+#############################################################
+# Ensemble forecasts with the learned drift: initial conditions are the observed u1 with u2 ~ N(mu, R) from CGFilter,
+# advanced by EnsembleSDESolver with the estimated noise sigma_hat. The start times are split into chunks, each chunk
+# is one batched ensemble run reduced to mean, std and percentiles right away, so the member paths are never stored.
+# Chunks can run in worker processes (cgnsde.parallel), each with its own generator seeded by (seed, chunk index), so the
+# result does not depend on the number of processes.
+
+
+def _quantiles(x, q, dim):
+    # Linear-interpolation quantiles via one sort (torch.quantile is limited in input size)
+    x = torch.sort(x, dim=dim).values
+    pos = torch.tensor(q, dtype=torch.float64) * (x.shape[dim]-1)
+    low = torch.floor(pos).long()
+    high = torch.clamp(low+1, max=x.shape[dim]-1)
+    w = (pos - low).to(x.dtype)
+    out = []
+    for k in range(len(q)):
+        a = x.select(dim, int(low[k]))
+        b = x.select(dim, int(high[k]))
+        out.append(a + w[k]*(b-a))
+    return torch.stack(out)
+
+
+def _ensemble_chunk(job, i):
+    start = i*job["chunk_size"]
+    u1, mu, R = (x[start:start+job["chunk_size"]] for x in (job["u1"], job["mu"], job["R"]))
+    C = u1.shape[0]
+    M = job["members"]
+    generator = torch.Generator().manual_seed(job["seed"]*100003 + i)
+    with torch.no_grad():
+        u0 = torch.empty((C*M, len(job["indices_u1"])+len(job["indices_u2"])), dtype=mu.dtype)
+        u0[:, job["indices_u1"]] = u1.to(mu.dtype).repeat_interleave(M, dim=0)[:, :, 0]
+        u2 = mu.repeat_interleave(M, dim=0) + _sqrt_psd(R).repeat_interleave(M, dim=0) @ \
+            torch.randn((C*M, mu.shape[1], 1), generator=generator, dtype=mu.dtype)
+        u0[:, job["indices_u2"]] = u2[:, :, 0]
+        ens = EnsembleSDESolver(job["model"], u0, job["steps"], job["dt"], job["sigma_lst"], generator=generator)
+        ens = ens.reshape(job["steps"], C, M, -1)
+        return (torch.mean(ens, dim=2), torch.std(ens, dim=2), _quantiles(ens, job["q"], dim=2))
+
+
+def posterior_ensemble_forecast(model, u1, mu, R, indices_u1, indices_u2, steps, dt, sigma_lst, members=100,
+                                percentiles=(5, 50, 95), chunk_size=10, processes=1, seed=0):
+    """
+    Ensemble forecasts of the full state from the CGFilter posteriors at B start times, reduced to summaries.
+    :param model: callable; model(t, u) returns du/dt for a batch u (N, x), e.g. the trained MixModel
+    :param u1: torch.Tensor(B, d1, 1); Observed variables at the start times
+    :param mu: torch.Tensor(B, d2, 1); Posterior means at the start times
+    :param R: torch.Tensor(B, d2, d2); Posterior covariances at the start times
+    :param indices_u1: list; Positions of the observed variables in the state u
+    :param indices_u2: list; Positions of the hidden variables in the state u
+    :param steps: int; Number of time steps of the forecasts (including the start time)
+    :param dt: float; Time step
+    :param sigma_lst: list; Noise amplitudes of all variables (e.g. sigma_hat)
+    :param members: int; Ensemble size per start time
+    :param percentiles: tuple; Percentiles (0-100) to keep
+    :param chunk_size: int; Number of start times per batched ensemble run
+    :param processes: int; Number of forked worker processes (None: all CPU cores; 1 runs in this process), see
+                      cgnsde.parallel for the fork caveat
+    :param seed: int; Seed of the initial conditions and the noise
+    :return: dict; {"mean" (steps, B, x), "std" (steps, B, x), "percentiles" (P, steps, B, x), "q" (P) the percentiles}
+    """
+    n_chunks = -(-u1.shape[0] // chunk_size)
+    job = dict(model=model, u1=u1.detach(), mu=mu.detach(), R=R.detach(), indices_u1=list(indices_u1),
+               indices_u2=list(indices_u2), steps=steps, dt=dt, sigma_lst=sigma_lst, members=members,
+               q=[p/100 for p in percentiles], chunk_size=chunk_size, seed=seed)
+    results = list(map_jobs(_ensemble_chunk, job, range(n_chunks), processes))
+    mean, std, quantiles = zip(*results)
+    return {"mean": torch.cat(mean, dim=1), "std": torch.cat(std, dim=1),
+            "percentiles": torch.cat(quantiles, dim=2), "q": list(percentiles)}
@@ -0,0 +1,121 @@
+import numpy as np
+import torch
+
+
+##########################################################
+################# Posterior Skill Metrics ################
+##########################################################
+# Skill of Gaussian posteriors N(mu, R) (e.g. CGFilter outputs) w.r.t. the true states x.
+# x, mu are in matrix form, e.g. (t, x, 1); R is either the full covariance (t, x, x)
+# or only the variances (t, x) (diagonal-only mode, e.g. from TraceWriter(diagonal=True)).
+
+def _variances(R):
+    return R if R.dim() == 2 else torch.diagonal(R, dim1=1, dim2=2)
+
+
+def _logdet_quad(r, R):
+    # log det(R) and r.T inv(R) r of every step, from the Cholesky factor R = L L.T
+    L, info = torch.linalg.cholesky_ex(R)
+    if not torch.any(info):
+        z = torch.linalg.solve_triangular(L, r, upper=False)
+        return (2*torch.sum(torch.log(torch.diagonal(L, dim1=1, dim2=2)), dim=1), torch.sum(z**2, dim=(1, 2)))
+    # Some R are not (numerically) positive definite: LU based slogdet/solve, giving nan where det(R) < 0 like log(det(R))
+    sign, logabsdet = torch.linalg.slogdet(R)
+    return (torch.log(sign) + logabsdet, (r.mT @ torch.linalg.solve(R, r)).flatten())
+
+
+def neg_log_likehood(x, mu, R):
+    """
+    Gaussian negative log-likelihood of x under N(mu, R) at every step.
+    :param x: torch.Tensor(t, d, 1); True states
+    :param mu: torch.Tensor(t, d, 1); Posterior means
+    :param R: torch.Tensor(t, d, d) or torch.Tensor(t, d); Posterior covariances or variances
+    :return: torch.Tensor(t)
+    """
+    d = x.shape[1]
+    if R.dim() == 2:
+        logdet = torch.sum(torch.log(R), dim=1)
+        quad = torch.sum((x-mu).squeeze(2)**2/R, dim=1)
+    else:
+        logdet, quad = _logdet_quad(x-mu, R)
+    return 1/2*(d*np.log(2*np.pi) + logdet + quad)
+
+
+def avg_neg_log_likehood(x, mu, R, chunk_size=None):
+    """
+    Average Gaussian negative log-likelihood over all steps.
+    :param chunk_size: int; Evaluate the steps in chunks of this size to bound the memory of the intermediates (no autograd)
+    :return: torch.Tensor(); 0-d tensor in both modes
+    """
+    if chunk_size is None:
+        return torch.mean(neg_log_likehood(x, mu, R))
+    total = 0.
+    with torch.no_grad():
+        for i in range(0, x.shape[0], chunk_size):
+            total = total + torch.sum(neg_log_likehood(x[i:i+chunk_size], mu[i:i+chunk_size], R[i:i+chunk_size]))
+    return torch.as_tensor(total / x.shape[0])
+
+
+def mse(x, mu):
+    return torch.mean((x-mu)**2)
+
+
+def crps(x, mu, R):
+    # Average CRPS of the Gaussian marginals N(mu_i, R_ii) over all steps and variables
+    sigma = torch.sqrt(_variances(R))
+    z = (x-mu).squeeze(2) / sigma
+    pdf = torch.exp(-z**2/2) / np.sqrt(2*np.pi)
+    cdf = torch.special.ndtr(z)
+    return torch.mean(sigma*(z*(2*cdf-1) + 2*pdf - 1/np.sqrt(np.pi)))
+
+
+def coverage(x, mu, R, k=2.):
+    # Fraction of the true states inside the mu +- k*sigma band of their marginals
+    sigma = torch.sqrt(_variances(R))
+    return torch.mean((torch.abs((x-mu).squeeze(2)) <= k*sigma).to(mu.dtype))
+
+
+class SkillAccumulator:
+    """
+    Streaming MSE, NLL, CRPS and +-2 sigma coverage: feed the trace chunk by chunk with update(x, mu, R),
+    so a long trace never has to be held (or evaluated) at once.
+    """
+    def __init__(self, diagonal=False, k=2.):
+        """
+        :param diagonal: bool; Only use the variances of R (the NLL then ignores correlations)
+        :param k: float; Width of the coverage band in standard deviations
+        """
+        self.diagonal = diagonal
+        self.k = k
+        self.steps = 0
+        self.numel = 0
+        self.sse = 0.
+        self.nll = 0.
+        self.crps = 0.
+        self.covered = 0.
+
+    def update(self, x, mu, R):
+        with torch.no_grad():
+            R = _variances(R) if self.diagonal else R
+            t, d = x.shape[:2]
+            self.sse += torch.sum((x-mu)**2).item()
+            self.nll += torch.sum(neg_log_likehood(x, mu, R)).item()
+            self.crps += crps(x, mu, R).item() * t*d
+            self.covered += coverage(x, mu, R, self.k).item() * t*d
+            self.steps += t
+            self.numel += t*d
+
+    def result(self):
+        return {"mse": self.sse/self.numel, "nll": self.nll/self.steps,
+                "crps": self.crps/self.numel, "coverage": self.covered/self.numel}
+
+
+def skill(x, mu, R, chunk_size=10000, diagonal=False):
+    """
+    MSE, NLL, CRPS and +-2 sigma coverage of a whole trace, evaluated in chunks.
+    :return: dict; {"mse", "nll", "crps", "coverage"}
+    """
+    acc = SkillAccumulator(diagonal=diagonal)
+    for i in range(0, x.shape[0], chunk_size):
+        acc.update(x[i:i+chunk_size], mu[i:i+chunk_size], R[i:i+chunk_size])
+    return acc.result()
@@ -0,0 +1,48 @@
+import multiprocessing
+import os
+import torch
+
+
+################################################
+################# Worker Pools  ################
+################################################
+# posterior_ensemble_forecast, enkbf_repeats and library_cov split their work into independent items (chunks of start
+# times, of repeats, of time steps) that can run in worker processes. The shared inputs of all items (model, data,
+# settings) are handed to the workers once through the Pool initializer, so no module-level state is written in the
+# calling process and concurrent calls do not interfere. Workers are forked, so closures and models are inherited
+# instead of pickled, and each worker runs torch with one intra-op thread.
+# Caveat: forking a process whose torch/OpenMP thread pool is already running can deadlock on some platforms; the tools
+# therefore default to processes=1 (everything in the calling process) and parallel runs are opt-in.
+
+_worker = None
+
+
+def _init_worker(func, job):
+    global _worker
+    _worker = (func, job)
+    torch.set_num_threads(1)
+
+
+def _run_item(item):
+    func, job = _worker
+    return func(job, item)
+
+
+def map_jobs(func, job, items, processes=1):
+    """
+    Results func(job, item) of all items, in order, computed in this process or in forked workers.
+    :param func: callable; Module-level function func(job, item)
+    :param job: dict; Inputs shared by all items
+    :param items: list; Work items
+    :param processes: int; Number of worker processes (None: all CPU cores; 1 runs in this process)
+    :return: generator; Results in the order of items, yielded as they become available
+    """
+    items = list(items)
+    processes = os.cpu_count() if processes is None else processes
+    if min(processes, len(items)) <= 1:
+        for item in items:
+            yield func(job, item)
+        return
+    with multiprocessing.get_context("fork").Pool(min(processes, len(items)), initializer=_init_worker,
+                                                  initargs=(func, job)) as pool:
+        yield from pool.imap(_run_item, items)
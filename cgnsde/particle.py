@@ -0,0 +1,82 @@
+import time
+import numpy as np
+
+
+###########################################################
+################# Bootstrap Particle Filter  ##############
+###########################################################
+# Nonlinear reference filter for systems that are not conditionally Gaussian (e.g. PSBSE). N particles of the hidden
+# variables u2 (N, p) are propagated with the drift (Euler-Maruyama, noise sig2) and weighted by the likelihood of the
+# observed increment du1 ~ N(g dt, sig1 sig1.T dt). The drift uses the same tendency(u1, u2) -> (g, f) contract as the
+# EnKBF (cgnsde.enkbf: split_tendency, model_tendency for learned models), evaluated for all particles at once.
+# Resampling is systematic (O(N)) and only triggered when the effective sample size drops below ess_threshold * N.
+
+def systematic_resample(weights, rng):
+    """
+    Systematic resampling in O(N): with one uniform offset U, particle i is copied
+    ceil(N C_i - U) - ceil(N C_{i-1} - U) times, C the cumulative weights.
+    :param weights: np.ndarray(N); Normalized weights
+    :param rng: np.random.Generator; Source of the offset
+    :return: np.ndarray(N); Indices of the resampled particles
+    """
+    N = weights.shape[0]
+    C = np.cumsum(weights)
+    C[-1] = 1.
+    edges = np.ceil(N*C - rng.random()).astype(np.int64)
+    counts = np.diff(edges, prepend=0)
+    return np.repeat(np.arange(N), counts)
+
+
+def BootstrapPF(tendency, u1, u2_0, dt, sig1, sig2, ess_threshold=0.5, rng=None, seed=0):
+    """
+    :param tendency: callable; tendency(u1, u2) returns (g (N, d1), f (N, p)) for u1 (d1) and the particles u2 (N, p)
+    :param u1: np.ndarray(Nt, d1); Observed variables
+    :param u2_0: np.ndarray(N, p); Initial particles
+    :param dt: float; Time step
+    :param sig1: np.ndarray(d1, d1); Noise amplitude of u1
+    :param sig2: np.ndarray(p, p); Noise amplitude of u2
+    :param ess_threshold: float; Resample when the effective sample size is below ess_threshold * N
+    :param rng: np.random.Generator; Source of the noise (default: np.random.default_rng(seed))
+    :param seed: int; Seed of the default generator
+    :return: dict; {"mu_trace" (Nt, p, 1), "R_trace" (Nt, p, p) weighted posterior moments, "ess" (Nt) effective sample
+             sizes, "resampled" number of resampling steps, "throughput" particles x steps per second}
+    """
+    rng = np.random.default_rng(seed) if rng is None else rng
+    Nt = u1.shape[0]
+    N, p = u2_0.shape
+    inv_SIG1 = np.linalg.inv(sig1 @ sig1.T)
+    du1 = np.diff(u1, axis=0)
+    x = np.array(u2_0, dtype=np.float64)
+    w = np.full(N, 1/N)
+    logw = np.zeros(N)  # Unnormalized log-weights
+    mu_trace = np.zeros((Nt, p, 1))
+    R_trace = np.zeros((Nt, p, p))
+    ess = np.zeros(Nt)
+    resampled = 0
+
+    def moments(n):
+        mu = w @ x
+        A = x - mu
+        mu_trace[n, :, 0] = mu
+        R_trace[n] = (A * w[:, None]).T @ A
+        ess[n] = 1 / np.sum(w**2)
+
+    moments(0)
+    start = time.time()
+    for n in range(1, Nt):
+        g, f = tendency(u1[n-1], x)
+        r = du1[n-1] - g*dt
+        logw -= 0.5*np.sum((r @ inv_SIG1) * r, axis=1) / dt
+        logw -= logw.max()
+        x = x + f*dt + rng.standard_normal((N, p)) @ sig2 * np.sqrt(dt)
+        w = np.exp(logw)
+        w /= w.sum()
+        moments(n)
+        if ess[n] < ess_threshold*N:
+            x = x[systematic_resample(w, rng)]
+            w = np.full(N, 1/N)
+            logw = np.zeros(N)
+            resampled += 1
+    elapsed = time.time() - start
+    return {"mu_trace": mu_trace, "R_trace": R_trace, "ess": ess, "resampled": resampled,
+            "throughput": N*(Nt-1) / max(elapsed, 1e-12)}
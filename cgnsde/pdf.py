@@ -0,0 +1,156 @@
+import itertools
+import numpy as np
+import torch
+
+
+###########################################################
+################# Gaussian Mixture PDF  ###################
+###########################################################
+# The CGFilter posterior of u2 at each time is the Gaussian N(mu_trace[n], R_trace[n]), so the time-averaged PDF of u2
+# is the mixture (1/Nt) sum_n N(mu_trace[n], R_trace[n]). With 10^5-10^6 components, it is evaluated on a uniform grid by
+#   1. linear binning of the kernel parameters (log-variances, correlation) onto a coarse node grid, so that only a few
+#      distinct kernels remain,
+#   2. linear binning of the component means of each kernel onto the evaluation grid,
+#   3. convolving each histogram with its Gaussian kernel as a product with the analytic Fourier transform of the kernel,
+#      so all kernels together only need a single inverse FFT.
+# The cost is O(Nt + G * M log M) for G kernels and M grid points instead of O(Nt * M). The grid spacing should resolve
+# the posterior standard deviations (binning error ~ (h/sigma)^2).
+
+def _to_numpy(x):
+    return x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x)
+
+
+def _kernel_nodes(keys, tols, max_groups):
+    """
+    Linear binning of the kernel parameters: each component spreads its weight over the 2^K surrounding nodes of a grid
+    with spacing tols in parameter space. The spacing is doubled until at most max_groups nodes are occupied.
+    :return: tuple; (labels (2^K, Nt) node of each corner, frac (2^K, Nt) weight of each corner, nodes (G, K) parameters)
+    """
+    K = len(keys)
+    while True:
+        pos = [(k - k.min()) / tol for k, tol in zip(keys, tols)]
+        low = [np.floor(p).astype(np.int64) for p in pos]
+        # Node indices are flattened into one integer code per corner
+        extent = [int(l.max()) + 2 for l in low]
+        stride = np.cumprod([1] + extent[:-1])
+        codes, frac = [], []
+        for corner in itertools.product((0, 1), repeat=K):
+            codes.append(sum((l+c)*st for l, c, st in zip(low, corner, stride)))
+            frac.append(np.prod([p-l if c else 1-(p-l) for p, l, c in zip(pos, low, corner)], axis=0))
+        codes = np.stack(codes)
+        frac = np.stack(frac)
+        used = frac > 0
+        nodes_code, labels = np.unique(codes[used], return_inverse=True)
+        if nodes_code.shape[0] <= max_groups:
+            break
+        tols = [2*tol for tol in tols]
+    full_labels = np.zeros(frac.shape, dtype=np.int64)
+    full_labels[used] = labels.reshape(-1)
+    nodes = np.stack([k.min() + (nodes_code // st % ext)*tol for k, st, ext, tol in zip(keys, stride, extent, tols)], axis=1)
+    return (full_labels, frac, nodes)
+
+
+def _work_grid(grid, pad):
+    # Uniform grid extended by `pad` on both sides (zero padding against the circular wrap of the FFT)
+    h = grid[1] - grid[0]
+    n_pad = int(np.ceil(pad / h))
+    x0 = grid[0] - n_pad*h
+    return (x0, h, n_pad, len(grid) + 2*n_pad)
+
+
+def _weights(weights, Nt):
+    return np.full(Nt, 1/Nt) if weights is None else np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+
+def mixture_pdf_1d(mu_trace, R_trace, i, grid, weights=None, log_var_tol=0.05, max_groups=256, n_sigma=6):
+    """
+    Marginal PDF of the i-th hidden variable of the Gaussian mixture given by the CGFilter posteriors.
+    :param mu_trace: torch.Tensor or np.ndarray (Nt, d2, 1); Posterior means
+    :param R_trace: torch.Tensor or np.ndarray (Nt, d2, d2); Posterior covariances
+    :param i: int; Index of the hidden variable
+    :param grid: np.ndarray(M); Uniform evaluation grid
+    :param weights: np.ndarray(Nt); Mixture weights (default: equal weights, i.e. the time average)
+    :param log_var_tol: float; Node spacing of the log-variances of the kernels
+    :param max_groups: int; Maximal number of distinct kernels (the node spacing is coarsened beyond)
+    :param n_sigma: float; Components farther than n_sigma standard deviations from the grid are dropped
+    :return: np.ndarray(M); PDF values on the grid
+    """
+    mu = _to_numpy(mu_trace)[:, i, 0].astype(np.float64)
+    var = _to_numpy(R_trace)[:, i, i].astype(np.float64)
+    grid = np.asarray(grid, dtype=np.float64)
+    w = _weights(weights, mu.shape[0])
+
+    labels, frac, nodes = _kernel_nodes([np.log(var)], [log_var_tol], max_groups)
+    G = nodes.shape[0]
+    x0, h, n_pad, M = _work_grid(grid, n_sigma*np.sqrt(var.max()))
+
+    # Linear binning of the means, for every kernel node
+    px = (mu - x0) / h
+    inside = (px >= 0) & (px <= M-1)
+    lx = np.minimum(np.floor(px).astype(int), M-2)
+    fx = px - lx
+    hist = np.zeros(G*M)
+    for labels_c, frac_c in zip(labels, frac):
+        idx = np.concatenate([(labels_c*M + lx)[inside], (labels_c*M + lx+1)[inside]])
+        wc = np.concatenate([(w*frac_c*(1-fx))[inside], (w*frac_c*fx)[inside]])
+        hist += np.bincount(idx, weights=wc, minlength=G*M)
+    hist = hist.reshape(G, M)
+
+    n_fft = 2*M
+    f = np.fft.rfftfreq(n_fft, d=h)
+    kernel_ft = np.exp(-2*np.pi**2*np.exp(nodes[:, [0]])*f**2)
+    spectrum = np.sum(np.fft.rfft(hist, n=n_fft, axis=1) * kernel_ft, axis=0)
+    pdf = np.fft.irfft(spectrum, n=n_fft)[:M] / h
+    return np.maximum(pdf[n_pad:n_pad+len(grid)], 0)
+
+
+def mixture_pdf_2d(mu_trace, R_trace, ij, grid_x, grid_y, weights=None, log_var_tol=0.05, corr_tol=0.05, max_groups=256, n_sigma=6):
+    """
+    Joint PDF of the hidden variables ij = (i, j) of the Gaussian mixture given by the CGFilter posteriors.
+    :param ij: tuple; Indices (i, j) of the two hidden variables
+    :param grid_x: np.ndarray(Mx); Uniform evaluation grid of variable i
+    :param grid_y: np.ndarray(My); Uniform evaluation grid of variable j
+    :param corr_tol: float; Node spacing of the correlation coefficients of the kernels
+    :return: np.ndarray(Mx, My); PDF values on the grid, pdf[a, b] at (grid_x[a], grid_y[b])
+    (other parameters as in mixture_pdf_1d)
+    """
+    i, j = ij
+    mu = _to_numpy(mu_trace)[:, [i, j], 0].astype(np.float64)
+    R = _to_numpy(R_trace).astype(np.float64)
+    var_x, var_y, cov_xy = R[:, i, i], R[:, j, j], R[:, i, j]
+    grid_x = np.asarray(grid_x, dtype=np.float64)
+    grid_y = np.asarray(grid_y, dtype=np.float64)
+    w = _weights(weights, mu.shape[0])
+
+    corr = cov_xy / np.sqrt(var_x*var_y)
+    labels, frac, nodes = _kernel_nodes([np.log(var_x), np.log(var_y), corr], [log_var_tol, log_var_tol, corr_tol], max_groups)
+    G = nodes.shape[0]
+    x0, hx, pad_x, Mx = _work_grid(grid_x, n_sigma*np.sqrt(var_x.max()))
+    y0, hy, pad_y, My = _work_grid(grid_y, n_sigma*np.sqrt(var_y.max()))
+
+    # Bilinear binning of the means, for every kernel node
+    px = (mu[:, 0] - x0) / hx
+    py = (mu[:, 1] - y0) / hy
+    inside = (px >= 0) & (px <= Mx-1) & (py >= 0) & (py <= My-1)
+    lx = np.minimum(np.floor(px).astype(int), Mx-2)
+    ly = np.minimum(np.floor(py).astype(int), My-2)
+    fx, fy = px - lx, py - ly
+    hist = np.zeros(G*Mx*My)
+    corners = [(dx, dy, wx*wy) for dx, wx in ((0, 1-fx), (1, fx)) for dy, wy in ((0, 1-fy), (1, fy))]
+    for labels_c, frac_c in zip(labels, frac):
+        idx = np.concatenate([(labels_c*Mx*My + (lx+dx)*My + ly+dy)[inside] for dx, dy, _ in corners])
+        wc = np.concatenate([(w*frac_c*wxy)[inside] for _, _, wxy in corners])
+        hist += np.bincount(idx, weights=wc, minlength=G*Mx*My)
+    hist = hist.reshape(G, Mx, My)
+
+    n_fft = (2*Mx, 2*My)
+    fxx = np.fft.fftfreq(n_fft[0], d=hx)[:, None]
+    fyy = np.fft.rfftfreq(n_fft[1], d=hy)[None, :]
+    spectrum = np.zeros((n_fft[0], n_fft[1]//2+1), dtype=np.complex128)
+    for g in range(G):
+        vx, vy = np.exp(nodes[g, 0]), np.exp(nodes[g, 1])
+        cxy = np.clip(nodes[g, 2], -1, 1)*np.sqrt(vx*vy)
+        kernel_ft = np.exp(-2*np.pi**2*(vx*fxx**2 + 2*cxy*fxx*fyy + vy*fyy**2))
+        spectrum += np.fft.rfft2(hist[g], s=n_fft) * kernel_ft
+    pdf = np.fft.irfft2(spectrum, s=n_fft)[:Mx, :My] / (hx*hy)
+    return np.maximum(pdf[pad_x:pad_x+len(grid_x), pad_y:pad_y+len(grid_y)], 0)
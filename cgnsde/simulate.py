@@ -0,0 +1,300 @@
+import os
+import time
+import numpy as np
+import torch
+
+
+#############################################################
+################# Ensemble Simulation  ######################
+#############################################################
+# The scripts' SDESolver(model, u0, steps, dt, sigma_lst) simulates a single path with one model call of batch size 1
+# per step. The learned models are evaluated on batches (N, dim) anyway, so an ensemble of M paths is advanced with
+# one batched model call per step, and the Gaussian increments are drawn in preallocated blocks of steps.
+
+def EnsembleSDESolver(model, u0, steps, dt, sigma_lst, block_size=1000, generator=None, guard=None):
+    """
+    Euler-Maruyama simulation of M paths of du = model(u) dt + sigma dW at once (same scheme as SDESolver).
+    :param model: callable; model(t, u) returns du/dt for a batch u (M, dim)
+    :param u0: torch.Tensor(M, dim) or torch.Tensor(dim); Initial states of the members (copied M=1 times for (dim))
+    :param steps: int; Number of time steps of the output (including u0)
+    :param dt: float; Time step
+    :param sigma_lst: list; Noise amplitudes of the variables (zeros give the Euler scheme of ODESolver)
+    :param block_size: int; Number of steps whose noise is drawn at once
+    :param generator: torch.Generator; Random number generator (default: global RNG)
+    :param guard: DivergenceGuard; Masks diverged members (NaN after their blow-up) or stops the run
+    :return: torch.Tensor(steps, M, dim); Shorter if the guard stopped the run
+    """
+    u0 = u0.reshape(-1, u0.shape[-1])
+    u_simu = torch.empty((steps,) + u0.shape, dtype=u0.dtype, device=u0.device)
+    with torch.inference_mode():
+        u_simu[0] = u0
+        filled = _sde_steps(model, u_simu, dt, sigma_lst, block_size, generator, guard)
+    return u_simu[:filled]
+
+
+def _sde_steps(model, u_simu, dt, sigma_lst, block_size, generator, guard=None, n0=0):
+    # Fill u_simu[1:] (steps, M, dim) from u_simu[0], step n of u_simu being step n0+n of the run;
+    # returns the number of filled steps (< steps if the guard stopped the run)
+    steps, M, dim = u_simu.shape
+    sigma = torch.tensor(sigma_lst, dtype=u_simu.dtype, device=u_simu.device) * np.sqrt(dt)
+    noise = torch.empty((min(block_size, max(steps-1, 1)), M, dim), dtype=u_simu.dtype, device=u_simu.device)
+    if guard is not None and n0 == 0:
+        guard.check(0, u_simu[0])
+    for n in range(steps-1):
+        k = n % noise.shape[0]
+        if k == 0:
+            torch.randn(noise.shape, generator=generator, dtype=noise.dtype, device=noise.device, out=noise)
+            noise.mul_(sigma)
+        if guard is None or guard.alive.all():
+            u_simu[n+1] = u_simu[n] + model(None, u_simu[n])*dt + noise[k]
+        else:
+            # Only the members that are still alive are advanced
+            alive = guard.alive
+            u_simu[n+1] = np.nan
+            u_simu[n+1, alive] = u_simu[n, alive] + model(None, u_simu[n, alive])*dt + noise[k, alive]
+        if guard is not None and not guard.check(n0+n+1, u_simu[n+1]):
+            return n+2
+    return steps
+
+
+class DivergenceGuard:
+    """
+    Detects blow-ups of simulated members: non-finite values or values outside the envelope [lower, upper].
+    With mode="stop" the run ends at the first diverged member, with mode="mask" the diverged members are frozen
+    (NaN) and the others continue until all have diverged. The blow-up steps are kept for screening model checkpoints.
+    Usable in any step loop: `if not guard.check(n+1, u_simu[n+1]): break`; reset() clears the record, so one guard can
+    screen several runs (e.g. model checkpoints) in turn.
+    """
+    def __init__(self, lower=-np.inf, upper=np.inf, mode="mask", dt=1.):
+        """
+        :param lower: float or torch.Tensor(dim); Lower bound of the envelope
+        :param upper: float or torch.Tensor(dim); Upper bound of the envelope
+        :param mode: str; "stop" or "mask"
+        :param dt: float; Time step (blow-up times in summary() are step * dt)
+        """
+        if mode not in ("stop", "mask"):
+            raise ValueError(f"Unknown mode {mode}, expected 'stop' or 'mask'")
+        self.lower = lower
+        self.upper = upper
+        self.mode = mode
+        self.dt = dt
+        self.alive = None
+        self.blowup_step = None
+
+    @staticmethod
+    def from_data(u, margin=1., mode="mask", dt=1.):
+        # Envelope of the data u (t, dim) widened by margin times its range on both sides
+        u_min = torch.min(u, dim=0).values
+        u_max = torch.max(u, dim=0).values
+        return DivergenceGuard(u_min - margin*(u_max-u_min), u_max + margin*(u_max-u_min), mode, dt)
+
+    def check(self, n, u):
+        """
+        :param n: int; Step index of u
+        :param u: torch.Tensor(M, dim) or torch.Tensor(dim); States of the members at step n
+        :return: bool; Whether the run should continue
+        """
+        u = u.reshape(-1, u.shape[-1])
+        if self.alive is None:
+            self.alive = torch.ones(u.shape[0], dtype=torch.bool, device=u.device)
+            self.blowup_step = np.full(u.shape[0], -1)
+        bad = ~torch.all(torch.isfinite(u), dim=1) | torch.any(u < self.lower, dim=1) | torch.any(u > self.upper, dim=1)
+        new = (bad & self.alive).cpu().numpy()
+        if new.any():
+            self.blowup_step[new] = n
+            self.alive = self.alive & ~bad
+        if self.mode == "stop":
+            return bool(self.alive.all())
+        return bool(self.alive.any())
+
+    def reset(self):
+        # Forget the members and blow-up steps of the previous run (the envelope and mode are kept)
+        self.alive = None
+        self.blowup_step = None
+
+    def summary(self):
+        # Blow-up statistics, times in units of dt
+        t = self.blowup_step[self.blowup_step >= 0] * self.dt
+        out = {"members": len(self.blowup_step), "diverged": len(t), "fraction": len(t)/len(self.blowup_step)}
+        if len(t) > 0:
+            out.update({"first": t.min(), "median": np.median(t), "mean": t.mean()})
+        return out
+
+    def state_dict(self):
+        return {"alive": None if self.alive is None else self.alive.cpu(), "blowup_step": self.blowup_step}
+
+    def load_state_dict(self, state):
+        self.alive = state["alive"]
+        self.blowup_step = state["blowup_step"]
+
+
+#############################################################
+################# Long-run Simulation  ######################
+#############################################################
+# Long runs (10^7 steps) do not fit a torch.zeros(steps, dim) buffer and must survive interruptions. The path is
+# written chunk by chunk into a memory-mapped .npy file, and at every chunk boundary the current state and the RNG
+# state are checkpointed next to it. Calling LongSDESimulation again with the same arguments resumes from the last
+# checkpoint and gives exactly the same path as an uninterrupted run.
+
+def LongSDESimulation(model, u0, steps, dt, sigma_lst, path, chunk_size=100000, block_size=1000, seed=0, verbose=True, guard=None):
+    """
+    Chunked, resumable EnsembleSDESolver run written to disk.
+    :param u0: torch.Tensor(M, dim) or torch.Tensor(dim); Initial states of the members
+    :param path: str; Output .npy file with the path (steps, M, dim); the checkpoint is path + ".ckpt"
+    :param chunk_size: int; Number of steps per chunk (written and checkpointed together)
+    :param seed: int; Seed of the generator of the noise (restored from the checkpoint when resuming)
+    :param verbose: bool; Print progress and throughput (steps/s) after every chunk
+    :param guard: DivergenceGuard; Checked every step and checkpointed with the state; if it stops the run,
+                  the remaining steps are filled with NaN
+    :return: np.memmap(steps, M, dim); The simulated path (read-only)
+    (other parameters as in EnsembleSDESolver)
+    """
+    u0 = u0.reshape(-1, u0.shape[-1])
+    shape = (steps,) + tuple(u0.shape)
+    dtype = np.dtype(str(u0.dtype).replace("torch.", ""))
+    ckpt_path = path + ".ckpt"
+    config = {"shape": shape, "dtype": str(dtype), "dt": dt, "sigma_lst": list(sigma_lst),
+              "chunk_size": chunk_size, "block_size": block_size, "seed": seed}
+
+    generator = torch.Generator(device=u0.device)
+    if os.path.exists(ckpt_path):
+        ckpt = torch.load(ckpt_path, weights_only=False)
+        if ckpt["config"] != config:
+            raise ValueError(f"Checkpoint {ckpt_path} belongs to a different run: {ckpt['config']}")
+        n = ckpt["n"]
+        u = ckpt["u"].to(u0.device)
+        generator.set_state(ckpt["rng"])
+        if guard is not None:
+            guard.load_state_dict(ckpt["guard"])
+        u_disk = np.lib.format.open_memmap(path, mode="r+")
+    else:
+        n = 0
+        u = u0.clone()
+        generator.manual_seed(seed)
+        u_disk = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        u_disk[0] = u0.cpu().numpy()
+        if guard is not None and not guard.check(0, u0):
+            u_disk[1:] = np.nan
+            n = steps-1
+
+    buffer = torch.empty((chunk_size+1,) + tuple(u0.shape), dtype=u0.dtype, device=u0.device)
+    while n < steps-1:
+        start_time = time.time()
+        c = min(chunk_size, steps-1-n)
+        with torch.inference_mode():
+            buffer[0] = u
+            filled = _sde_steps(model, buffer[:c+1], dt, sigma_lst, block_size, generator, guard, n0=n)
+        u_disk[n+1:n+filled] = buffer[1:filled].cpu().numpy()
+        if filled < c+1:
+            # Stopped by the guard
+            for i in range(n+filled, steps, chunk_size):
+                u_disk[i:i+chunk_size] = np.nan
+            c = steps-1-n
+        u_disk.flush()
+        n += c
+        u = buffer[filled-1].clone()
+        # Write the checkpoint atomically, so an interruption leaves either the old or the new one
+        torch.save({"config": config, "n": n, "u": u.cpu(), "rng": generator.get_state(),
+                    "guard": None if guard is None else guard.state_dict()}, ckpt_path + ".tmp")
+        os.replace(ckpt_path + ".tmp", ckpt_path)
+        end_time = time.time()
+        if verbose:
+            print(n+1, "/", steps, " steps/s:", c/(end_time-start_time))
+    del u_disk
+    return np.load(path, mmap_mode="r")
+
+
+#############################################################
+################# Recurrent (LSTM) Models  ##################
+#############################################################
+# Models driven by a window of the last W states (e.g. the CGNN LSTM of PSBSE_MixModel(LSTM)) rerun the LSTM over the
+# whole window and rebuild the window with torch.cat at every step, i.e. O(W) work plus an allocation per step.
+# LSTMStepper keeps the LSTM state instead and advances it by a single cell step wherever this gives the same result.
+
+class HistoryBuffer:
+    """
+    Ring buffer of the last W inputs. Every input is written twice (at i and i+W of a buffer of length 2W), so the
+    window is always the contiguous view storage[:, i+1:i+1+W] and a push is O(1) without allocation.
+    In-place writes: only for inference (no autograd through the window).
+    """
+    def __init__(self, x_history):
+        """
+        :param x_history: torch.Tensor(N, W, d); Initial window (oldest first)
+        """
+        N, W, d = x_history.shape
+        self.W = W
+        self.storage = torch.cat([x_history, x_history], dim=1).detach()
+        self.i = W-1
+
+    def push(self, x_new):
+        # x_new: (N, d); drops the oldest input of the window
+        self.i = (self.i + 1) % self.W
+        self.storage[:, self.i] = x_new
+        self.storage[:, self.i+self.W] = x_new
+
+    def window(self):
+        # (N, W, d) view, oldest first
+        return self.storage[:, self.i+1:self.i+1+self.W]
+
+
+class LSTMStepper:
+    """
+    Output of a batch_first nn.LSTM at the end of an input window that is advanced one input at a time.
+    memory = "fixed":    the first W-1 inputs stay fixed and push() replaces the newest one (the window update of the
+                         LSTM MixModel solvers, torch.cat([u_history[:-1], u_new])). The LSTM state after the fixed
+                         inputs is computed once, each step is one cell step: O(1), same result as rerunning the window.
+    memory = "window":   sliding window of the last W inputs in a HistoryBuffer, LSTM rerun over the window: O(W) per
+                         step but without allocations; exact sliding-window semantics.
+    memory = "stateful": the LSTM state is carried from step to step and rebuilt from the last W-1 inputs of the
+                         HistoryBuffer every W steps, so the memory is truncated to W-1 to 2W-2 inputs: O(1) amortized.
+                         Right after each rebuild the output equals the "window" output.
+    """
+    def __init__(self, lstm, x_history, memory="fixed"):
+        """
+        :param lstm: nn.LSTM; batch_first LSTM
+        :param x_history: torch.Tensor(N, W, d); Initial input window (oldest first)
+        :param memory: str; "fixed", "window" or "stateful"
+        """
+        if memory not in ("fixed", "window", "stateful"):
+            raise ValueError(f"Unknown memory {memory}, expected 'fixed', 'window' or 'stateful'")
+        self.lstm = lstm
+        self.memory = memory
+        self.W = x_history.shape[1]
+        self.x_last = x_history[:, -1]
+        self.state = self._state(x_history[:, :-1])
+        self.next_state = None
+        if memory != "fixed":
+            self.buffer = HistoryBuffer(x_history)
+            self.pushes = 0
+
+    def _state(self, x):
+        # (h, c) of the LSTM after the inputs x (N, t, d); None (zero state) for t = 0
+        if x.shape[1] == 0:
+            return None
+        return self.lstm(x)[1]
+
+    def output(self):
+        """
+        :return: torch.Tensor(N, hidden); Output of the last layer at the newest input
+        """
+        if self.memory == "window":
+            return self.lstm(self.buffer.window())[0][:, -1]
+        out, self.next_state = self.lstm(self.x_last.unsqueeze(1), self.state)
+        return out[:, -1]
+
+    def push(self, x_new):
+        """
+        :param x_new: torch.Tensor(N, d); Newest input
+        """
+        if self.memory != "fixed":
+            self.buffer.push(x_new)
+            self.pushes += 1
+        if self.memory == "stateful":
+            if self.pushes % self.W == 0:
+                self.state = self._state(self.buffer.window()[:, :-1])
+            else:
+                if self.next_state is None:
+                    self.output()
+                self.state = self.next_state
+        self.next_state = None
+        self.x_last = x_new
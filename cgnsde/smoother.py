@@ -0,0 +1,180 @@
+import numpy as np
+import torch
+
+from cgnsde.filter import cg_coefficients, _cg_recursion
+
+
+#####################################################
+################# Backward Kernel  ##################
+#####################################################
+# In the Euler-discretized CG model, the hidden state u2[n] given the filter posterior N(mu[n], R[n]), the observed
+# increment du1[n] and the next hidden state u2[n+1] is Gaussian:
+#     precision  P[n] = inv(R[n]) + H[n] dt + A[n].T inv(Q[n]) A[n],    A = I + g2 dt,  Q = s2 s2.T dt,
+#     u2[n] | u2[n+1] ~ N(c[n] + M[n] u2[n+1], S[n]),    S = inv(P),  M = S A.T inv(Q),
+#     c[n] = S (inv(R) mu + G (du1 - f1 dt) - A.T inv(Q) f2 dt).
+# c, M, S only depend on the observations and the filter trace, so they are computed for whole blocks of steps at once;
+# backward sampling (CGSampler) and smoothing (CGSmoother) then only apply these affine maps backward in time.
+
+def backward_kernel(coefs, mu_trace, R_trace, dt):
+    """
+    :param coefs: tuple; cg_coefficients of the N transitions u1[n] -> u1[n+1]
+    :param mu_trace: torch.Tensor(N, d2, 1); Filter posterior means at the first N steps
+    :param R_trace: torch.Tensor(N, d2, d2); Filter posterior covariances at the first N steps
+    :param dt: float; Time step
+    :return: tuple; (c (N, d2, 1), M (N, d2, d2), S (N, d2, d2)), in float64
+    """
+    innov0, g1, f2, g2, G, H, s2os2 = (x.detach().to(torch.float64) for x in coefs)
+    mu = mu_trace.detach().to(torch.float64)
+    R = R_trace.detach().to(torch.float64)
+    d2 = mu.shape[1]
+    eye = torch.eye(d2, dtype=torch.float64, device=mu.device)
+    A = eye + g2*dt
+    invR = torch.linalg.inv(R)
+    AtinvQ = A.mT @ torch.linalg.inv(s2os2*dt)
+    S = torch.linalg.inv(invR + H*dt + AtinvQ @ A)
+    S = (S + S.mT) / 2
+    c = S @ (invR @ mu + G @ innov0 - AtinvQ @ f2 * dt)
+    return (c, S @ AtinvQ, S)
+
+
+####################################################
+################# Trajectory Sampler  ##############
+####################################################
+
+def CGSampler(coef, u1, mu_trace, R_trace, dt, samples, block_size=1000, generator=None, path=None):
+    """
+    Forward-filter backward-sample: K trajectories of u2 drawn at once from the posterior given all observations u1.
+    The backward pass runs block by block (kernel of a block in one batched call, noise of a block drawn at once), so
+    only one block of coefficients is held in memory; with path the samples are streamed to a .npy file.
+    :param coef: callable; Same as for CGFilter; it is called on blocks of consecutive observations
+    :param u1: torch.Tensor(Nt, d1, 1); Observed variables
+    :param mu_trace: torch.Tensor(Nt, d2, 1); CGFilter posterior means of u1 (cut_point=0)
+    :param R_trace: torch.Tensor(Nt, d2, d2); CGFilter posterior covariances of u1 (cut_point=0)
+    :param dt: float; Time step
+    :param samples: int; Number K of trajectories
+    :param block_size: int; Number of steps per block
+    :param generator: torch.Generator; Random number generator (default: global RNG)
+    :param path: str; Output .npy file (Nt, K, d2); None keeps the samples in memory
+    :return: torch.Tensor(Nt, K, d2), or np.memmap(Nt, K, d2) (read-only) with path
+    """
+    Nt, d2 = mu_trace.shape[:2]
+    dtype = mu_trace.dtype
+    shape = (Nt, samples, d2)
+    if path is None:
+        out = torch.empty(shape, dtype=dtype)
+    else:
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=np.dtype(str(dtype).replace("torch.", "")), shape=shape)
+
+    def randn(*size):
+        return torch.randn(size, generator=generator, dtype=torch.float64)
+
+    def write(a, x):
+        out[a:a+x.shape[0]] = x.to(dtype) if path is None else x.cpu().numpy()
+
+    with torch.no_grad():
+        R_last = R_trace[-1].detach().to(torch.float64)
+        L_last = torch.linalg.cholesky((R_last + R_last.T) / 2)
+        x = mu_trace[-1, :, 0].detach().to(torch.float64) + randn(samples, d2) @ L_last.T
+        write(Nt-1, x.unsqueeze(0))
+        for b in range(Nt-1, 0, -block_size):
+            a = max(b-block_size, 0)
+            c, M, S = backward_kernel(cg_coefficients(coef, u1[a:b+1], dt), mu_trace[a:b], R_trace[a:b], dt)
+            L = torch.linalg.cholesky(S)
+            noise = randn(b-a, samples, d2)
+            block = torch.empty((b-a, samples, d2), dtype=torch.float64)
+            for n in range(b-a-1, -1, -1):
+                # x (K, d2) rows: u2[n] = c + M u2[n+1] + L xi
+                x = c[n, :, 0] + x @ M[n].T + noise[n] @ L[n].T
+                block[n] = x
+            write(a, block)
+    if path is None:
+        return out
+    out.flush()
+    return np.load(path, mmap_mode="r")
+
+
+####################################################
+################# CG Smoother  #####################
+####################################################
+# The smoother posteriors follow from the backward kernel by
+#     mu_s[n] = c[n] + M[n] mu_s[n+1],    R_s[n] = S[n] + M[n] R_s[n+1] M[n].T,    starting from the filter at Nt-1.
+# Both are affine maps of the next step, and the composition of two such maps e = (M, c, S) is again one:
+#     e1 o e2 = (M1 M2, c1 + M1 c2, S1 + M1 S2 M1.T).
+# Within a block of L steps, all suffix compositions e[n] o ... o e[L-1] are formed by a log2(L)-level doubling scan of
+# batched matrix products, and each block is then applied to the smoother posterior at its right boundary.
+
+def _compose(e1, e2):
+    M1, c1, S1 = e1
+    M2, c2, S2 = e2
+    return (M1 @ M2, c1 + M1 @ c2, S1 + M1 @ S2 @ M1.mT)
+
+
+def _suffix_scan(M, c, S):
+    # Inclusive suffix compositions of the block (Hillis-Steele doubling)
+    L = M.shape[0]
+    k = 1
+    while k < L:
+        head = _compose((M[:L-k], c[:L-k], S[:L-k]), (M[k:], c[k:], S[k:]))
+        M = torch.cat([head[0], M[L-k:]])
+        c = torch.cat([head[1], c[L-k:]])
+        S = torch.cat([head[2], S[L-k:]])
+        k *= 2
+    return (M, c, S)
+
+
+def CGSmoother(coef, u1, dt, mu_trace=None, R_trace=None, mu0=None, R0=None, block_size=1000, segment_size=None):
+    """
+    Forward-backward CG smoother: posteriors of u2 given all observations u1.
+    Either the filter traces of any CGFilter variant are passed (mu_trace, R_trace), or the memory-light mode
+    (mu0, R0, segment_size) runs the filter itself, keeping only the filter state at the segment boundaries and
+    recomputing the filter trace of one segment at a time during the backward pass.
+    :param coef: callable; Same as for CGFilter; it is called on blocks of consecutive observations
+    :param u1: torch.Tensor(Nt, d1, 1); Observed variables
+    :param dt: float; Time step
+    :param mu_trace: torch.Tensor(Nt, d2, 1); CGFilter posterior means of u1 (cut_point=0)
+    :param R_trace: torch.Tensor(Nt, d2, d2); CGFilter posterior covariances of u1 (cut_point=0)
+    :param mu0: torch.Tensor(d2, 1); Initial posterior mean (memory-light mode)
+    :param R0: torch.Tensor(d2, d2); Initial posterior covariance (memory-light mode)
+    :param block_size: int; Number of steps per scan block
+    :param segment_size: int; Number of steps whose filter trace is recomputed at once (memory-light mode)
+    :return: tuple; (mu_s (Nt, d2, 1), R_s (Nt, d2, d2)) in the dtype of the filter
+    """
+    Nt = u1.shape[0]
+
+    def filter_segments():
+        # Filter traces (s, e, mu_f, R_f) of the steps s..e-1, last segment first
+        if mu_trace is not None:
+            yield (0, Nt, mu_trace.detach(), R_trace.detach())
+            return
+        # Forward pass keeping only the filter state at the start of every segment
+        starts = list(range(0, Nt-1, segment_size)) or [0]
+        states = [(mu0.detach(), R0.detach())]
+        for s in starts[1:]:
+            mu_f, R_f = _cg_recursion(cg_coefficients(coef, u1[s-segment_size:s+1], dt), *states[-1], dt)
+            states.append((mu_f[-1], R_f[-1]))
+        for i in range(len(starts)-1, -1, -1):
+            s = starts[i]
+            e = Nt if i == len(starts)-1 else starts[i+1]+1
+            yield (s, e) + tuple(_cg_recursion(cg_coefficients(coef, u1[s:e], dt), *states[i], dt))
+
+    mu_s = R_s = None
+    with torch.no_grad():
+        for s, e, mu_f, R_f in filter_segments():
+            if mu_s is None:
+                # The smoother posterior at the last step is the filter posterior
+                mu_s = torch.empty((Nt,) + tuple(mu_f.shape[1:]), dtype=mu_f.dtype)
+                R_s = torch.empty((Nt,) + tuple(R_f.shape[1:]), dtype=R_f.dtype)
+                mu_s[-1] = mu_f[-1]
+                R_s[-1] = R_f[-1]
+                next_mu = mu_f[-1].to(torch.float64)
+                next_R = R_f[-1].to(torch.float64)
+            for b in range(e-1, s, -block_size):
+                a = max(b-block_size, s)
+                c, M, S = backward_kernel(cg_coefficients(coef, u1[a:b+1], dt), mu_f[a-s:b-s], R_f[a-s:b-s], dt)
+                M, c, S = _suffix_scan(M, c, S)
+                mu_block = c + M @ next_mu
+                R_block = S + M @ next_R @ M.mT
+                mu_s[a:b] = mu_block.to(mu_s.dtype)
+                R_s[a:b] = R_block.to(R_s.dtype)
+                next_mu, next_R = mu_block[0], R_block[0]
+    return (mu_s, R_s)
@@ -0,0 +1,207 @@
+import itertools
+import numpy as np
+
+from cgnsde.parallel import map_jobs
+
+
+########################################################
+################# Causation Entropy  ###################
+########################################################
+# For Gaussian statistics, the causation entropy of the candidate term a_j to the target y given the other terms is
+#     C(a_j -> y | A\a_j) = 1/2 log(det R_YZ / det R_Z) - 1/2 log(det R_XYZ / det R_XZ)
+#                         = 1/2 log(Var(y | A\a_j) / Var(y | A)),
+# a ratio of two conditional variances. From the precision K = inv(R_AA) of the library, the regression coefficients
+# beta = K R_Ay and the residual variance s = Var(y | A) = R_yy - R_yA beta, the Schur complement of a_j gives
+#     Var(y | A\a_j) = s + beta_j^2 / K_jj,    so    C = 1/2 log1p(beta_j^2 / (s K_jj)).
+# One Cholesky factor of R_AA serves all targets; the cost is O(Na^3 + Na^2 Nb) and no determinant is formed.
+
+def cem_from_cov(R, Na):
+    """
+    Causation entropy matrix from the joint covariance of the library and the targets.
+    :param R: numpy.array(Na+Nb, Na+Nb); Covariance of [A, B]
+    :param Na: int; Number of basis functions (leading block of R)
+    :return: numpy.array(Nb, Na); Causation Entropy Matrix C(X->Y|Z)
+    """
+    R = np.asarray(R, dtype=np.float64)
+    L_inv = np.linalg.inv(np.linalg.cholesky(R[:Na, :Na]))
+    W = L_inv @ R[:Na, Na:]  # (Na, Nb); beta = L_inv.T W
+    beta = L_inv.T @ W
+    s = np.diagonal(R[Na:, Na:]) - np.sum(W**2, axis=0)
+    K_diag = np.sum(L_inv**2, axis=0)
+    return 1/2 * np.log1p(beta.T**2 / (s[:, None] * K_diag[None, :]))
+
+
+def cem(A, B):
+    """
+    :param A: numpy.array(Nt, Na); Basis Functions
+    :param B: numpy.array(Nt, Nb); Dynamics (any number of targets)
+    :return: numpy.array(Nb, Na); Causation Entropy Matrix C(X->Y|Z)
+    """
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64).reshape(A.shape[0], -1)
+    return cem_from_cov(np.cov(np.concatenate([A, B], axis=1).T), A.shape[1])
+
+
+########################################################
+################# Streaming Covariance  ################
+########################################################
+# CEM only needs the joint covariance of the library terms and the targets. Instead of stacking the library of all
+# sites (Nt * sites, Na) before np.cov, the covariance is accumulated over (site, time chunk) blocks, or over time chunks
+# of all sites when the library is a PolyLibrary gathering its stencils itself: each block gives its count, mean and
+# centered scatter matrix, and blocks are merged with Chan's pairwise update
+#     n = na + nb,   mean = ma + d nb / n,   M2 = M2a + M2b + d d.T na nb / n,   d = mb - ma,
+# so memory is O(Na^2) plus one block, and blocks can be reduced in worker processes.
+
+def _block_stats(X):
+    # Count, mean and centered scatter matrix of the rows X (k, d)
+    X = np.asarray(X, dtype=np.float64)
+    mean = np.mean(X, axis=0)
+    D = X - mean
+    return (X.shape[0], mean, D.T @ D)
+
+
+class CovAccumulator:
+    # Running mean and covariance of rows (Welford/Chan merge of block statistics)
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.M2 = None
+
+    def merge(self, n, mean, M2):
+        if self.n == 0:
+            self.n, self.mean, self.M2 = n, mean.copy(), M2.copy()
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.M2 = self.M2 + M2 + np.outer(delta, delta) * self.n * n / total
+        self.n = total
+
+    def update(self, X):
+        # Rows X (k, d) of a new block
+        self.merge(*_block_stats(X))
+
+    def cov(self):
+        # Sample covariance (d, d), as np.cov of all rows seen
+        return self.M2 / (self.n - 1)
+
+
+def _cov_block(job, block):
+    i, start, size = block
+    u = job["u"][start:start+size]
+    u_dot = job["u_dot"][start:start+size]
+    if i is None:
+        # All sites of the chunk in one gather, stacked site by site as in the per-site blocks; the library is
+        # assembled term-major (Na+1, rows) and passed transposed, which avoids a strided copy
+        lib = np.moveaxis(job["basis"].gather(u, job["sites"]), -1, 0)
+        return _block_stats(np.concatenate([lib.reshape(lib.shape[0], -1),
+                                            u_dot[:, job["sites"]].T.reshape(1, -1)]).T)
+    return _block_stats(np.concatenate([job["basis"](u[:, job["stencil"](i)]), u_dot[:, [i]]], axis=1))
+
+
+def library_cov(basis, u, u_dot, sites, stencil=None, chunk_size=10000, processes=1):
+    """
+    Joint covariance of the library terms and the target stacked over sites, i.e. np.cov of
+    [np.concatenate([basis(u[:, stencil(i)]) for i in sites]), u_dot[:, sites].T.reshape(-1, 1)], without stacking.
+    :param basis: callable; basis(x) returns the library (N, Na) of the local states x (N, s), or a PolyLibrary
+    :param u: numpy.array(Nt, dim); States
+    :param u_dot: numpy.array(Nt, dim); Targets (time derivatives)
+    :param sites: list; Sites i whose library and target u_dot[:, i] are stacked
+    :param stencil: callable; stencil(i) returns the columns of u forming the local state of site i
+                    (None: basis is a PolyLibrary, whose stencil offsets are gathered for all sites of a chunk at once)
+    :param chunk_size: int; Number of rows per block (time steps of one site, or chunk_size // len(sites) steps of all sites)
+    :param processes: int; Number of forked worker processes over the blocks (None: all CPU cores), see cgnsde.parallel
+    :return: numpy.array(Na+1, Na+1); Covariance, the target last (see cem_from_cov)
+    """
+    if stencil is None:
+        size = max(chunk_size // len(sites), 1)
+        blocks = [(None, start, size) for start in range(0, u.shape[0], size)]
+    else:
+        blocks = [(i, start, chunk_size) for i in sites for start in range(0, u.shape[0], chunk_size)]
+    job = dict(basis=basis, u=u, u_dot=u_dot, sites=np.asarray(sites), stencil=stencil)
+    acc = CovAccumulator()
+    for stats in map_jobs(_cov_block, job, blocks, processes):
+        acc.merge(*stats)
+    return acc.cov()
+
+
+########################################################
+################# Polynomial Library  ##################
+########################################################
+# Candidate libraries are generated instead of written out: the local state of site i is the set of variables
+# u[:, i + offset] for the stencil offsets (modulo the ring size), and the terms are all monomials of these variables up
+# to the given degree. With cg=True, monomials of degree > 1 in the hidden variables (u2) are dropped, so every term is
+# at most linear in u2 and the identified model stays conditionally Gaussian. Within each degree, pure powers come first
+# and mixed products follow in lexicographic order; this reproduces the hand-written basisCG1/basisCG2 of the L96 scripts
+# and the [x, y, z, x^2, xy, xz] library of PSBSE.
+# Evaluation gathers the stencils of all sites and times with one fancy index u.T[(sites[:, None] + offsets).T] and builds
+# each monomial as (its lower-degree prefix) * (one variable), so shared factors are multiplied only once.
+
+class PolyLibrary:
+    """
+    :param offsets: list; Stencil offsets of the local variables relative to the site, e.g. [-2, -1, 0, 1, 2]
+    :param hidden: list; Offsets of the hidden variables (u2)
+    :param degree: int; Maximum degree of the monomials
+    :param cg: bool; Keep only the terms at most linear in the hidden variables
+    :param size: int; Ring size I (indices wrap modulo I); None for a non-periodic state
+    :param names: list; Names of the local variables (default u_{i+offset})
+    :param constant: bool; Include the constant term
+    """
+    def __init__(self, offsets, hidden=(), degree=2, cg=True, size=None, names=None, constant=False):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.size = size
+        self.variables = list(names) if names is not None else \
+                         ["u_{i%+d}" % o if o else "u_{i}" for o in self.offsets]
+        hidden = [k for k, o in enumerate(self.offsets) if o in set(hidden)]
+        self.terms = [()] if constant else []
+        for d in range(1, degree+1):
+            combos = [c for c in itertools.combinations_with_replacement(range(len(self.offsets)), d)
+                      if not cg or sum(k in hidden for k in c) <= 1]
+            self.terms += [c for c in combos if len(set(c)) == 1] + [c for c in combos if len(set(c)) > 1]
+        self.names = [self._name(c) for c in self.terms]
+
+    def _name(self, term):
+        if not term:
+            return "1"
+        return "*".join(self.variables[k] + ("^%d" % term.count(k) if term.count(k) > 1 else "")
+                        for k in sorted(set(term)))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _evaluate(self, xs):
+        # Terms (Na, ...) of the variable-major local states xs (s, ...), each monomial from its lower-degree prefix
+        out = np.empty((len(self.terms),) + xs.shape[1:])
+        cache = {(): np.ones(xs.shape[1:])}
+
+        def monomial(term):
+            if term not in cache:
+                cache[term] = monomial(term[:-1]) * xs[term[-1]]
+            return cache[term]
+
+        for j, term in enumerate(self.terms):
+            out[j] = monomial(term)
+        return out
+
+    def __call__(self, x):
+        """
+        :param x: numpy.array(..., s); Local states, the variables in the order of offsets
+        :return: numpy.array(..., Na); Library terms
+        """
+        return np.moveaxis(self._evaluate(np.moveaxis(np.asarray(x, dtype=np.float64), -1, 0)), 0, -1)
+
+    def stencil(self, i):
+        # Columns of u forming the local state of site i
+        columns = i + self.offsets
+        return columns % self.size if self.size is not None else columns
+
+    def gather(self, u, sites):
+        """
+        Library of all sites and times in one vectorized call.
+        :param u: numpy.array(Nt, dim); States
+        :param sites: list; Sites i
+        :return: numpy.array(sites, Nt, Na); Library of every site
+        """
+        columns = self.stencil(np.asarray(sites)[:, None])  # (sites, s)
+        xs = np.asarray(u, dtype=np.float64).T[columns.T]  # (s, sites, Nt)
+        return np.moveaxis(self._evaluate(xs), 0, -1)
@@ -0,0 +1,91 @@
+import numpy as np
+
+from cgnsde.enkbf import EnKBF, L96Tendency, StreamingEnKBF, enkbf_repeats, l96_tendency, ring_localization, \
+                         split_tendency
+
+
+# Lorenz-96 case2 setting of the EnKBF scripts on a smaller ring: u1 at the even sites, u2 at the odd ones.
+
+F = 8.
+I = 12
+sigma = 0.5
+dt = 0.01
+indices_u1 = np.arange(0, I, 2)
+indices_u2 = np.arange(1, I, 2)
+
+
+def l96_data(Nt, c=1., seed=0):
+    rng = np.random.default_rng(seed)
+    u = np.zeros((Nt, I))
+    u[0] = rng.standard_normal(I)
+    for n in range(Nt-1):
+        u_dot = -c*u[n] + (np.roll(u[n], -1) - np.roll(u[n], 2))*np.roll(u[n], 1) + F
+        u[n+1] = u[n] + u_dot*dt + sigma*np.sqrt(dt)*rng.standard_normal(I)
+    return u
+
+
+def enkbf_loop(u1, J, c=1.):
+    # EnKBF loop of the scripts before cgnsde.enkbf: site-by-site tendency, interleaved u1/u2, np.random.randn per step
+    Nt, p = u1.shape[0], len(indices_u2)
+    c = np.broadcast_to(c, (I,))
+    SIG1 = np.diag([sigma**2]*len(indices_u1))
+    sig2 = np.diag([sigma]*p)
+    u2_ens = np.zeros((J, Nt, p))
+    for n in range(1, Nt):
+        u1_repeat = np.tile(u1[n-1], (J, 1))
+        u_ens = np.stack([u1_repeat, u2_ens[:, n-1]]).transpose(1, 2, 0).reshape(-1, I)
+        u_dot_ens = np.zeros_like(u_ens)
+        for i in range(I):
+            u_dot_ens[:, i] = -c[i]*u_ens[:, i] + u_ens[:, (i+1) % I]*u_ens[:, i-1] - u_ens[:, i-2]*u_ens[:, i-1] + F
+        g = u_dot_ens[:, indices_u1]
+        f = u_dot_ens[:, indices_u2]
+        g_bar = np.mean(g, axis=0)
+        CCOV = (u2_ens[:, n-1] - np.mean(u2_ens[:, n-1], axis=0)).T @ (g - g_bar) / (J-1)
+        Sys_term = f*dt + np.random.randn(J, p) @ sig2 * np.sqrt(dt)
+        DA_term = -0.5*((g+g_bar)*dt-2*(u1[n]-u1[n-1])) @ (CCOV@np.linalg.inv(SIG1)).T
+        u2_ens[:, n] = u2_ens[:, n-1] + Sys_term + DA_term
+    return u2_ens
+
+
+def test_enkbf_matches_loop_with_same_seed():
+    sig = np.diag([sigma]*len(indices_u1))
+    for c in (1., np.linspace(0.8, 1.2, I)):
+        u1 = l96_data(300, c)[:, indices_u1]
+        np.random.seed(1)
+        expected = enkbf_loop(u1, 20, c)
+        for tendency in (L96Tendency(F, indices_u1, indices_u2, c),
+                         split_tendency(lambda u: l96_tendency(u, F, c), indices_u1, indices_u2)):
+            np.random.seed(1)
+            out = EnKBF(tendency, u1, np.zeros((20, len(indices_u2))), dt, sig, sig, block_size=64)
+            np.testing.assert_allclose(out, expected, rtol=0, atol=1e-10)
+
+
+def test_compiled_steps_match_vectorized_steps():
+    # L96Tendency (compiled loop) against the same tendency through split_tendency (one vectorized call per step)
+    u1 = l96_data(200)[:, indices_u1]
+    sig = np.diag([sigma]*len(indices_u1))
+    kwargs = dict(localization=ring_localization(indices_u2, indices_u1, I, 2.), inflation=0.5, additive=0.1)
+    compiled = L96Tendency(F, indices_u1, indices_u2)
+    vectorized = split_tendency(lambda u: l96_tendency(u, F), indices_u1, indices_u2)
+    u2_0 = np.zeros((3, 10, len(indices_u2)))
+    out = [EnKBF(tendency, u1, u2_0, dt, sig, sig, rng=np.random.default_rng(0), **kwargs)
+           for tendency in (compiled, vectorized)]
+    np.testing.assert_allclose(out[0], out[1], rtol=0, atol=1e-10)
+    u2 = l96_data(200)[:, indices_u2]
+    stats = [enkbf_repeats(tendency, u1, u2, 10, 4, dt, sig, sig, block_size=30, **kwargs)
+             for tendency in (compiled, vectorized)]
+    np.testing.assert_allclose(stats[0]["mse"], stats[1]["mse"], rtol=1e-10)
+    np.testing.assert_allclose(stats[0]["nll"], stats[1]["nll"], rtol=1e-10)
+
+
+def test_streaming_matches_enkbf():
+    u1 = l96_data(250)[:, indices_u1]
+    sig = np.diag([sigma]*len(indices_u1))
+    tendency = L96Tendency(F, indices_u1, indices_u2)
+    u2_0 = np.zeros((8, len(indices_u2)))
+    np.random.seed(2)
+    expected = EnKBF(tendency, u1, u2_0, dt, sig, sig)
+    np.random.seed(2)
+    enkbf = StreamingEnKBF(tendency, u2_0, dt, sig, sig)
+    enkbf.run(u1, chunk_size=37)
+    np.testing.assert_allclose(enkbf.ens, expected[:, -1], rtol=0, atol=1e-12)
@@ -0,0 +1,116 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from cgnsde.simulate import DivergenceGuard, HistoryBuffer, LSTMStepper
+
+
+# A MixModel of the shape of PSBSE_MixModel(LSTM): a CGNN (LSTM over the u1 history + linear head) whose outputs
+# modulate the dynamics of the newest state.
+
+class CGNN(nn.Module):
+    def __init__(self, input_size=1, hidden_size=5, output_size=3, num_layers=2):
+        super().__init__()
+        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
+        self.fc = nn.Linear(hidden_size, output_size)
+
+    def forward(self, x):
+        out_lstm, _ = self.lstm(x)
+        return self.fc(out_lstm[:, -1, :])
+
+
+class MixModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.net = CGNN()
+
+    def forward(self, u_history):
+        # u_history shape (N, t, x)
+        return self.dynamics(self.net(u_history[:, :, [0]]), u_history[:, -1, :])
+
+    def step(self, stepper, u):
+        return self.dynamics(self.net.fc(stepper.output()), u)
+
+    def dynamics(self, outnet, u):
+        return torch.stack([-u[:, 0] + outnet[:, 0], u[:, 0]*u[:, 2] + outnet[:, 1], -u[:, 0]*u[:, 1] + outnet[:, 2]]).T
+
+
+def sde_windowed(model, u_history, steps, dt, sigma):
+    # Solver loop before LSTMStepper: the LSTM reruns the window, rebuilt by torch.cat([u_history[:-1], u_new])
+    u_simu = torch.zeros(steps, u_history.shape[1])
+    u_simu[0] = u_history[-1]
+    for n in range(0, steps-1):
+        u_dot_pred = model(u_history.unsqueeze(0)).squeeze(0)
+        u_simu[n+1] = u_simu[n] + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(3)
+        u_history = torch.cat([u_history[:-1], u_simu[n+1].unsqueeze(0)])
+    return u_simu
+
+
+def sde_stepper(model, u_history, steps, dt, sigma, memory="fixed"):
+    # Solver loop of PSBSE_MixModel(LSTM) with LSTMStepper
+    u_simu = torch.zeros(steps, u_history.shape[1])
+    u_simu[0] = u_history[-1]
+    u_last = u_history[[-1]]
+    stepper = LSTMStepper(model.net.lstm, u_history[:, [0]].unsqueeze(0), memory)
+    for n in range(0, steps-1):
+        u_dot_pred = model.step(stepper, u_last)
+        u_last = u_last + u_dot_pred*dt + sigma*np.sqrt(dt)*torch.randn(3)
+        u_simu[n+1] = u_last.squeeze(0)
+        stepper.push(u_last[:, [0]])
+    return u_simu
+
+
+def test_fixed_memory_matches_windowed_solvers():
+    torch.manual_seed(0)
+    model = MixModel()
+    u_history = torch.randn(20, 3)
+    with torch.no_grad():
+        for sigma in (torch.zeros(3), torch.tensor([0.1, 0.2, 0.3])):
+            torch.manual_seed(1)
+            expected = sde_windowed(model, u_history, 200, 0.01, sigma)
+            torch.manual_seed(1)
+            out = sde_stepper(model, u_history, 200, 0.01, sigma)
+            torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_history_buffer_is_sliding_window():
+    torch.manual_seed(0)
+    x = torch.randn(2, 7, 3)
+    buffer = HistoryBuffer(x)
+    window = x
+    for _ in range(20):
+        x_new = torch.randn(2, 3)
+        buffer.push(x_new)
+        window = torch.cat([window[:, 1:], x_new.unsqueeze(1)], dim=1)
+        torch.testing.assert_close(buffer.window(), window, rtol=0, atol=0)
+
+
+def test_stateful_matches_window_after_rebuild():
+    torch.manual_seed(0)
+    lstm = nn.LSTM(1, 5, 2, batch_first=True)
+    W = 8
+    x_history = torch.randn(3, W, 1)
+    stateful = LSTMStepper(lstm, x_history, "stateful")
+    window = LSTMStepper(lstm, x_history, "window")
+    with torch.no_grad():
+        torch.testing.assert_close(stateful.output(), window.output())
+        for k in range(1, 5*W+1):
+            x_new = torch.randn(3, 1)
+            stateful.output()
+            stateful.push(x_new)
+            window.push(x_new)
+            if k % W == 0:
+                torch.testing.assert_close(stateful.output(), window.output(), rtol=1e-5, atol=1e-6)
+
+
+def test_guard_reset_between_runs():
+    guard = DivergenceGuard(-10., 10., mode="stop", dt=0.1)
+    u = torch.zeros(4, 2)
+    assert guard.check(0, u)
+    u[2, 1] = 11.
+    assert not guard.check(5, u)
+    assert guard.summary() == {"members": 4, "diverged": 1, "fraction": 0.25, "first": 0.5, "median": 0.5, "mean": 0.5}
+    guard.reset()
+    for n in range(3):
+        assert guard.check(n, torch.zeros(3, 2))
+    assert guard.summary() == {"members": 3, "diverged": 0, "fraction": 0.}
@@ -0,0 +1,40 @@
+import numpy as np
+
+from cgnsde.sysid import cem, cem_from_cov
+
+
+def cem_det(A, B):
+    # Causation entropy matrix of the SysId scripts before cgnsde.sysid: four determinants per entry
+    Na = A.shape[1]
+    Nb = B.shape[1]
+    CEM = np.zeros((Nb, Na))
+    for i in range(Nb):
+        XYZ = np.concatenate([A, B[:, [i]]], axis=1)
+        RXYZ = np.cov(XYZ.T)
+        RXYZ_det = np.linalg.det(RXYZ)
+        RXZ = RXYZ[:-1, :-1]
+        RXZ_det = np.linalg.det(RXZ)
+        for j in range(Na):
+            RYZ = np.delete(np.delete(RXYZ, j, axis=0), j, axis=1)
+            RYZ_det = np.linalg.det(RYZ)
+            RZ = RYZ[:-1, :-1]
+            RZ_det = np.linalg.det(RZ)
+            CEM[i, j] = 1/2 * np.log(RYZ_det) - 1/2*np.log(RZ_det) - 1/2*np.log(RXYZ_det) + 1/2*np.log(RXZ_det)
+    return CEM
+
+
+def test_cem_matches_determinants():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((2000, 3))
+    # Correlated library of monomials, as in the CG libraries, plus noisy copies of some terms
+    lib = np.concatenate([x, x**2, x[:, [0]]*x[:, [1]], x[:, [1]]*x[:, [2]]], axis=1)
+    lib = np.concatenate([lib, lib[:, :4] + 0.3*rng.standard_normal((2000, 4))], axis=1)
+    for Na, Nb in ((6, 3), (12, 1)):
+        A = lib[:, :Na]
+        # Targets driven by some of the terms
+        W = rng.standard_normal((Na, Nb)) * (rng.random((Na, Nb)) < 0.5)
+        B = A @ W + 0.5*rng.standard_normal((2000, Nb))
+        expected = cem_det(A, B)
+        np.testing.assert_allclose(cem(A, B), expected, rtol=1e-6, atol=1e-10)
+        R = np.cov(np.concatenate([A, B], axis=1).T)
+        np.testing.assert_allclose(cem_from_cov(R, Na), expected, rtol=1e-6, atol=1e-10)